@@ -50,6 +50,11 @@ else:
     timeUsed = 0
     avgSyncTime = 0
 
+# how long users waited in each queue lane before a worker picked them up
+laneWaitTimes = {}
+for laneWaitAgg in db.sync_worker_stats.aggregate([{"$match": {"QueueWait": {"$ne": None}}}, {"$group": {"_id": "$Lane", "wait": {"$avg": "$QueueWait"}}}]):
+    laneWaitTimes[laneWaitAgg["_id"] if laneWaitAgg["_id"] else "scheduled"] = laneWaitAgg["wait"]
+
 # error/pending/locked stats
 lockedSyncRecords = list(db.users.aggregate([
                                        {"$match": {"SynchronizationWorker": {"$ne": None}}},
@@ -97,7 +102,8 @@ db.sync_status_stats.insert({
         "TotalErrors": totalErrors,
         "SyncTimeUsed": timeUsed,
         "SyncEnqueueTime": enqueueTime.total_seconds(),
-        "SyncQueueHeadTime": rmq_user_queue_wait_time
+        "SyncQueueHeadTime": rmq_user_queue_wait_time,
+        "SyncLaneWaitTimes": laneWaitTimes
 })
 
 db.stats.update({}, {"$set": {
@@ -109,6 +115,7 @@ db.stats.update({}, {"$set": {
                         "LastHourSynchronizationCount": totalSyncOps,
                         "EnqueueTime": enqueueTime.total_seconds(),
                         "QueueHeadTime": rmq_user_queue_wait_time,
+                        "LaneWaitTimes": laneWaitTimes,
                         "Updated": datetime.utcnow() }}, upsert=True)
 
 
@@ -30,6 +30,8 @@ def celery_shutdown(**kwargs):
 @celery_app.task(acks_late=True)
 def trigger_poll(service_id, index):
     from tapiriik.auth import User
+    from tapiriik.sync.schedule import SyncSchedule
+    from tapiriik.sync.lanes import SyncLane
     print("Polling %s-%d" % (service_id, index))
     svc = Service.FromID(service_id)
     affected_connection_external_ids = svc.PollPartialSyncTrigger(index)
@@ -44,14 +46,14 @@ def trigger_poll(service_id, index):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    SyncSchedule.ScheduleMatching(trigger_users_query, datetime.utcnow(), SyncLane.Triggered)
 
     db.poll_stats.insert({"Service": service_id, "Index": index, "Timestamp": datetime.utcnow(), "TriggerCount": len(affected_connection_external_ids)})
 
 def schedule_trigger_poll():
     schedule_data = list(db.trigger_poll_scheduling.find())
     print("Scheduler run at %s" % datetime.now())
-    for svc in Service.List():
+    for svc in Service.List(lambda x: x.get("PollsPartialSyncTrigger")):
         if svc.PartialSyncTriggerRequiresPolling and svc.ID not in DISABLED_SERVICES:
             print("Checking %s's %d poll indexes" % (svc.ID, svc.PartialSyncTriggerPollMultiple))
             for idx in range(svc.PartialSyncTriggerPollMultiple):
@@ -21,6 +21,8 @@ def celery_shutdown(**kwargs):
 @celery_app.task(acks_late=True)
 def trigger_remote(service_id, affected_connection_external_ids_with_payloads):
     from tapiriik.auth import User
+    from tapiriik.sync.schedule import SyncSchedule
+    from tapiriik.sync.lanes import SyncLane
     affected_connection_ids = list()
 
     for item in affected_connection_external_ids_with_payloads:
@@ -39,4 +41,4 @@ def trigger_remote(service_id, affected_connection_external_ids_with_payloads):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    SyncSchedule.ScheduleMatching(trigger_users_query, datetime.utcnow(), SyncLane.Triggered)
@@ -1,34 +1,176 @@
 from tapiriik.database import db
 from tapiriik.sync import Sync
-from datetime import datetime
+from tapiriik.sync.lanes import SyncLane
+from tapiriik.sync.schedule import SyncSchedule
+from tapiriik.sync.cost import SyncCost
+from tapiriik.sync.backpressure import SyncBackpressure
+from tapiriik.sync.affinity import SyncAffinity
+from tapiriik.sync.publisher import BatchPublisher
+from tapiriik.messagequeue import mq
+from tapiriik.services.health import ServiceHealth
+from tapiriik.settings import SYNC_SCHEDULER_BATCH_SIZE, SYNC_SCHEDULER_REBUILD_INTERVAL, SYNC_SCHEDULER_EXPENSIVE_PER_MINUTE, SYNC_COST_EXPENSIVE_THRESHOLD, SYNC_SERVICE_HEALTH_RELEASE_SPREAD, SYNC_HOST_AFFINITY
+from collections import deque
+import pymongo
+from datetime import datetime, timedelta
 from pymongo.read_preferences import ReadPreference
 import kombu
+import random
 import time
 import uuid
 
 Sync.InitializeWorkerBindings()
 
 producer = kombu.Producer(Sync._channel, Sync._exchange)
+backpressure = SyncBackpressure([queues[1] for queues in Sync._lane_queues.values()]) # The global queues
+affinity = SyncAffinity(Sync._channel, producer) if SYNC_HOST_AFFINITY else None
+# Without the confirm_publish transport option - see BatchPublisher
+publisher = BatchPublisher(mq.clone(transport_options={}), kombu.Exchange("tapiriik-users", type="direct"))
 
-while True:
-    generation = str(uuid.uuid4())
-    queueing_at = datetime.utcnow()
-    users = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
-                {
-                    "NextSynchronization": {"$lte": datetime.utcnow()},
-                    "QueuedAt": {"$exists": False}
-                },
-                {
-                    "_id": True,
-                    "SynchronizationHostRestriction": True
-                }
-            ))
+def queue_users(users, lanes, generation, queueing_at):
     scheduled_ids = [x["_id"] for x in users]
-    print("Found %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
-    db.users.update({"_id": {"$in": scheduled_ids}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True}}, multi=True)
-    print("Marked %d users as queued at %s" % (len(scheduled_ids), datetime.utcnow()))
+    db.users.update({"_id": {"$in": scheduled_ids}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True, "SyncHeldUntil": True}}, multi=True)
+    messages = []
     for user in users:
-        producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=user["SynchronizationHostRestriction"] if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"] else "")
-    print("Scheduled %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
+        lane = lanes[user["_id"]]
+        body = {"user_id": str(user["_id"]), "generation": generation, "lane": lane}
+        host = user.get("SynchronizationHostRestriction")
+        if not host and affinity:
+            host = affinity.HostFor(user["_id"])
+            # So they can be moved elsewhere if the host goes away - unlike those restricted to it.
+            body["affinity"] = host is not None
+        messages.append((body, SyncLane.RoutingKey(lane, host)))
+    # The whole batch goes out, then we wait on the confirms for all of it at once.
+    unpublished = publisher.Publish(messages)
+    if unpublished:
+        # Otherwise they'd sit there marked as queued until someone noticed.
+        unpublished_ids = [scheduled_ids[idx] for idx in unpublished]
+        db.users.update({"_id": {"$in": unpublished_ids}, "QueuedGeneration": generation}, {"$set": {"NextSynchronization": queueing_at}, "$unset": {"QueuedAt": True}}, multi=True)
+        SyncSchedule.Add(dict((x, queueing_at) for x in unpublished_ids))
+        raise Exception("%d of %d users could not be queued" % (len(unpublished_ids), len(users)))
+
+# When we last queued each of the expensive users, going back a minute - so they're spread out rather than all landing on the workers at once.
+expensive_queued_at = deque()
+
+def held_until(user, unavailable):
+    """ When the user's sync could next get anywhere, given {service ID: when it's back} for the services that aren't usable - or None, if it can now """
+    services = set(x["Service"] for x in user.get("ConnectedServices", []))
+    down = sorted(unavailable[x] for x in services if x in unavailable)
+    # It takes two to sync.
+    needed = 2 - (len(services) - len(down))
+    if not down or len(services) < 2 or needed <= 0:
+        return None
+    return down[needed - 1] + timedelta(seconds=random.uniform(0, SYNC_SERVICE_HEALTH_RELEASE_SPREAD))
+
+def plan_users(users, queueing_at):
+    """ Returns the users to queue now (cheapest first, so everyone else isn't stuck behind the whales), their lanes, {user ID: due time} for the expensive users that'll have to wait, the same for those stuck on a service that's down, and for exhaustive syncs being put off """
+    while expensive_queued_at and expensive_queued_at[0] < queueing_at - timedelta(minutes=1):
+        expensive_queued_at.popleft()
+    unavailable = ServiceHealth.Unavailable(set(x["Service"] for user in users for x in user.get("ConnectedServices", [])), queueing_at)
+    costs = {}
+    lanes = {}
+    deferred = {}
+    held = {}
+    deferred_exhaustive = {}
+    queueable = []
+    for user in sorted(users, key=lambda x: x["NextSynchronization"]):
+        hold = held_until(user, unavailable)
+        if hold:
+            held[user["_id"]] = hold
+            continue
+        exhaustive = Sync.WillSyncExhaustively(user)
+        costs[user["_id"]] = SyncCost.Estimate(user, exhaustive)
+        expensive = costs[user["_id"]] > SYNC_COST_EXPENSIVE_THRESHOLD
+        lanes[user["_id"]] = SyncLane.ForUser(user, exhaustive, expensive)
+        if exhaustive and lanes[user["_id"]] == SyncLane.Exhaustive and backpressure.Saturated():
+            defer_until = SyncBackpressure.DeferUntil(user, queueing_at)
+            if defer_until:
+                deferred_exhaustive[user["_id"]] = (defer_until, user.get("ExhaustiveDeferredSince") or user["NextSynchronization"], user["NextSynchronization"])
+                continue
+        if expensive and lanes[user["_id"]] != SyncLane.Interactive:
+            if len(expensive_queued_at) >= SYNC_SCHEDULER_EXPENSIVE_PER_MINUTE:
+                deferred[user["_id"]] = expensive_queued_at[0] + timedelta(minutes=1) # When the next slot frees up
+                continue
+            expensive_queued_at.append(queueing_at)
+        queueable.append(user)
+    queueable.sort(key=lambda x: costs[x["_id"]])
+    return queueable, lanes, deferred, held, deferred_exhaustive
+
+def defer_exhaustive(deferred_exhaustive):
+    # Unlike the others, these really are rescheduled - they're not due till then.
+    # Unless they've clicked "sync now" (or been rescheduled some other way) since we read them, that is.
+    db.users.bulk_write([pymongo.UpdateOne({"_id": user_id, "QueuedAt": {"$exists": False}, "NextSynchronization": next_sync}, {"$set": {"NextSynchronization": defer_until, "ExhaustiveDeferredSince": deferred_since}}) for user_id, (defer_until, deferred_since, next_sync) in deferred_exhaustive.items()], ordered=False)
+    # So, whatever the records say now goes in the schedule - not what we meant to set.
+    SyncSchedule.Add(dict((x["_id"], SyncSchedule.DueAt(x)) for x in db.users.with_options(read_preference=ReadPreference.PRIMARY).find({"_id": {"$in": list(deferred_exhaustive.keys())}, "NextSynchronization": {"$ne": None}, "QueuedAt": {"$exists": False}}, {"NextSynchronization": True, "SyncHeldUntil": True})))
+
+last_rebuild = None
+while True:
+    if last_rebuild is None or datetime.utcnow() - last_rebuild > timedelta(seconds=SYNC_SCHEDULER_REBUILD_INTERVAL):
+        last_rebuild = datetime.utcnow()
+        print("Rebuilt schedule with %d users at %s" % (SyncSchedule.Rebuild(), datetime.utcnow()))
+
+    pass_start = time.time()
+    now = datetime.utcnow()
+    scheduled_count = deferred_count = 0
+    lag = 0
+    while True:
+        due_ids = SyncSchedule.PopDue(now, SYNC_SCHEDULER_BATCH_SIZE)
+        if not due_ids:
+            break
+        generation = str(uuid.uuid4())
+        queueing_at = datetime.utcnow()
+        users = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
+                    {
+                        "_id": {"$in": due_ids}
+                    },
+                    {
+                        "_id": True,
+                        "SynchronizationHostRestriction": True,
+                        "NextSynchronization": True,
+                        "QueuedAt": True,
+                        "NextSyncLane": True,
+                        "NextSyncIsExhaustive": True,
+                        "NonblockingSyncErrorCount": True,
+                        "ForcingExhaustiveSyncErrorCount": True,
+                        "SyncCost": True,
+                        "ConnectedServices": True,
+                        "ExhaustiveDeferredSince": True,
+                        "SyncHeldUntil": True,
+                        "Backfill": True
+                    }
+                ))
+        # The user record has the final say - they may have been rescheduled, queued some other way, or deleted since they went into the schedule.
+        pending = [x for x in users if x.get("NextSynchronization") is not None and "QueuedAt" not in x]
+        due_users = [x for x in pending if SyncSchedule.DueAt(x) <= now]
+        rescheduled = dict((x["_id"], SyncSchedule.DueAt(x)) for x in pending if SyncSchedule.DueAt(x) > now)
+        SyncSchedule.Add(rescheduled)
+        deferred_count += len(rescheduled)
+
+        if due_users:
+            lag = max(lag, (queueing_at - min(SyncSchedule.DueAt(x) for x in due_users)).total_seconds())
+            queueable_users, lanes, deferred, held, deferred_exhaustive = plan_users(due_users, queueing_at)
+            # These stay due as far as NextSynchronization's concerned, they just won't come up again till there's room (or the service is back).
+            SyncSchedule.Hold(deferred)
+            SyncSchedule.Hold(held)
+            deferred_count += len(deferred) + len(held)
+            if deferred_exhaustive:
+                print("Putting off %d exhaustive syncs (%d queued, %s wait)" % (len(deferred_exhaustive), backpressure.QueueLength, backpressure.QueueWait))
+                defer_exhaustive(deferred_exhaustive)
+                deferred_count += len(deferred_exhaustive)
+            if queueable_users:
+                queue_users(queueable_users, lanes, generation, queueing_at)
+            scheduled_count += len(queueable_users)
+
+        if len(due_ids) < SYNC_SCHEDULER_BATCH_SIZE:
+            break
+
+    latency = time.time() - pass_start
+    if scheduled_count or deferred_count:
+        print("Scheduled %d users (%d rescheduled/deferred) in %.3fs, %.1fs behind at %s" % (scheduled_count, deferred_count, latency, lag, datetime.utcnow()))
+    SyncSchedule.RecordPass({"Users": scheduled_count, "Rescheduled": deferred_count, "Latency": latency, "Lag": lag})
 
-    time.sleep(1)
+    # Nap till the next user's due, but not for more than a second - immediate syncs should stay that way.
+    next_due = SyncSchedule.NextDue()
+    if next_due is None:
+        time.sleep(1)
+    else:
+        time.sleep(min(1, max(0.05, (next_due - datetime.utcnow()).total_seconds())))
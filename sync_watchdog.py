@@ -1,5 +1,6 @@
 from tapiriik.database import db, close_connections
 from tapiriik.sync import SyncStep
+from tapiriik.sync.heartbeat import WorkerHeartbeat
 import os
 import signal
 import socket
@@ -9,7 +10,7 @@ print("Sync watchdog run at %s" % datetime.now())
 
 host = socket.gethostname()
 
-for worker in db.sync_workers.find({"Host": host}):
+for worker in WorkerHeartbeat.Read(db.sync_workers.find({"Host": host})):
     # Does the process still exist?
     alive = True
     try:
@@ -30,10 +31,14 @@ for worker in db.sync_workers.find({"Host": host}):
         alive = False
 
     # Clear it from the database if it's not alive.
+    # Its users aren't our problem any more - they're free to go again once its lease on them lapses.
     if not alive:
         db.sync_workers.remove({"_id": worker["_id"]})
-        # Unlock users attached to it.
-        db.users.update({"SynchronizationWorker": worker["Process"], "SynchronizationHost": host}, {"$unset":{"SynchronizationWorker": True}}, multi=True)
+
+# Just so someone knows - they'll be picked up whenever they're next queued.
+lapsed_count = db.users.find({"SynchronizationHost": host, "SynchronizationWorker": {"$ne": None}, "SynchronizationLeaseExpiry": {"$lt": datetime.utcnow()}}).count()
+if lapsed_count:
+    print("%d users on this host have lapsed leases" % lapsed_count)
 
 db.sync_watchdogs.update({"Host": host}, {"Host": host, "Timestamp": datetime.utcnow()}, upsert=True)
 
@@ -9,20 +9,24 @@ worker_message("booting")
 
 from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_requests_source_address
 from tapiriik import settings
-from tapiriik.database import db, close_connections
+from tapiriik.database import db, redis, close_connections
 from pymongo import ReturnDocument
 import sys
 import subprocess
 import socket
+import signal
+import time
+import traceback
 
 RecycleInterval = 2 # Time spent rebooting workers < time spent wrangling Python memory management.
+RespawnDelay = 5 # Seconds before forking again after a child dies
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
 os.chdir(oldCwd)
 
-def sync_heartbeat(state, user=None):
-    db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}})
+def sync_heartbeat(state, user=None, slot=0):
+    heartbeats[slot].Beat(state, user)
 
 worker_message("initialized")
 
@@ -36,23 +40,32 @@ worker_message("initialized")
 # (plus, we no longer query with Process/Host in sync_hearbeat)
 
 sys.stdout.flush()
-heartbeat_rec = db.sync_workers.find_one_and_update(
-	{
-		"Process": os.getpid(),
-		"Host": socket.gethostname()
-	}, { 
-		"$set": {
+
+def heartbeat_record(slot):
+    return {
+        "Process": os.getpid(),
+        "Host": socket.gethostname(),
+        "Slot": slot,
+        "Heartbeat": datetime.utcnow(),
+        "Startup":  datetime.utcnow(),
+        "Version": WorkerVersion,
+        "Index": settings.WORKER_INDEX,
+        "State": "startup"
+    }
+
+# When synchronizing several users at once, each gets a record of its own - they're all the same process, though.
+heartbeat_rec_ids = []
+for slot in range(settings.SYNC_WORKER_CONCURRENCY):
+	heartbeat_rec = db.sync_workers.find_one_and_update(
+		{
 			"Process": os.getpid(),
 			"Host": socket.gethostname(),
-			"Heartbeat": datetime.utcnow(),
-			"Startup":  datetime.utcnow(),
-			"Version": WorkerVersion,
-			"Index": settings.WORKER_INDEX,
-			"State": "startup"
-		}
-	}, upsert=True,
-	return_document=ReturnDocument.AFTER)
-heartbeat_rec_id = heartbeat_rec["_id"]
+			"Slot": slot
+		}, {
+			"$set": heartbeat_record(slot)
+		}, upsert=True,
+		return_document=ReturnDocument.AFTER)
+	heartbeat_rec_ids.append(heartbeat_rec["_id"])
 
 patch_requests_with_default_timeout(timeout=60)
 
@@ -65,17 +78,84 @@ print(" %d -> Index %s\n -> Interface %s" % (os.getpid(), settings.WORKER_INDEX,
 # We defer including the main body of the application till here so the settings aren't captured before we've set them up.
 # The better way would be to defer initializing services until they're requested, but it's 10:30 and this will work just as well.
 from tapiriik.sync import Sync
-
-Sync.InitializeWorkerBindings()
-
-sync_heartbeat("ready")
-
-worker_message("ready")
-
-Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval)
-
-worker_message("shutting down cleanly")
-db.sync_workers.remove({"_id": heartbeat_rec_id})
-close_connections()
-worker_message("shut down")
-sys.stdout.flush()
+from tapiriik.sync.heartbeat import WorkerHeartbeat
+from tapiriik.messagequeue import mq
+
+def run_worker():
+    global heartbeats
+    heartbeats = [WorkerHeartbeat(x) for x in heartbeat_rec_ids]
+
+    Sync.InitializeWorkerBindings()
+
+    for slot in range(len(heartbeats)):
+        sync_heartbeat("ready", slot=slot)
+
+    worker_message("ready")
+
+    Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval * settings.SYNC_WORKER_CONCURRENCY, concurrency=settings.SYNC_WORKER_CONCURRENCY)
+
+    worker_message("shutting down cleanly")
+    db.sync_workers.remove({"_id": {"$in": heartbeat_rec_ids}})
+    for heartbeat in heartbeats:
+        heartbeat.Clear()
+
+if not settings.SYNC_WORKER_FORK_SERVER:
+    run_worker()
+    close_connections()
+    worker_message("shut down")
+    sys.stdout.flush()
+    sys.exit(0)
+
+# Services are otherwise only loaded once a sync needs them - every child would then be importing (and setting up) the lot all over again.
+from tapiriik.services import Service
+Service.List()
+
+# Everything above is only paid for once - each batch of users gets a fresh child forked from here, so we still get to throw away whatever memory it accumulates.
+# Neither side can share sockets across the fork, so we hang up before forking. The children reconnect (pymongo does so on its own once it's used again).
+child_pid = None
+
+def forward_sigterm(signum, frame):
+    if child_pid:
+        try:
+            os.kill(child_pid, signal.SIGTERM)
+            os.waitpid(child_pid, 0)
+        except OSError:
+            pass
+    db.sync_workers.remove({"_id": {"$in": heartbeat_rec_ids}})
+    close_connections()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, forward_sigterm)
+
+while True:
+    close_connections()
+    mq.release()
+    sys.stdout.flush()
+    child_pid = os.fork()
+    if child_pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            worker_message("forked")
+            if redis is not None:
+                redis.connection_pool.reset()
+            mq.connect()
+            # The watchdog finds us by PID - and may well have removed the records in the meantime.
+            for slot, rec_id in enumerate(heartbeat_rec_ids):
+                db.sync_workers.update({"_id": rec_id}, {"$set": heartbeat_record(slot)}, upsert=True)
+            run_worker()
+            close_connections()
+            worker_message("shut down")
+            exit_code = 0
+        except:
+            traceback.print_exc()
+            exit_code = 1
+        sys.stdout.flush()
+        os._exit(exit_code)
+
+    _, status = os.waitpid(child_pid, 0)
+    worker_message("reaped child %d (status %d)" % (child_pid, status))
+    child_pid = None
+    if status != 0:
+        # Killed by the watchdog, or a sync blew up - neither has anything to do with us, so it's just another child.
+        # (after a moment, in case whatever it was takes the next one down right away too)
+        time.sleep(RespawnDelay)
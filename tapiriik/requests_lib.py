@@ -1,3 +1,30 @@
+import threading
+from datetime import datetime
+
+# Whatever's running in this thread has to be done by then - set by the sync for itself and its pools.
+_request_deadline = threading.local()
+
+def set_request_deadline(deadline):
+	_request_deadline.deadline = deadline
+
+def get_request_deadline():
+	return getattr(_request_deadline, "deadline", None)
+
+def request_timeout(timeout, now=None):
+	# Nothing gets to wait past the deadline, whatever timeout it asked for.
+	deadline = get_request_deadline()
+	if deadline is None:
+		return timeout
+	import requests
+	remaining = (deadline - (now if now else datetime.utcnow())).total_seconds()
+	if remaining <= 0:
+		raise requests.exceptions.Timeout("Out of time for this sync")
+	if timeout is None:
+		return remaining
+	if isinstance(timeout, tuple):
+		return tuple(remaining if x is None else min(x, remaining) for x in timeout)
+	return min(timeout, remaining)
+
 # For whatever reason there's no built-in way to specify a global timeout for requests operations.
 # socket.setdefaulttimeout doesn't work since requests overriddes the default with its own default.
 # There's probably a better way to do this in requests 2.x, but...
@@ -8,6 +35,7 @@ def patch_requests_with_default_timeout(timeout):
 	def new_request(*args, **kwargs):
 		if "timeout" not in kwargs:
 			kwargs["timeout"] = timeout
+		kwargs["timeout"] = request_timeout(kwargs["timeout"])
 		return old_request(*args, **kwargs)
 	requests.Session.request = new_request
 
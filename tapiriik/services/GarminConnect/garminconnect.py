@@ -23,6 +23,7 @@ import json
 import re
 import random
 import tempfile
+import threading
 import json
 from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
@@ -146,27 +147,30 @@ class GarminConnectService(ServiceBase):
         # Ensure the rate lock file exists (...the easy way)
         open(rate_lock_path, "a").close()
         self._rate_lock = open(rate_lock_path, "r+")
+        # flock() doesn't exclude other threads sharing the same file, so they get their own lock
+        self._rate_thread_lock = threading.Lock()
 
     def _rate_limit(self):
         import fcntl, struct, time
         min_period = 1  # I appear to been banned from Garmin Connect while determining this.
-        fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
-        try:
-            self._rate_lock.seek(0)
-            last_req_start = self._rate_lock.read()
-            if not last_req_start:
-                last_req_start = 0
-            else:
-                last_req_start = float(last_req_start)
+        with self._rate_thread_lock:
+            fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
+            try:
+                self._rate_lock.seek(0)
+                last_req_start = self._rate_lock.read()
+                if not last_req_start:
+                    last_req_start = 0
+                else:
+                    last_req_start = float(last_req_start)
 
-            wait_time = max(0, min_period - (time.time() - last_req_start))
-            time.sleep(wait_time)
+                wait_time = max(0, min_period - (time.time() - last_req_start))
+                time.sleep(wait_time)
 
-            self._rate_lock.seek(0)
-            self._rate_lock.write(str(time.time()))
-            self._rate_lock.flush()
-        finally:
-            fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+                self._rate_lock.seek(0)
+                self._rate_lock.write(str(time.time()))
+                self._rate_lock.flush()
+            finally:
+                fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
 
     def _request_with_reauth(self, req_lambda, serviceRecord=None, email=None, password=None, force_skip_cache=False):
         for i in range(self._reauthAttempts + 1):
@@ -3,6 +3,7 @@ from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBas
 from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.stream_sampling import StreamSampler
 from tapiriik.services.auto_pause import AutoPauseCalculator
+from tapiriik.services.health import ServiceHealth
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, WaypointType, Waypoint, Location, Lap
 from tapiriik.database import cachedb, redis
@@ -46,10 +47,9 @@ class RunKeeperService(ServiceBase):
 
     _wayptTypeMappings = {"start": WaypointType.Start, "end": WaypointType.End, "pause": WaypointType.Pause, "resume": WaypointType.Resume}
     _URI_CACHE_KEY = "rk:user_uris"
-    _RATE_LIMIT_KEY = "rk:rate_limit:hit"
 
     def _rate_limit(self, endpoint, req_lambda):
-        if redis.get(self._RATE_LIMIT_KEY) is not None:
+        if ServiceHealth.RateLimitedUntil(self.ID) is not None:
             raise APIException("RK global rate limit previously reached on %s" % endpoint, user_exception=UserException(UserExceptionType.RateLimited))
         response = req_lambda()
         if response.status_code == 429:
@@ -69,7 +69,8 @@ class RunKeeperService(ServiceBase):
                     # This line is too clever for its own good.
                     timeout = timedelta(**{"%ss" % timeout_match.group(2): float(timeout_match.group(1))})
 
-                redis.setex(self._RATE_LIMIT_KEY, response.text, timeout)
+                # This goes in the service health registry, so the scheduler knows to hold back anyone who needs RK till then.
+                ServiceHealth.RecordRateLimit(self.ID, datetime.utcnow() + timeout)
                 raise APIException("RK global rate limit reached on %s" % endpoint, user_exception=UserException(UserExceptionType.RateLimited))
             else:
                 # Per-user limit hit: don't halt entire system, just bail for this user
@@ -0,0 +1,94 @@
+from tapiriik.database import redis
+from tapiriik.settings import SYNC_SERVICE_HEALTH_ERROR_RATE, SYNC_SERVICE_HEALTH_MIN_SAMPLES, SYNC_SERVICE_HEALTH_WINDOW, SYNC_SERVICE_HEALTH_BACKOFF
+from tapiriik.services.api import ServiceException, UserExceptionType
+from datetime import datetime, timedelta
+import math
+
+_EPOCH = datetime(1970, 1, 1)
+
+class ServiceHealth:
+    """
+    Whether each service is usable right now, shared between every worker (and the scheduler) via Redis.
+
+    A service is unavailable while it's rate limited (as reported by the service itself), or while nearly all of its listings are failing.
+    Either way, there's no sense handing out users who can't sync without it - they'd just burn a listing on the way to failing.
+    """
+    _redisKeyPrefix = "service-health"
+
+    # These say something about the user's account, not the service.
+    _userSpecificExceptionTypes = [
+        UserExceptionType.Authorization,
+        UserExceptionType.RenewPassword,
+        UserExceptionType.Locked,
+        UserExceptionType.AccountFull,
+        UserExceptionType.AccountExpired,
+        UserExceptionType.AccountUnpaid,
+        UserExceptionType.NonAthleteAccount,
+        UserExceptionType.GCUploadConsent,
+        UserExceptionType.MissingCredentials,
+        UserExceptionType.NotConfigured,
+        UserExceptionType.Private
+    ]
+
+    def _rateLimitKey(serviceId):
+        return "%s:%s:rate-limited-until" % (ServiceHealth._redisKeyPrefix, serviceId)
+
+    def _outcomeKey(serviceId, outcome, window):
+        return "%s:%s:%s:%d" % (ServiceHealth._redisKeyPrefix, serviceId, outcome, window)
+
+    def _window(now):
+        return int((now - _EPOCH).total_seconds() // SYNC_SERVICE_HEALTH_WINDOW)
+
+    def RecordRateLimit(serviceId, until):
+        if redis is None:
+            return
+        ttl = math.ceil((until - datetime.utcnow()).total_seconds())
+        if ttl > 0:
+            redis.set(ServiceHealth._rateLimitKey(serviceId), (until - _EPOCH).total_seconds(), ex=ttl)
+
+    def RateLimitedUntil(serviceId):
+        raw = redis.get(ServiceHealth._rateLimitKey(serviceId)) if redis is not None else None
+        return _EPOCH + timedelta(seconds=float(raw)) if raw else None
+
+    def RecordOutcome(serviceId, success):
+        if redis is None:
+            return
+        key = ServiceHealth._outcomeKey(serviceId, "successes" if success else "failures", ServiceHealth._window(datetime.utcnow()))
+        pipeline = redis.pipeline()
+        pipeline.incr(key)
+        pipeline.expire(key, SYNC_SERVICE_HEALTH_WINDOW * 2)
+        pipeline.execute()
+
+    def IsServiceFailure(exception):
+        """ Whether an exception raised during listing counts against the service (rather than just this user's account with it) """
+        if not isinstance(exception, ServiceException):
+            return True # Something unexpected - timeouts, 500s, and so on
+        return not exception.UserException or exception.UserException.Type not in ServiceHealth._userSpecificExceptionTypes
+
+    def Unavailable(serviceIds, now=None):
+        """ Returns {service ID: when it's worth trying again} for those that aren't usable right now """
+        serviceIds = list(serviceIds)
+        if redis is None or not serviceIds:
+            return {}
+        now = now if now else datetime.utcnow()
+        window = ServiceHealth._window(now)
+        keys = []
+        for serviceId in serviceIds:
+            keys += [ServiceHealth._rateLimitKey(serviceId)]
+            keys += [ServiceHealth._outcomeKey(serviceId, outcome, window - offset) for outcome in ["successes", "failures"] for offset in [0, 1]]
+        values = redis.mget(keys)
+        unavailable = {}
+        for idx, serviceId in enumerate(serviceIds):
+            rateLimited, successes, successesBefore, failures, failuresBefore = values[idx * 5:idx * 5 + 5]
+            if rateLimited and _EPOCH + timedelta(seconds=float(rateLimited)) > now:
+                unavailable[serviceId] = _EPOCH + timedelta(seconds=float(rateLimited))
+                continue
+            successes = int(successes or 0) + int(successesBefore or 0)
+            failures = int(failures or 0) + int(failuresBefore or 0)
+            if successes + failures >= SYNC_SERVICE_HEALTH_MIN_SAMPLES and failures / (successes + failures) >= SYNC_SERVICE_HEALTH_ERROR_RATE:
+                # No telling when it'll be back - the counts age out eventually, and whoever's let through then finds out.
+                unavailable[serviceId] = now + timedelta(seconds=SYNC_SERVICE_HEALTH_BACKOFF)
+        return unavailable
+
+    def UnavailableUntil(serviceId, now=None):
+        return ServiceHealth.Unavailable([serviceId], now).get(serviceId)
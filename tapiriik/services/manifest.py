@@ -0,0 +1,50 @@
+# Everything we need to know about a service without importing it - which is most of the time.
+# Service.FromID imports and instantiates a service the first time something asks for it.
+# These need to agree with the attributes on the service classes themselves - the tests check.
+
+SERVICE_MANIFEST = [
+    {"ID": "runkeeper", "DisplayName": "Runkeeper", "Module": "tapiriik.services.RunKeeper", "Class": "RunKeeperService"},
+    {"ID": "strava", "DisplayName": "Strava", "Module": "tapiriik.services.Strava", "Class": "StravaService"},
+    {"ID": "garminconnect", "DisplayName": "Garmin Connect", "Module": "tapiriik.services.GarminConnect", "Class": "GarminConnectService", "PollsPartialSyncTrigger": True},
+    {"ID": "endomondo", "DisplayName": "Endomondo", "Module": "tapiriik.services.Endomondo", "Class": "EndomondoService"},
+    {"ID": "sporttracks", "DisplayName": "SportTracks", "Module": "tapiriik.services.SportTracks", "Class": "SportTracksService"},
+    {"ID": "dropbox", "DisplayName": "Dropbox", "Module": "tapiriik.services.Dropbox", "Class": "DropboxService"},
+    {"ID": "trainingpeaks", "DisplayName": "TrainingPeaks", "Module": "tapiriik.services.TrainingPeaks", "Class": "TrainingPeaksService"},
+    {"ID": "rwgps", "DisplayName": "Ride With GPS", "Module": "tapiriik.services.RideWithGPS", "Class": "RideWithGPSService"},
+    {"ID": "trainasone", "DisplayName": "TrainAsONE", "Module": "tapiriik.services.TrainAsONE", "Class": "TrainAsONEService"},
+    {"ID": "pulsstory", "DisplayName": "pulsstory", "Module": "tapiriik.services.Pulsstory", "Class": "PulsstoryService"},
+    {"ID": "motivato", "DisplayName": "Motivato", "Module": "tapiriik.services.Motivato", "Class": "MotivatoService"},
+    {"ID": "nikeplus", "DisplayName": "Nike+", "Module": "tapiriik.services.NikePlus", "Class": "NikePlusService"},
+    {"ID": "velohero", "DisplayName": "Velo Hero", "Module": "tapiriik.services.VeloHero", "Class": "VeloHeroService"},
+    {"ID": "trainerroad", "DisplayName": "TrainerRoad", "Module": "tapiriik.services.TrainerRoad", "Class": "TrainerRoadService"},
+    {"ID": "smashrun", "DisplayName": "Smashrun", "Module": "tapiriik.services.Smashrun", "Class": "SmashrunService"},
+    {"ID": "beginnertriathlete", "DisplayName": "BeginnerTriathlete", "Module": "tapiriik.services.BeginnerTriathlete", "Class": "BeginnerTriathleteService"},
+    {"ID": "setio", "DisplayName": "Setio", "Module": "tapiriik.services.Setio", "Class": "SetioService"},
+    {"ID": "singletracker", "DisplayName": "Singletracker", "Module": "tapiriik.services.Singletracker", "Class": "SingletrackerService"},
+    {"ID": "aerobia", "DisplayName": "Aerobia", "Module": "tapiriik.services.Aerobia", "Class": "AerobiaService"},
+]
+
+# Ideally, we'd make an informed decision based on whatever features the activity had
+# ...but that would require either a) downloading it from evry service or b) storing a lot more activity metadata
+# So, I think this will do for now
+PREFERRED_DOWNLOAD_PRIORITY = [
+    "trainerroad", # Special case, since TR has a lot more data in some very specific areas
+    "garminconnect", # The reference
+    "smashrun",  # TODO: not sure if this is the right place, but it seems to have a lot of data
+    "sporttracks", # Pretty much equivalent to GC, no temperature (not that GC temperature works all thar well now, but I digress)
+    "trainingpeaks", # No seperate run cadence, but has temperature
+    "dropbox", # Equivalent to any of the above
+    "rwgps", # Uses TCX for everything, so same as Dropbox
+    "trainasone",
+    "velohero", # PWX export, no temperature
+    "strava", # No laps
+    "endomondo", # No laps, no cadence
+    "runkeeper", # No laps, no cadence, no power
+    "beginnertriathlete", # No temperature
+    "motivato",
+    "nikeplus",
+    "pulsstory",
+    "setio",
+    "singletracker",
+    "aerobia"
+]
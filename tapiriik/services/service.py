@@ -1,7 +1,10 @@
-from tapiriik.services import *
+from tapiriik.services import PRIVATE_SERVICES
 from .service_record import ServiceRecord
+from .manifest import SERVICE_MANIFEST, PREFERRED_DOWNLOAD_PRIORITY
 from tapiriik.database import db, cachedb
 from bson.objectid import ObjectId
+import importlib
+import threading
 
 # Really don't know why I didn't make most of this part of the ServiceBase.
 class Service:
@@ -14,68 +17,49 @@ class Service:
     }
 
     def Init():
-        Service._serviceMappings = {x.ID: x for x in Service.List()}
-        for svc in Service.List():
-            if svc.IDAliases:
-                Service._serviceMappings.update({x: svc for x in svc.IDAliases})
+        # Only the private services are already loaded - the rest come in through FromID.
+        Service._serviceMappings = {}
+        Service._manifestMappings = {x["ID"]: x for x in SERVICE_MANIFEST}
+        Service._loadLock = threading.Lock()
+        for svc in PRIVATE_SERVICES:
+            Service._register(svc)
+
+    def _register(svc):
+        Service._serviceMappings[svc.ID] = svc
+        if svc.IDAliases:
+            Service._serviceMappings.update({x: svc for x in svc.IDAliases})
+
+    def _load(manifestEntry):
+        with Service._loadLock:
+            # Somebody else may have beaten us to it.
+            if manifestEntry["ID"] not in Service._serviceMappings:
+                svcClass = getattr(importlib.import_module(manifestEntry["Module"]), manifestEntry["Class"])
+                Service._register(svcClass())
+            return Service._serviceMappings[manifestEntry["ID"]]
 
     def FromID(id):
         if id in Service._serviceMappings:
             return Service._serviceMappings[id]
+        if id in Service._manifestMappings:
+            return Service._load(Service._manifestMappings[id])
         raise ValueError
 
-    def List():
+    def Manifest():
+        return SERVICE_MANIFEST
+
+    def List(manifest_filter=None):
+        # This loads every service that passes manifest_filter - which is all of them, by default.
         private_svc_map = {svc.ID: svc for svc in PRIVATE_SERVICES}
         svc_list = (
-            private_svc_map.get("garminconnect2"),
-            RunKeeper,
-            Strava,
-            GarminConnect,
-            Endomondo,
-            SportTracks,
-            Dropbox,
-            TrainingPeaks,
-            RideWithGPS,
-            TrainAsONE,
-            Pulsstory,
-            Motivato,
-            NikePlus,
-            VeloHero,
-            TrainerRoad,
-            Smashrun,
-            BeginnerTriathlete,
-            Setio,
-            Singletracker,
-            Aerobia,
-            private_svc_map.get("runsense")
+            [private_svc_map.get("garminconnect2")] +
+            [Service.FromID(x["ID"]) for x in SERVICE_MANIFEST if manifest_filter is None or manifest_filter(x)] +
+            [private_svc_map.get("runsense")]
         )
         return tuple(x for x in svc_list if x is not None)
 
     def PreferredDownloadPriorityList():
-        # Ideally, we'd make an informed decision based on whatever features the activity had
-        # ...but that would require either a) downloading it from evry service or b) storing a lot more activity metadata
-        # So, I think this will do for now
-        return [
-            TrainerRoad, # Special case, since TR has a lot more data in some very specific areas
-            GarminConnect, # The reference
-            Smashrun,  # TODO: not sure if this is the right place, but it seems to have a lot of data
-            SportTracks, # Pretty much equivalent to GC, no temperature (not that GC temperature works all thar well now, but I digress)
-            TrainingPeaks, # No seperate run cadence, but has temperature
-            Dropbox, # Equivalent to any of the above
-            RideWithGPS, # Uses TCX for everything, so same as Dropbox
-            TrainAsONE,
-            VeloHero, # PWX export, no temperature
-            Strava, # No laps
-            Endomondo, # No laps, no cadence
-            RunKeeper, # No laps, no cadence, no power
-            BeginnerTriathlete, # No temperature
-            Motivato,
-            NikePlus,
-            Pulsstory,
-            Setio,
-            Singletracker,
-            Aerobia
-        ] + PRIVATE_SERVICES
+        # IDs rather than the services themselves, so nothing needs to be loaded to check.
+        return PREFERRED_DOWNLOAD_PRIORITY + [x.ID for x in PRIVATE_SERVICES]
 
     def WebInit():
         from tapiriik.settings import WEB_ROOT
@@ -98,7 +82,7 @@ class Service:
         # Should really figure out how to mangle pymongo into doing the serialization for me...
         extendedAuthDetailsForStorage = CredentialStore.FlattenShadowedCredentials(extendedAuthDetails) if extendedAuthDetails else None
         if serviceRecord is None:
-            db.connections.insert({"ExternalID": uid, "Service": service.ID, "SynchronizedActivities": [], "Authorization": authDetails, "ExtendedAuthorization": extendedAuthDetailsForStorage if persistExtendedAuthDetails else None})
+            db.connections.insert({"ExternalID": uid, "Service": service.ID, "Authorization": authDetails, "ExtendedAuthorization": extendedAuthDetailsForStorage if persistExtendedAuthDetails else None})
             serviceRecord = ServiceRecord(db.connections.find_one({"ExternalID": uid, "Service": service.ID}))
             serviceRecord.ExtendedAuthorization = extendedAuthDetails # So SubscribeToPartialSyncTrigger can use it (we don't save the whole record after this point)
             if service.PartialSyncTriggerRequiresPolling:
@@ -136,5 +120,7 @@ class Service:
         svc.RevokeAuthorization(serviceRecord)
         cachedb.extendedAuthDetails.remove({"ID": serviceRecord._id})
         db.connections.remove({"_id": serviceRecord._id})
+        from tapiriik.sync.synchronized_activities import SynchronizedActivities
+        SynchronizedActivities.Clear([serviceRecord._id])
 
 Service.Init()
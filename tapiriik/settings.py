@@ -263,6 +263,156 @@ EMAIL_FILE_PATH = './sent_emails'
 
 WORKER_INDEX = int(os.environ.get("TAPIRIIK_WORKER_INDEX", 0))
 
+# sync_scheduler queues at most this many users per Mongo update
+SYNC_SCHEDULER_BATCH_SIZE = 500
+
+# ...and re-reads every pending NextSynchronization into the schedule this often (seconds), in case anything was missed
+SYNC_SCHEDULER_REBUILD_INTERVAL = 5 * 60
+
+# How long (seconds) sync_scheduler waits on RabbitMQ to confirm each batch it publishes - whoever isn't confirmed by then is put back in the schedule
+SYNC_SCHEDULER_CONFIRM_TIMEOUT = 30
+
+# Relative share of the sync workers each queue lane gets when they're all busy (see tapiriik.sync.lanes)
+SYNC_LANE_WEIGHTS = {"interactive": 8, "triggered": 4, "scheduled": 2, "exhaustive": 1}
+
+# How long (seconds) an idle sync worker waits before checking the queues again
+SYNC_QUEUE_POLL_INTERVAL = 1
+
+# Estimating how long each user's sync will take (see tapiriik.sync.cost), in seconds
+# How much each sync counts towards the running average
+SYNC_COST_DECAY = 0.3
+# Guesses for users we've never timed
+SYNC_COST_DEFAULT_PER_CONNECTION = 20
+SYNC_COST_PER_ACTIVITY = 0.5
+SYNC_COST_EXHAUSTIVE_FACTOR = 10
+# Users whose syncs take longer than this go in the exhaustive lane, and only so many are queued per minute
+SYNC_COST_EXPENSIVE_THRESHOLD = 10 * 60
+SYNC_SCHEDULER_EXPENSIVE_PER_MINUTE = 20
+
+# sync_scheduler puts off (non-interactive) exhaustive syncs while there are more than this many users queued, or the queue wait's longer than this (seconds)
+SYNC_BACKPRESSURE_QUEUE_LENGTH = 500
+SYNC_BACKPRESSURE_WAIT = 15 * 60
+# (checking every so often)
+SYNC_BACKPRESSURE_CHECK_INTERVAL = 30
+# They're put off till the off-peak hours (UTC, start < end), or if it's off-peak already, for this long (seconds)
+SYNC_OFF_PEAK_HOURS = (3, 7)
+SYNC_BACKPRESSURE_RECHECK_INTERVAL = 15 * 60
+# ...but never for longer than this (seconds) all told
+SYNC_EXHAUSTIVE_MAX_DEFERRAL = 2 * 24 * 60 * 60
+
+# How long (seconds) between scheduled syncs - the more recently a user's been active, the closer to the floor (see tapiriik.sync.cadence)
+SYNC_INTERVAL_FLOOR = 60 * 60
+SYNC_INTERVAL_CEILING = 24 * 60 * 60
+# The interval is this fraction of however long they've been quiet
+SYNC_INTERVAL_STRETCH = 0.05
+# How many of their most recent activities to go by
+SYNC_CADENCE_SAMPLE_SIZE = 20
+
+# Number of users each sync worker process synchronizes at once
+SYNC_WORKER_CONCURRENCY = 1
+
+# Have sync_worker.py load everything once, then fork a fresh child for each batch of users - rather than paying for all the imports/startup each time it recycles
+SYNC_WORKER_FORK_SERVER = False
+
+# Number of activity listings retrieved at once within a single user's synchronization
+SYNC_LISTING_CONCURRENCY = 4
+
+# ...and number of destinations a single activity is uploaded to at once
+SYNC_UPLOAD_CONCURRENCY = 4
+
+# ...and number of upcoming activities downloaded ahead of time while the current one is uploaded (0 to disable)
+SYNC_DOWNLOAD_LOOKAHEAD = 2
+
+# Writes made during a sync are buffered, and written in bulk once this many are queued or this many seconds after the first one was...
+SYNC_WRITE_BUFFER_SIZE = 500
+SYNC_WRITE_BUFFER_INTERVAL = 5
+
+# ...with these write concerns (by collection name, anything else gets the connection's default)
+SYNC_WRITE_CONCERNS = {"sync_stats": 0, "uploaded_activities": 0}
+
+# Sync worker heartbeats and user sync progress go to Redis at most this often (seconds)...
+SYNC_HEARTBEAT_INTERVAL = 5
+
+# ...and to Mongo this often, unless the worker/sync moves on to something else entirely
+SYNC_HEARTBEAT_PERSIST_INTERVAL = 120
+
+# ...and expire from Redis after this long
+SYNC_HEARTBEAT_TTL = 30 * 60
+
+# Route each user to the same host every time (by consistent hashing over the live hosts), so per-host caches/locks are warm - SynchronizationHostRestriction still takes precedence
+SYNC_HOST_AFFINITY = False
+
+# ...so long as that host has fewer than this many users waiting per worker, otherwise they go to the global queue
+SYNC_AFFINITY_QUEUE_PER_WORKER = 2
+
+# ...where a host is live if its watchdog has checked in this recently (seconds) and it has workers
+SYNC_AFFINITY_HOST_TIMEOUT = 5 * 60
+
+# ...and the live hosts (and how backed up they are) are rechecked this often (seconds)
+SYNC_AFFINITY_REFRESH_INTERVAL = 30
+
+# Points each host gets on the hash ring - more spreads users more evenly
+SYNC_AFFINITY_VNODES = 64
+
+# A service is treated as down once at least this share of its listings fail (over at least this many, in the last two windows of this many seconds)...
+SYNC_SERVICE_HEALTH_ERROR_RATE = 0.9
+SYNC_SERVICE_HEALTH_MIN_SAMPLES = 20
+SYNC_SERVICE_HEALTH_WINDOW = 300
+
+# ...and users who can't sync without it are held back this long before anyone tries again (seconds)
+SYNC_SERVICE_HEALTH_BACKOFF = 300
+
+# ...then let back in spread over this long, so they don't all land on the service the moment it recovers (seconds)
+SYNC_SERVICE_HEALTH_RELEASE_SPREAD = 300
+
+# A worker's lease on the user it's synchronizing lasts this long (seconds), and is renewed this often while the sync is making progress...
+SYNC_LEASE_DURATION = 2 * 60
+SYNC_LEASE_RENEW_INTERVAL = 30
+
+# ...which it isn't if it's been this long since the last heartbeat - listing can take a loooooooong time, everything else shouldn't (seconds)
+SYNC_LEASE_STALL_TIMEOUT = 10 * 60
+SYNC_LEASE_LIST_STALL_TIMEOUT = 45 * 60
+
+# A sync that dies part-way through picks up from its last checkpoint, so long as it was listed this recently (seconds)...
+SYNC_CHECKPOINT_VALIDITY = 3 * 60 * 60
+
+# ...with its progress through the activities checkpointed this often (seconds)
+SYNC_CHECKPOINT_INTERVAL = 60
+
+# A newly connected service is brought up to speed a slice at a time - each going at most this many activities or this long (seconds) past where the last one stopped...
+SYNC_BACKFILL_SLICE_ACTIVITIES = 100
+SYNC_BACKFILL_SLICE_DURATION = 15 * 60
+
+# ...with this long between slices (seconds) - the regular syncs carry on as usual in the meantime
+SYNC_BACKFILL_INTERVAL = 10 * 60
+
+# A sync gets this long all told (seconds) - well inside the lease stall timeouts, so it winds itself up rather than being left to lapse...
+SYNC_DEADLINE = 30 * 60
+
+# ...stopping on new activities once it's down to this much (seconds), to leave time for whatever's in flight and for writing back...
+SYNC_DEADLINE_RESERVE = 3 * 60
+
+# ...and picking up where it left off this long after (seconds)
+SYNC_DEADLINE_RESCHEDULE = 5 * 60
+
+# Each listing gets at least this long (seconds) however little of the deadline's left, since it can't be split up - still inside SYNC_LEASE_LIST_STALL_TIMEOUT.
+# Whatever was listed in time is checkpointed, so the next go doesn't start over.
+SYNC_DEADLINE_LISTING = 40 * 60
+
+# Syncs for users with at least this many activities are split up between workers - the listings, then the downloads/uploads a batch at a time (None to never do so)...
+SYNC_FANOUT_MIN_ACTIVITIES = None
+
+# ...this many activities to a batch, with at most this many batches out at once...
+SYNC_FANOUT_BATCH_SIZE = 25
+SYNC_FANOUT_CONCURRENCY = 4
+
+# ...and if nobody's picked one up within this long (seconds), the sync that handed it out does it itself
+SYNC_FANOUT_PICKUP_TIMEOUT = 60
+
+# How often the handing-out sync checks on the pieces (seconds), and how long they're kept around (seconds)
+SYNC_FANOUT_POLL_INTERVAL = 1
+SYNC_FANOUT_RETENTION = 2 * 60 * 60
+
 # Used for distributing outgoing calls across multiple interfaces
 
 HTTP_SOURCE_ADDR = "0.0.0.0"
@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+# All of these are in microseconds, so the comparisons are exactly those of the timedeltas they replace.
+_START_LEEWAY = _microseconds(timedelta(minutes=3))
+_TZ_OFFSET_LEEWAY = _microseconds(timedelta(minutes=1))
+_TZ_ERROR_PERIOD = _microseconds(timedelta(hours=38))
+_HALF_HOUR = _microseconds(timedelta(minutes=30))
+_MINUTE = _microseconds(timedelta(minutes=1))
+
+class _ActivityIndexEntry:
+    def __init__(self, activity, seq):
+        self.Activity = activity
+        self.Seq = seq
+        self.UID = activity.UID # What it's filed under - the activity's own may have moved on by the time it's removed
+        startTime = activity.StartTime
+        naiveStartTime = startTime.replace(tzinfo=None)
+        self.TZInfo = startTime.tzinfo
+        self.Aware = startTime.tzinfo is not None
+        self.NaiveStart = _microseconds(naiveStartTime - _EPOCH)
+        self.UTCStart = self.NaiveStart - _microseconds(startTime.utcoffset()) if self.Aware else None
+        # What's left after replace(hour=0) - the date, and the position within the hour.
+        self.Date = naiveStartTime.toordinal()
+        self.WithinHour = _microseconds(timedelta(minutes=naiveStartTime.minute, seconds=naiveStartTime.second, microseconds=naiveStartTime.microsecond))
+
+    def StartBucket(self):
+        return self.NaiveStart // _START_LEEWAY
+
+    def UTCStartBucket(self):
+        return self.UTCStart // _START_LEEWAY
+
+    def MinuteBucket(self):
+        return (self.Date, self.WithinHour // _MINUTE)
+
+class ActivityIndex:
+    """
+    The activities accumulated during a sync, indexed for duplicate detection.
+
+    Iterates in the order the bisect-maintained list did - most recent (naive) StartTime first, and most recently added first among equals.
+    """
+    def __init__(self, activities=None):
+        self._entries = {}
+        self._seq = 0
+        self._ordered = None
+        self._byUID = defaultdict(set)
+        self._byStart = defaultdict(set)
+        self._byUTCStart = defaultdict(set)
+        self._byMinute = defaultdict(set)
+        if activities:
+            # The list is already in iteration order, so the first item has to look like the most recently added.
+            for activity in reversed(activities):
+                self.Add(activity)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._orderedActivities())
+
+    def __getitem__(self, idx):
+        return self._orderedActivities()[idx]
+
+    def _orderedActivities(self):
+        if self._ordered is None:
+            self._ordered = [x.Activity for x in sorted(self._entries.values(), key=lambda x: (x.NaiveStart, x.Seq), reverse=True)]
+        return self._ordered
+
+    def _insert(self, entry):
+        self._entries[id(entry.Activity)] = entry
+        self._byUID[entry.UID].add(entry)
+        self._byStart[entry.StartBucket()].add(entry)
+        if entry.Aware:
+            self._byUTCStart[entry.UTCStartBucket()].add(entry)
+        self._byMinute[entry.MinuteBucket()].add(entry)
+        self._ordered = None
+
+    def _remove(self, entry):
+        del self._entries[id(entry.Activity)]
+        self._byUID[entry.UID].discard(entry)
+        self._byStart[entry.StartBucket()].discard(entry)
+        if entry.Aware:
+            self._byUTCStart[entry.UTCStartBucket()].discard(entry)
+        self._byMinute[entry.MinuteBucket()].discard(entry)
+        self._ordered = None
+
+    def Add(self, activity):
+        self._seq += 1
+        self._insert(_ActivityIndexEntry(activity, self._seq))
+
+    def Update(self, activity):
+        # Must be called when an indexed activity's StartTime or UID changes.
+        entry = self._entries[id(activity)]
+        self._remove(entry)
+        self._insert(_ActivityIndexEntry(activity, entry.Seq))
+
+    def _candidates(self, query):
+        candidates = set(self._byUID.get(query.Activity.UID, ()))
+        startBucket = query.StartBucket()
+        for bucket in range(startBucket - 1, startBucket + 2):
+            candidates.update(self._byStart.get(bucket, ()))
+        if query.Aware:
+            utcStartBucket = query.UTCStartBucket()
+            for bucket in range(utcStartBucket - 1, utcStartBucket + 2):
+                candidates.update(self._byUTCStart.get(bucket, ()))
+        date, minute = query.MinuteBucket()
+        for centre in (minute - 30, minute, minute + 30):
+            for bucketMinute in range(centre - 1, centre + 2):
+                candidates.update(self._byMinute.get((date, bucketMinute), ()))
+        return candidates
+
+    def _matches(self, entry, query):
+        if abs(entry.NaiveStart - query.NaiveStart) > _TZ_ERROR_PERIOD:
+            return False # Outside the window the bisection would have considered.
+        if entry.Activity.UID == query.Activity.UID:
+            return True
+        # Reasonably close together to be considered duplicate - compared as actual instants if both are TZ-aware, otherwise as if they were in the same TZ.
+        if entry.Aware and query.Aware:
+            # (datetime subtraction ignores the offsets if both share the same tzinfo)
+            if entry.TZInfo is query.TZInfo:
+                startDifference = abs(entry.NaiveStart - query.NaiveStart)
+            else:
+                startDifference = abs(entry.UTCStart - query.UTCStart)
+            if startDifference < _START_LEEWAY:
+                return True
+        elif abs(entry.NaiveStart - query.NaiveStart) < _START_LEEWAY:
+            return True
+        # Same mm:ss but a different hh (TZ issues) - or half-hour time zones.
+        # These compared the times with replace(hour=0), which can only come within an hour when they're on the same date.
+        if entry.Date == query.Date:
+            withinHourDifference = abs(entry.WithinHour - query.WithinHour)
+            if withinHourDifference < _TZ_OFFSET_LEEWAY:
+                return True
+            if _HALF_HOUR - (_TZ_OFFSET_LEEWAY / 2) < withinHourDifference < _HALF_HOUR + (_TZ_OFFSET_LEEWAY / 2):
+                return True
+        return False
+
+    def FindDuplicates(self, activity):
+        """ Returns activities that may be duplicates of the one provided, in iteration order - before the activity type is considered """
+        query = _ActivityIndexEntry(activity, None)
+        matches = [x for x in self._candidates(query) if self._matches(x, query)]
+        matches.sort(key=lambda x: (x.NaiveStart, x.Seq), reverse=True)
+        return [x.Activity for x in matches]
@@ -1,8 +1,12 @@
 from datetime import datetime
+from tapiriik.database import db
 from tapiriik.services.interchange import ActivityStatisticUnit
 from tapiriik.services.api import UserException
+import pymongo
 
 class ActivityRecord:
+    _indexEnsured = False
+
     def __init__(self, dbRec=None):
         self.StartTime = None
         self.EndTime = None
@@ -27,6 +31,26 @@ class ActivityRecord:
     def __deepcopy__(self, x):
         return ActivityRecord(self.__dict__)
 
+    def _collection():
+        if not ActivityRecord._indexEnsured:
+            db.activity_records.ensure_index([("UserID", pymongo.ASCENDING), ("StartTime", pymongo.DESCENDING)])
+            ActivityRecord._indexEnsured = True
+        return db.activity_records
+
+    def LoadRaw(userId, fields=None):
+        """ Returns the user's activity records as stored, most recent first - records still in the old single-document layout don't have an _id """
+        # Records used to be stored in an "Activities" array on a single document per user.
+        # If that document is still around, it's the authoritative copy - anything else is from an upgrade that never finished.
+        projection = None
+        if fields:
+            projection = dict([(x, 1) for x in fields] + [("Activities." + x, 1) for x in fields])
+        records = []
+        for doc in ActivityRecord._collection().find({"UserID": userId}, projection).sort("StartTime", pymongo.DESCENDING):
+            if "Activities" in doc:
+                return doc["Activities"]
+            records.append(doc)
+        return records
+
     def FromActivity(activity):
         record = ActivityRecord()
         record.SetActivity(activity)
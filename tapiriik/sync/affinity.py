@@ -0,0 +1,90 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_AFFINITY_QUEUE_PER_WORKER, SYNC_AFFINITY_HOST_TIMEOUT, SYNC_AFFINITY_REFRESH_INTERVAL, SYNC_AFFINITY_VNODES
+from .lanes import SyncLane
+from collections import Counter
+from datetime import datetime, timedelta
+import bisect
+import hashlib
+import kombu
+
+class HostRing:
+    """
+    Consistent hashing of users onto hosts - when a host comes or goes, only the users that were (or will be) on it move.
+
+    Uses md5 rather than hash() since the latter differs between processes.
+    """
+    def __init__(self, hosts, vnodes=SYNC_AFFINITY_VNODES):
+        self.Hosts = sorted(hosts)
+        points = sorted((HostRing._hash("%s:%d" % (host, idx)), host) for host in self.Hosts for idx in range(vnodes))
+        self._keys = [x[0] for x in points]
+        self._hosts = [x[1] for x in points]
+
+    def _hash(value):
+        return int(hashlib.md5(value.encode("UTF-8")).hexdigest()[:16], 16)
+
+    def Host(self, key):
+        if not self._keys:
+            return None
+        idx = bisect.bisect(self._keys, HostRing._hash(str(key))) % len(self._keys)
+        return self._hosts[idx]
+
+class SyncAffinity:
+    """
+    Picks the host a user should be synchronized on - the same one each time, so Garmin Connect sessions, the gc_rate lock, etc. stay warm there.
+
+    If that host's queues are backed up (or there aren't any live hosts) the user goes to the global queue instead, same as they would without affinity.
+    Whoever's still waiting on a host when it drops out is moved over to the global queues - so long as it was us that sent them there.
+    """
+    def __init__(self, channel, producer):
+        self._channel = channel
+        self._producer = producer
+        self._refreshedAt = None
+        self._live = set()
+        self._ring = HostRing([])
+        self._capacity = {}
+        self._load = {}
+
+    def _refresh(self):
+        self._refreshedAt = datetime.utcnow()
+        live = set(x["Host"] for x in db.sync_watchdogs.find({"Timestamp": {"$gte": datetime.utcnow() - timedelta(seconds=SYNC_AFFINITY_HOST_TIMEOUT)}}, {"Host": True}))
+        for host in self._live - live:
+            self._evacuate(host)
+        self._live = live
+        workers = Counter(x["Host"] for x in db.sync_workers.find({"Host": {"$in": list(live)}}, {"Host": True}))
+        self._ring = HostRing([host for host in live if workers[host]])
+        self._capacity = dict((host, workers[host] * SYNC_AFFINITY_QUEUE_PER_WORKER) for host in self._ring.Hosts)
+        # Not passive - a passive declare of a queue that isn't there takes the channel down with it, and these are declared the same way the workers do.
+        self._load = dict((host, sum(kombu.Queue(SyncLane.QueueName(lane, host))(self._channel).queue_declare().message_count for lane in SyncLane.All)) for host in self._ring.Hosts)
+
+    def _evacuate(self, host):
+        moved = 0
+        for lane in SyncLane.All:
+            queue = kombu.Queue(SyncLane.QueueName(lane, host))(self._channel)
+            pinned = []
+            while True:
+                message = queue.get(no_ack=False)
+                if message is None:
+                    break
+                if not message.payload.get("affinity"):
+                    # Sent there by SynchronizationHostRestriction - they wait for the host to come back.
+                    # (held unacked till we're done, so get() doesn't keep handing them back)
+                    pinned.append(message)
+                    continue
+                self._producer.publish(message.payload, routing_key=SyncLane.RoutingKey(lane))
+                message.ack()
+                moved += 1
+            for message in pinned:
+                message.requeue()
+        if moved:
+            print("Moved %d users waiting on %s to the global queues" % (moved, host))
+
+    def HostFor(self, userId):
+        """ Returns the host to route this user to, or None for the global queue """
+        if self._refreshedAt is None or datetime.utcnow() - self._refreshedAt > timedelta(seconds=SYNC_AFFINITY_REFRESH_INTERVAL):
+            self._refresh()
+        host = self._ring.Host(userId)
+        if host is None or self._load[host] >= self._capacity[host]:
+            return None
+        # Counted till the next refresh, so one batch can't swamp the host.
+        self._load[host] += 1
+        return host
@@ -0,0 +1,46 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_BACKPRESSURE_QUEUE_LENGTH, SYNC_BACKPRESSURE_WAIT, SYNC_BACKPRESSURE_CHECK_INTERVAL, SYNC_BACKPRESSURE_RECHECK_INTERVAL, SYNC_OFF_PEAK_HOURS, SYNC_EXHAUSTIVE_MAX_DEFERRAL
+from datetime import datetime, timedelta
+import random
+
+class SyncBackpressure:
+    """
+    Whether the sync workers are keeping up - and when they aren't, when to put exhaustive syncs off till.
+
+    Deferred users get an ExhaustiveDeferredSince, so nobody gets put off for more than SYNC_EXHAUSTIVE_MAX_DEFERRAL.
+    """
+    def __init__(self, queues):
+        self._queues = queues
+        self._checkedAt = None
+        self._saturated = False
+        self.QueueLength = None
+        self.QueueWait = None
+
+    def Saturated(self):
+        if self._checkedAt is None or datetime.utcnow() - self._checkedAt > timedelta(seconds=SYNC_BACKPRESSURE_CHECK_INTERVAL):
+            self._checkedAt = datetime.utcnow()
+            # How many are waiting right now, and how long the wait's been lately (as far as stats_cron knows).
+            self.QueueLength = sum(queue.queue_declare(passive=True).message_count for queue in self._queues)
+            stats = db.stats.find_one({}, {"QueueHeadTime": True})
+            self.QueueWait = stats.get("QueueHeadTime") if stats else None
+            self._saturated = self.QueueLength > SYNC_BACKPRESSURE_QUEUE_LENGTH or (self.QueueWait is not None and self.QueueWait > SYNC_BACKPRESSURE_WAIT)
+        return self._saturated
+
+    def NextOffPeak(now):
+        start, end = SYNC_OFF_PEAK_HOURS
+        if start <= now.hour < end:
+            # It's already as quiet as it gets.
+            return now + timedelta(seconds=SYNC_BACKPRESSURE_RECHECK_INTERVAL)
+        windowStart = now.replace(hour=start, minute=0, second=0, microsecond=0)
+        if windowStart < now:
+            windowStart += timedelta(days=1)
+        # Spread them through the window, rather than having them all turn up at once.
+        return windowStart + timedelta(seconds=random.randint(0, (end - start) * 60 * 60 - 1))
+
+    def DeferUntil(user, now):
+        """ Where to put off this user's exhaustive sync till - or None, if they've waited long enough already """
+        deferredSince = user.get("ExhaustiveDeferredSince") or user["NextSynchronization"]
+        deadline = deferredSince + timedelta(seconds=SYNC_EXHAUSTIVE_MAX_DEFERRAL)
+        if now >= deadline:
+            return None
+        return min(SyncBackpressure.NextOffPeak(now), deadline)
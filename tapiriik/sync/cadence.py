@@ -0,0 +1,42 @@
+from tapiriik.settings import SYNC_INTERVAL_FLOOR, SYNC_INTERVAL_CEILING, SYNC_INTERVAL_STRETCH, SYNC_CADENCE_SAMPLE_SIZE
+from datetime import datetime, timedelta
+import pytz
+
+class SyncCadence:
+    """
+    How often a user records activities, going by their activity records - kept on the user record as ActivityCadence.
+
+    Most syncs find nothing new, so there's no sense checking every hour on someone who hasn't uploaded anything in months.
+    Triggers and manual syncs still bring them forward, of course.
+    """
+
+    def FromActivityRecords(records, now=None):
+        now = now if now else datetime.utcnow()
+        starts = []
+        for record in records:
+            if not record.StartTime:
+                continue
+            start = record.StartTime
+            if start.tzinfo:
+                start = start.astimezone(pytz.utc).replace(tzinfo=None)
+            if start <= now: # Somebody's clock is always off.
+                starts.append(start)
+        if not starts:
+            return None
+        starts = sorted(starts, reverse=True)[:SYNC_CADENCE_SAMPLE_SIZE]
+        gaps = sorted((later - earlier).total_seconds() for later, earlier in zip(starts, starts[1:]))
+        typicalGap = None
+        if gaps:
+            # The median - no statistics module till 3.4.
+            middle = len(gaps) // 2
+            typicalGap = gaps[middle] if len(gaps) % 2 else (gaps[middle - 1] + gaps[middle]) / 2
+        return {"LastActivity": starts[0], "TypicalGap": typicalGap}
+
+    def Interval(cadence, now=None):
+        """ How long to wait before the next scheduled sync """
+        if not cadence:
+            return timedelta(seconds=SYNC_INTERVAL_FLOOR)
+        now = now if now else datetime.utcnow()
+        # However long they've been quiet, or usually are between activities - whichever's longer.
+        quiet = max((now - cadence["LastActivity"]).total_seconds(), cadence.get("TypicalGap") or 0)
+        return timedelta(seconds=min(max(quiet * SYNC_INTERVAL_STRETCH, SYNC_INTERVAL_FLOOR), SYNC_INTERVAL_CEILING))
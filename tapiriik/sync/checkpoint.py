@@ -0,0 +1,68 @@
+from tapiriik.database import redis
+from tapiriik.settings import SYNC_CHECKPOINT_VALIDITY
+from datetime import datetime, timedelta
+import logging
+import pickle
+
+logger = logging.getLogger(__name__)
+
+class SyncCheckpoint:
+    """
+    What a sync had got done before it died - so the next go doesn't have to start from scratch (and likely die the same way).
+
+    There are two parts: the listing, saved as each connection is listed, and the progress through the activities after that, saved every so often.
+    A checkpoint is only any good to a sync of the same kind, over the same connections, within SYNC_CHECKPOINT_VALIDITY of the listing.
+    """
+    _version = 1
+    _parts = ["listing", "progress"]
+
+    def _redisKey(userId, part):
+        return "sync-checkpoint:%s:%s" % (userId, part)
+
+    def _connections(connectionIds):
+        return sorted(str(x) for x in connectionIds)
+
+    def Save(userId, part, state):
+        if redis is None:
+            return False
+        try:
+            raw = pickle.dumps(dict(state, Version=SyncCheckpoint._version))
+        except Exception:
+            # Some service left something unpicklable in its activities - no checkpoints for this sync, then.
+            logger.exception("Could not checkpoint %s" % part)
+            return False
+        redis.set(SyncCheckpoint._redisKey(userId, part), raw, ex=SYNC_CHECKPOINT_VALIDITY)
+        return True
+
+    def SaveListing(userId, connectionIds, exhaustive, listedAt, state):
+        return SyncCheckpoint.Save(userId, "listing", dict(state, Connections=SyncCheckpoint._connections(connectionIds), Exhaustive=exhaustive, ListedAt=listedAt))
+
+    def SaveProgress(userId, listedAt, state):
+        return SyncCheckpoint.Save(userId, "progress", dict(state, ListedAt=listedAt))
+
+    def Load(userId, connectionIds, exhaustive, now=None):
+        """ Returns (listing, progress) to resume from - or None, if there's nothing usable. Progress may be None. """
+        if redis is None:
+            return None
+        listing, progress = redis.mget([SyncCheckpoint._redisKey(userId, part) for part in SyncCheckpoint._parts])
+        if not listing:
+            return None
+        now = now if now else datetime.utcnow()
+        try:
+            listing = pickle.loads(listing)
+            progress = pickle.loads(progress) if progress else None
+        except Exception:
+            logger.exception("Could not load checkpoint")
+            SyncCheckpoint.Clear(userId)
+            return None
+        if listing.get("Version") != SyncCheckpoint._version or listing["Exhaustive"] != exhaustive or listing["Connections"] != SyncCheckpoint._connections(connectionIds) or now - listing["ListedAt"] > timedelta(seconds=SYNC_CHECKPOINT_VALIDITY):
+            logger.info("Discarding checkpoint from %s" % listing.get("ListedAt"))
+            SyncCheckpoint.Clear(userId)
+            return None
+        if progress and (progress.get("Version") != SyncCheckpoint._version or progress["ListedAt"] != listing["ListedAt"]):
+            progress = None # Left over from some other listing
+        return listing, progress
+
+    def Clear(userId):
+        if redis is not None:
+            redis.delete(*[SyncCheckpoint._redisKey(userId, part) for part in SyncCheckpoint._parts])
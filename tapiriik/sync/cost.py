@@ -0,0 +1,41 @@
+from tapiriik.settings import SYNC_COST_DECAY, SYNC_COST_DEFAULT_PER_CONNECTION, SYNC_COST_PER_ACTIVITY, SYNC_COST_EXHAUSTIVE_FACTOR, SYNC_COST_EXPENSIVE_THRESHOLD
+from datetime import datetime
+
+class SyncCost:
+    """
+    A rough guess at how long (in seconds) a user's next sync will take - an exponentially decayed average of how long their previous ones did, kept on the user record as SyncCost.
+
+    Partial and exhaustive syncs are tracked separately, since they're nothing alike.
+    """
+
+    def _key(exhaustive):
+        return "Exhaustive" if exhaustive else "Partial"
+
+    def Estimate(user, exhaustive=False):
+        cost = user.get("SyncCost") or {}
+        if cost.get(SyncCost._key(exhaustive)) is not None:
+            return cost[SyncCost._key(exhaustive)]
+        # Never timed one of these - so guess from what we do know.
+        if exhaustive and cost.get("ActivityCount") is not None:
+            # Exhaustive syncs go through everything, so it's mostly down to how much there is.
+            return cost["ActivityCount"] * SYNC_COST_PER_ACTIVITY + cost.get("Partial", 0)
+        if exhaustive and cost.get("Partial") is not None:
+            return cost["Partial"] * SYNC_COST_EXHAUSTIVE_FACTOR
+        estimate = SYNC_COST_DEFAULT_PER_CONNECTION * max(len(user.get("ConnectedServices", [])) - 1, 1)
+        return estimate * SYNC_COST_EXHAUSTIVE_FACTOR if exhaustive else estimate
+
+    def IsExpensive(user, exhaustive=False):
+        return SyncCost.Estimate(user, exhaustive) > SYNC_COST_EXPENSIVE_THRESHOLD
+
+    def Update(user, duration, exhaustive, activityCount=None):
+        """ Returns the $set to record a sync that took duration seconds """
+        previous = (user.get("SyncCost") or {}).get(SyncCost._key(exhaustive))
+        estimate = duration if previous is None else SYNC_COST_DECAY * duration + (1 - SYNC_COST_DECAY) * previous
+        update = {
+            "SyncCost.%s" % SyncCost._key(exhaustive): estimate,
+            "SyncCost.Connections": len(user.get("ConnectedServices", [])),
+            "SyncCost.Updated": datetime.utcnow()
+        }
+        if activityCount is not None:
+            update["SyncCost.ActivityCount"] = activityCount
+        return update
@@ -0,0 +1,173 @@
+from tapiriik.database import redis
+from tapiriik.messagequeue import mq
+from tapiriik.settings import SYNC_FANOUT_MIN_ACTIVITIES, SYNC_FANOUT_PICKUP_TIMEOUT, SYNC_FANOUT_POLL_INTERVAL, SYNC_FANOUT_RETENTION, SYNC_LEASE_STALL_TIMEOUT, SYNC_LEASE_LIST_STALL_TIMEOUT
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import kombu
+import logging
+import pickle
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+class SyncSubtask:
+    """
+    One piece of a fanned-out sync - its input and result are pickled into Redis, and whoever claims it first gets to run it.
+    """
+    List = "list" # One connection's activity listing
+    Batch = "batch" # Downloading and uploading a run of activities
+
+    QueueName = "tapiriik-sync-subtasks"
+    RoutingKey = "sync-subtask"
+
+    def __init__(self, fanOutId, index, kind):
+        self.FanOutID = fanOutId
+        self.Index = index
+        self.Kind = kind
+        self.DispatchedAt = None
+        self.Payload = None # Only if it couldn't be handed out at all
+
+    def FromMessage(body):
+        return SyncSubtask(body["fanout_id"], body["subtask"], body["kind"])
+
+    def Message(self, userId):
+        return {"user_id": str(userId), "fanout_id": self.FanOutID, "subtask": self.Index, "kind": self.Kind}
+
+    def _redisKey(self, part):
+        return "sync-fanout:%s:%d:%s" % (self.FanOutID, self.Index, part)
+
+    def _claimTimeout(self):
+        # Listings are one long call, so they get as long as they would in a regular sync - batches renew theirs as they go.
+        return SYNC_LEASE_LIST_STALL_TIMEOUT if self.Kind == SyncSubtask.List else SYNC_LEASE_STALL_TIMEOUT
+
+    def Claim(self, token):
+        return bool(redis.set(self._redisKey("claim"), token, nx=True, ex=self._claimTimeout()))
+
+    def Renew(self, token):
+        """ Returns False if the claim has lapsed in the meantime (in which case someone else may well have it by now) """
+        key = self._redisKey("claim")
+        claimant = redis.get(key)
+        if claimant is None or claimant.decode("UTF-8") != token:
+            return False
+        redis.expire(key, self._claimTimeout())
+        return True
+
+    def IsClaimed(self):
+        return bool(redis.exists(self._redisKey("claim")))
+
+    def Input(self):
+        raw = redis.get(self._redisKey("input"))
+        return pickle.loads(raw) if raw is not None else None
+
+    def Outcome(self):
+        raw = redis.get(self._redisKey("result"))
+        return pickle.loads(raw) if raw is not None else None
+
+    def IsDone(self):
+        return bool(redis.exists(self._redisKey("result")))
+
+class SyncFanOut:
+    """
+    Splits a very large user's sync between workers - each connection's listing, then the downloading and uploading, a batch of activities at a time.
+
+    The sync holding the user's lease (the coordinator) hands the subtasks out over the message queue, and merges what comes back in the order it handed them out.
+    Anything nobody's picked up within SYNC_FANOUT_PICKUP_TIMEOUT (or whose worker has since died) the coordinator does itself - so it can't end up waiting on workers that are all busy coordinating.
+    """
+    def __init__(self, userId, run, waiting):
+        self.ID = str(ObjectId())
+        self._userId = userId
+        self._run = run # As for Perform
+        self._waiting = waiting # Called while waiting on subtasks, so the coordinator can keep its lease, heartbeat, etc. going
+        self._subtasks = []
+        self._connection = None
+        self._producer = None
+
+    def ShouldFanOut(user):
+        if SYNC_FANOUT_MIN_ACTIVITIES is None or redis is None:
+            return False
+        return ((user.get("SyncCost") or {}).get("ActivityCount") or 0) >= SYNC_FANOUT_MIN_ACTIVITIES
+
+    def Dispatch(self, kind, payload):
+        subtask = SyncSubtask(self.ID, len(self._subtasks), kind)
+        self._subtasks.append(subtask)
+        try:
+            raw = pickle.dumps(payload)
+        except Exception:
+            # Same as with checkpoints - some service left something unpicklable in its activities. This one's staying here, then.
+            logger.exception("Could not pickle %s subtask %d" % (kind, subtask.Index))
+            subtask.Payload = payload
+            return subtask
+        redis.set(subtask._redisKey("input"), raw, ex=SYNC_FANOUT_RETENTION)
+        subtask.DispatchedAt = datetime.utcnow()
+        try:
+            if self._producer is None:
+                # Our own connection, since the worker's channel belongs to whichever thread is pulling users off the queue.
+                self._connection = mq.clone()
+                self._producer = kombu.Producer(self._connection.channel(), kombu.Exchange("tapiriik-users", type="direct"))
+            self._producer.publish(subtask.Message(self._userId), routing_key=SyncSubtask.RoutingKey)
+        except Exception:
+            logger.exception("Could not hand out %s subtask %d - it'll be done here instead" % (kind, subtask.Index))
+            subtask.DispatchedAt = datetime.min
+        return subtask
+
+    def Result(self, subtask):
+        """ Waits on the subtask (doing it here, if nobody else will) - returns its result, or raises whatever it raised """
+        if subtask.Payload is not None:
+            return self._run(subtask.Kind, subtask.Payload, lambda: True)
+        while not subtask.IsDone():
+            if not subtask.IsClaimed() and datetime.utcnow() - subtask.DispatchedAt >= timedelta(seconds=SYNC_FANOUT_PICKUP_TIMEOUT):
+                logger.info("Nobody has %s subtask %d - doing it here" % (subtask.Kind, subtask.Index))
+                SyncFanOut.Perform(subtask, self._run)
+                continue
+            self._waiting()
+            time.sleep(SYNC_FANOUT_POLL_INTERVAL)
+        outcome = subtask.Outcome()
+        if "Exception" in outcome:
+            logger.warning("%s subtask %d failed elsewhere:\n%s" % (subtask.Kind, subtask.Index, outcome["Traceback"]))
+            raise outcome["Exception"]
+        if outcome.get("Unpicklable"):
+            # Whatever the service listed couldn't make the trip - listing again here is harmless, unlike uploading again.
+            if subtask.Kind != SyncSubtask.List:
+                raise Exception("Result of %s subtask %d could not be returned" % (subtask.Kind, subtask.Index))
+            logger.info("Result of %s subtask %d could not be returned - doing it again here" % (subtask.Kind, subtask.Index))
+            return self._run(subtask.Kind, subtask.Input(), lambda: True)
+        return outcome["Result"]
+
+    def Perform(subtask, run):
+        """ Runs the subtask if nobody else has - run being (kind, payload, renew) -> result, where renew() returns False once the claim's been lost """
+        token = str(ObjectId())
+        if subtask.IsDone() or not subtask.Claim(token):
+            return False
+        payload = subtask.Input()
+        if payload is None:
+            return False # The coordinator's long gone
+        try:
+            result = run(subtask.Kind, payload, lambda: subtask.Renew(token))
+        except Exception as e:
+            raw = SyncFanOut._packException(e)
+        else:
+            try:
+                raw = pickle.dumps({"Result": result})
+            except Exception:
+                logger.exception("Could not pickle result of %s subtask %d" % (subtask.Kind, subtask.Index))
+                raw = pickle.dumps({"Unpicklable": True})
+        redis.set(subtask._redisKey("result"), raw, ex=SYNC_FANOUT_RETENTION)
+        return True
+
+    def _packException(e):
+        tb = traceback.format_exc()
+        try:
+            raw = pickle.dumps({"Exception": e, "Traceback": tb})
+            pickle.loads(raw) # Not everything that pickles unpickles
+        except Exception:
+            raw = pickle.dumps({"Exception": Exception(str(e)), "Traceback": tb})
+        return raw
+
+    def Close(self):
+        # The claims are left to lapse, so anyone who's only now getting to one doesn't start it over.
+        if self._subtasks:
+            redis.delete(*[subtask._redisKey(part) for subtask in self._subtasks for part in ["input", "result"]])
+        if self._connection is not None:
+            self._connection.release()
+            self._connection = None
@@ -0,0 +1,89 @@
+from tapiriik.database import db, redis
+from tapiriik.settings import SYNC_HEARTBEAT_INTERVAL, SYNC_HEARTBEAT_PERSIST_INTERVAL, SYNC_HEARTBEAT_TTL
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import json
+
+# Heartbeats and progress change constantly, and nothing needs them to be durable - so they live in Redis (when it's configured).
+# Mongo only hears about them at phase boundaries, and every so often in between, so there's something to fall back on if Redis loses them.
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _pack(values):
+    return json.dumps(dict((k, (v - _EPOCH).total_seconds() if isinstance(v, datetime) else v) for k, v in values.items()))
+
+def _unpack(raw, timestampFields):
+    values = json.loads(raw.decode("UTF-8"))
+    for field in timestampFields:
+        if values.get(field) is not None:
+            values[field] = _EPOCH + timedelta(seconds=values[field])
+    return values
+
+class WorkerHeartbeat:
+    def __init__(self, recordId):
+        self._recordId = recordId
+        self._lastBeat = None
+        self._lastPersisted = None
+        self._lastPersistedState = None
+        self._lastPersistedUser = None
+
+    def _redisKey(recordId):
+        return "sync-heartbeat:%s" % recordId
+
+    def Beat(self, state, user=None):
+        from tapiriik.sync import SyncStep
+        # Going back and forth between these is business as usual within a sync - anything else is worth persisting right away.
+        inSyncStates = (SyncStep.List, SyncStep.Download, SyncStep.Upload)
+        now = datetime.utcnow()
+        phaseChanged = user != self._lastPersistedUser or (state != self._lastPersistedState and (state not in inSyncStates or self._lastPersistedState not in inSyncStates))
+        if redis is None or phaseChanged or now - self._lastPersisted >= timedelta(seconds=SYNC_HEARTBEAT_PERSIST_INTERVAL):
+            db.sync_workers.update({"_id": self._recordId}, {"$set": {"Heartbeat": now, "State": state, "User": user}})
+            self._lastPersisted = now
+            self._lastPersistedState = state
+            self._lastPersistedUser = user
+        if redis is not None and (phaseChanged or self._lastBeat is None or now - self._lastBeat >= timedelta(seconds=SYNC_HEARTBEAT_INTERVAL)):
+            redis.set(WorkerHeartbeat._redisKey(self._recordId), _pack({"Heartbeat": now, "State": state, "User": str(user) if user else None, "UserIsObjectId": isinstance(user, ObjectId)}), ex=SYNC_HEARTBEAT_TTL)
+            self._lastBeat = now
+
+    def Clear(self):
+        if redis is not None:
+            redis.delete(WorkerHeartbeat._redisKey(self._recordId))
+
+    def Read(workers):
+        """ Updates the sync_workers records given with their latest heartbeat, wherever it is """
+        workers = list(workers)
+        if redis is None or not workers:
+            return workers
+        for worker, raw in zip(workers, redis.mget([WorkerHeartbeat._redisKey(x["_id"]) for x in workers])):
+            if raw:
+                beat = _unpack(raw, ["Heartbeat"])
+                # Back to whatever it was in Mongo, so it still compares equal to the records that aren't overlaid.
+                if beat.pop("UserIsObjectId", False):
+                    beat["User"] = ObjectId(beat["User"])
+                if beat["Heartbeat"] > worker["Heartbeat"]:
+                    worker.update(beat)
+        return workers
+
+class SyncProgress:
+    def _redisKey(userId):
+        return "sync-progress:%s" % userId
+
+    def Set(userId, step, progress, persist=False):
+        if redis is not None:
+            redis.set(SyncProgress._redisKey(userId), _pack({"SynchronizationStep": step, "SynchronizationProgress": progress}), ex=SYNC_HEARTBEAT_TTL)
+        if persist or redis is None:
+            db.users.update({"_id": userId}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
+
+    def Clear(userId):
+        if redis is not None:
+            redis.delete(SyncProgress._redisKey(userId))
+
+    def Read(users):
+        """ Updates the user records given with their latest SynchronizationStep and SynchronizationProgress """
+        users = list(users)
+        if redis is None or not users:
+            return users
+        for user, raw in zip(users, redis.mget([SyncProgress._redisKey(x["_id"]) for x in users])):
+            if raw:
+                user.update(_unpack(raw, []))
+        return users
@@ -0,0 +1,55 @@
+class SyncLane:
+    """
+    Which queue a user waits in - so someone who just clicked "sync now" isn't stuck behind a pile of exhaustive resyncs.
+
+    Each lane has a global queue and one per host (for SynchronizationHostRestriction, and SyncAffinity), same as there always were - the scheduled lane keeps the original names.
+    """
+    Interactive = "interactive" # Somebody's looking at the dashboard
+    Triggered = "triggered" # Partial syncs from webhooks/polling
+    Scheduled = "scheduled" # The regular hourly partial syncs
+    Exhaustive = "exhaustive" # ...and anyone else whose sync is going to take a while
+
+    All = [Interactive, Triggered, Scheduled, Exhaustive]
+
+    def ForUser(user, exhaustive, expensive=False):
+        """ exhaustive being whether the user's next sync will be (see Sync.WillSyncExhaustively), expensive whether it'll take a while (see SyncCost) """
+        if user.get("NextSyncLane") == SyncLane.Interactive:
+            return SyncLane.Interactive
+        if exhaustive or expensive:
+            return SyncLane.Exhaustive
+        if user.get("NextSyncLane") == SyncLane.Triggered:
+            return SyncLane.Triggered
+        return SyncLane.Scheduled
+
+    def RoutingKey(lane, host=None):
+        if lane == SyncLane.Scheduled:
+            return host if host else ""
+        return "%s:%s" % (host, lane) if host else lane
+
+    def QueueName(lane, host=None):
+        name = "tapiriik-users-%s" % host if host else "tapiriik-users"
+        if lane == SyncLane.Scheduled:
+            return name
+        return "%s-%s" % (name, lane)
+
+class LanePicker:
+    """
+    Weighted round-robin over the lanes - each lane gets its weight's share of the users taken off the queue, so long as it has any waiting.
+
+    Lanes are offered in order of how far behind their share they are; the caller takes from the first with anything in it.
+    """
+    def __init__(self, weights):
+        self._weights = weights
+        self._credit = dict((lane, 0) for lane in weights)
+
+    def Order(self):
+        return sorted(self._weights.keys(), key=lambda lane: (self._credit[lane] + self._weights[lane], self._weights[lane]), reverse=True)
+
+    def Served(self, lane, empty=()):
+        # Lanes with nothing waiting sit this round out - they aren't owed anything, otherwise they'd hog the workers once something did turn up.
+        active = dict((x, weight) for x, weight in self._weights.items() if x not in empty)
+        for activeLane, weight in active.items():
+            self._credit[activeLane] += weight
+        self._credit[lane] -= sum(active.values())
+        for emptyLane in empty:
+            self._credit[emptyLane] = min(self._credit[emptyLane], 0)
@@ -0,0 +1,103 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_LEASE_DURATION, SYNC_LEASE_RENEW_INTERVAL, SYNC_LEASE_STALL_TIMEOUT, SYNC_LEASE_LIST_STALL_TIMEOUT
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+class UserLease:
+    """
+    A worker's claim on the user it's synchronizing - SynchronizationWorker and co. on the user record, plus a token and an expiry.
+
+    It's only taken if nobody else holds it (or their lease has lapsed), and it's renewed in the background while the sync keeps making progress.
+    So, if the worker dies or hangs, the user's free to go again as soon as the lease runs out - no need to wait on the watchdogs.
+    """
+    def __init__(self, userId):
+        self._userId = userId
+        self.Token = None
+        self.Lost = False
+        self._expiry = None # As of our last renewal - past this, someone else may well have it
+        self._step = None
+        self._lastProgress = None
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _available(now):
+        # Locks from before leases (no expiry) are as good as lapsed.
+        return [{"SynchronizationWorker": None}, {"SynchronizationLeaseExpiry": None}, {"SynchronizationLeaseExpiry": {"$lt": now}}]
+
+    def IsHeld(user, now=None):
+        now = now if now else datetime.utcnow()
+        return user.get("SynchronizationWorker") is not None and user.get("SynchronizationLeaseExpiry") is not None and user["SynchronizationLeaseExpiry"] >= now
+
+    def RescheduleIfAbandoned(userId, when):
+        """ For a sync that's given up on its user - reschedules them, unless someone else holds them (or has already seen to it) """
+        now = datetime.utcnow()
+        # Whoever finishes a sync clears QueuedAt - so if it's still there, nobody has.
+        result = db.users.update({"_id": userId, "QueuedAt": {"$exists": True}, "$or": UserLease._available(now)}, {"$set": {"NextSynchronization": when}, "$unset": {"QueuedAt": None}})
+        return bool(result["n"])
+
+    def Acquire(self, step):
+        now = datetime.utcnow()
+        token = ObjectId()
+        expiry = now + timedelta(seconds=SYNC_LEASE_DURATION)
+        result = db.users.update({"_id": self._userId, "$or": UserLease._available(now)}, {"$set": {
+            "SynchronizationWorker": os.getpid(),
+            "SynchronizationHost": socket.gethostname(),
+            "SynchronizationStartTime": now,
+            "SynchronizationLease": token,
+            "SynchronizationLeaseExpiry": expiry
+        }})
+        if not result["n"]:
+            return False
+        self.Token = token
+        self._expiry = expiry
+        self.Progress(step)
+        self._renewer = threading.Thread(target=self._renewLoop, daemon=True)
+        self._renewer.start()
+        return True
+
+    def Progress(self, step):
+        """ Call whenever the sync gets anywhere - returns False if the lease has been lost (or may have been) in the meantime """
+        self._step = step
+        self._lastProgress = datetime.utcnow()
+        # If the renewals have stopped for whatever reason, it's as good as gone once it runs out.
+        return not self.Lost and self._expiry is not None and self._lastProgress < self._expiry
+
+    def _renewLoop(self):
+        while not self._stop.wait(SYNC_LEASE_RENEW_INTERVAL):
+            if not self._renew():
+                return
+
+    def _renew(self):
+        from tapiriik.sync import SyncStep
+        now = datetime.utcnow()
+        stallTimeout = SYNC_LEASE_LIST_STALL_TIMEOUT if self._step == SyncStep.List else SYNC_LEASE_STALL_TIMEOUT
+        if now - self._lastProgress > timedelta(seconds=stallTimeout):
+            # Let it lapse, so someone else can have a go - and if this sync does wake up, it's not to carry on alongside them.
+            logger.warning("Sync for %s stalled in %s since %s - letting lease lapse" % (self._userId, self._step, self._lastProgress))
+            self.Lost = True
+            return False
+        expiry = now + timedelta(seconds=SYNC_LEASE_DURATION)
+        result = db.users.update({"_id": self._userId, "SynchronizationLease": self.Token}, {"$set": {"SynchronizationLeaseExpiry": expiry}})
+        if not result["n"]:
+            logger.warning("Lost lease on %s" % self._userId)
+            self.Lost = True
+            return False
+        self._expiry = expiry
+        return True
+
+    def Release(self, update=None):
+        """ Gives up the lease (applying update to the user record along the way), so long as it's still ours """
+        self._stop.set()
+        if self.Token is None:
+            return
+        update = update if update else {}
+        update.setdefault("$unset", {}).update({"SynchronizationWorker": None, "SynchronizationLease": None, "SynchronizationLeaseExpiry": None})
+        result = db.users.update({"_id": self._userId, "SynchronizationLease": self.Token}, update)
+        self.Token = None
+        return result
@@ -0,0 +1,55 @@
+from tapiriik.settings import SYNC_SCHEDULER_CONFIRM_TIMEOUT
+from datetime import datetime, timedelta
+import kombu
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+class BatchPublisher:
+    """
+    Publishes a batch of messages, then waits on RabbitMQ's confirms for the lot - one round-trip per batch, rather than one per message.
+
+    It needs a connection of its own, since the confirm_publish transport option makes every publish on a connection wait on its own confirm.
+    """
+    def __init__(self, connection, exchange):
+        self._connection = connection
+        self._channel = connection.channel()
+        self._channel.confirm_select()
+        self._channel.events["basic_ack"].add(self._acked)
+        self._channel.events["basic_nack"].add(self._nacked)
+        self._producer = kombu.Producer(self._channel, exchange)
+        self._nextTag = 1 # RabbitMQ numbers the messages on a confirm-mode channel from 1
+        self._outstanding = {} # delivery tag -> index in the batch
+        self._rejected = set()
+
+    def _settle(self, delivery_tag, multiple):
+        tags = [x for x in self._outstanding if x <= delivery_tag] if multiple else [delivery_tag]
+        return [self._outstanding.pop(x) for x in tags if x in self._outstanding]
+
+    def _acked(self, delivery_tag, multiple):
+        self._settle(delivery_tag, multiple)
+
+    def _nacked(self, delivery_tag, multiple):
+        self._rejected.update(self._settle(delivery_tag, multiple))
+
+    def Publish(self, messages):
+        """ Publishes each (body, routing key) - returns the indices of those RabbitMQ didn't confirm, which may or may not have made it """
+        self._outstanding = {}
+        self._rejected = set()
+        published = 0
+        try:
+            for body, routing_key in messages:
+                self._producer.publish(body, routing_key=routing_key)
+                self._outstanding[self._nextTag] = published
+                self._nextTag += 1
+                published += 1
+            deadline = datetime.utcnow() + timedelta(seconds=SYNC_SCHEDULER_CONFIRM_TIMEOUT)
+            while self._outstanding and datetime.utcnow() < deadline:
+                try:
+                    self._connection.drain_events(timeout=(deadline - datetime.utcnow()).total_seconds())
+                except socket.timeout:
+                    break
+        except Exception:
+            logger.exception("Publishing stopped after %d of %d messages" % (published, len(messages)))
+        return sorted(self._rejected | set(self._outstanding.values()) | set(range(published, len(messages))))
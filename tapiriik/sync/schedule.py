@@ -0,0 +1,113 @@
+from tapiriik.database import db, redis
+from tapiriik.settings import SYNC_HEARTBEAT_TTL
+from pymongo.read_preferences import ReadPreference
+import pymongo
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import json
+
+_EPOCH = datetime(1970, 1, 1)
+
+class SyncSchedule:
+    """
+    When each user is next due to synchronize, kept in a Redis sorted set (scored by due time) so sync_scheduler can pick out whoever's due without polling the users collection.
+
+    NextSynchronization on the user record is still what counts - this is just an index into it, so anything that sets it should also tell us.
+    Anything that slips through is picked up when the schedule is rebuilt, which the scheduler does every so often.
+    Users the scheduler's holding back have SyncHeldUntil set as well, and aren't due till the later of the two.
+    """
+    _redisKey = "sync-schedule"
+    _passRedisKey = "sync-scheduler:last-pass"
+
+    def Add(times):
+        """ Takes {user ID: due time} """
+        if redis is None or not times:
+            return
+        args = []
+        for userId, when in times.items():
+            args += [(when - _EPOCH).total_seconds(), str(userId)]
+        # (zadd's signature changed between redis-py versions, this didn't)
+        redis.execute_command("ZADD", SyncSchedule._redisKey, *args)
+
+    def Set(userId, when):
+        if when is None:
+            SyncSchedule.Remove([userId])
+        else:
+            SyncSchedule.Add({userId: when})
+
+    def Hold(times):
+        """ Takes {user ID: held until} - they stay due as far as NextSynchronization's concerned, but won't come up again till then """
+        if not times:
+            return
+        # On the user record, so the hold survives the schedule being rebuilt.
+        db.users.bulk_write([pymongo.UpdateOne({"_id": userId, "QueuedAt": {"$exists": False}}, {"$set": {"SyncHeldUntil": until}}) for userId, until in times.items()], ordered=False)
+        SyncSchedule.Add(times)
+
+    def DueAt(user):
+        """ When the user (with NextSynchronization and SyncHeldUntil) is actually due """
+        if user.get("SyncHeldUntil") and user["SyncHeldUntil"] > user["NextSynchronization"]:
+            return user["SyncHeldUntil"]
+        return user["NextSynchronization"]
+
+    def Remove(userIds):
+        if redis is None or not userIds:
+            return
+        redis.zrem(SyncSchedule._redisKey, *[str(x) for x in userIds])
+
+    def ScheduleMatching(query, when, lane=None):
+        """ Sets NextSynchronization (and NextSyncLane, if given) for every user matching the query - in bulk """
+        userIds = [x["_id"] for x in db.users.find(query, {"_id": True})]
+        if not userIds:
+            return userIds
+        update = {"NextSynchronization": when}
+        if lane:
+            update["NextSyncLane"] = lane
+        db.users.update({"_id": {"$in": userIds}}, {"$set": update}, multi=True)
+        SyncSchedule.Add(dict((x, when) for x in userIds))
+        return userIds
+
+    def PopDue(now, limit):
+        """ Removes and returns the IDs of (up to limit) users due by now, earliest first """
+        if redis is None:
+            # Back to polling, I suppose.
+            return [x["_id"] for x in db.users.with_options(read_preference=ReadPreference.PRIMARY).find({"NextSynchronization": {"$lte": now}, "QueuedAt": {"$exists": False}, "$or": [{"SyncHeldUntil": None}, {"SyncHeldUntil": {"$lte": now}}]}, {"_id": True}).sort("NextSynchronization", 1).limit(limit)]
+        due = redis.zrangebyscore(SyncSchedule._redisKey, "-inf", (now - _EPOCH).total_seconds(), start=0, num=limit)
+        if not due:
+            return []
+        # Only the scheduler pops, so nobody's racing us for these - if one was rescheduled in between, the scheduler puts it back once it sees the user record.
+        redis.zrem(SyncSchedule._redisKey, *due)
+        return [ObjectId(x.decode("UTF-8")) for x in due]
+
+    def NextDue():
+        if redis is None:
+            return None
+        head = redis.zrange(SyncSchedule._redisKey, 0, 0, withscores=True)
+        return _EPOCH + timedelta(seconds=head[0][1]) if head else None
+
+    def Count():
+        return redis.zcard(SyncSchedule._redisKey) if redis is not None else None
+
+    def Rebuild():
+        """ Adds every user with a pending NextSynchronization - for when Redis has lost track, or someone's updated users behind our back """
+        batch = {}
+        count = 0
+        for user in db.users.find({"NextSynchronization": {"$ne": None}, "QueuedAt": {"$exists": False}}, {"_id": True, "NextSynchronization": True, "SyncHeldUntil": True}):
+            batch[user["_id"]] = SyncSchedule.DueAt(user)
+            if len(batch) >= 1000:
+                SyncSchedule.Add(batch)
+                count += len(batch)
+                batch = {}
+        SyncSchedule.Add(batch)
+        return count + len(batch)
+
+    def RecordPass(stats):
+        if redis is not None:
+            redis.set(SyncSchedule._passRedisKey, json.dumps(dict(stats, Timestamp=(datetime.utcnow() - _EPOCH).total_seconds())), ex=SYNC_HEARTBEAT_TTL)
+
+    def LastPass():
+        raw = redis.get(SyncSchedule._passRedisKey) if redis is not None else None
+        if not raw:
+            return None
+        stats = json.loads(raw.decode("UTF-8"))
+        stats["Timestamp"] = _EPOCH + timedelta(seconds=stats["Timestamp"])
+        return stats
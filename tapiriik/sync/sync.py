@@ -1,8 +1,24 @@
 from tapiriik.database import db, cachedb, redis
 from tapiriik.messagequeue import mq
 from tapiriik.services import Service, ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning, UserException, UserExceptionType
-from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES
+from tapiriik.services.health import ServiceHealth
+from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES, SYNC_LISTING_CONCURRENCY, SYNC_UPLOAD_CONCURRENCY, SYNC_DOWNLOAD_LOOKAHEAD, SYNC_LANE_WEIGHTS, SYNC_QUEUE_POLL_INTERVAL, SYNC_INTERVAL_FLOOR, SYNC_CHECKPOINT_INTERVAL, SYNC_BACKFILL_SLICE_ACTIVITIES, SYNC_BACKFILL_SLICE_DURATION, SYNC_BACKFILL_INTERVAL, SYNC_DEADLINE, SYNC_DEADLINE_RESERVE, SYNC_DEADLINE_RESCHEDULE, SYNC_DEADLINE_LISTING, SYNC_FANOUT_BATCH_SIZE, SYNC_FANOUT_CONCURRENCY
+from tapiriik.requests_lib import set_request_deadline, get_request_deadline
 from .activity_record import ActivityRecord, ActivityServicePrescence
+from .activity_index import ActivityIndex
+from .synchronized_activities import SynchronizedActivities
+from .write_buffer import WriteBuffer
+from .heartbeat import SyncProgress
+from .schedule import SyncSchedule
+from .lanes import SyncLane, LanePicker
+from .cost import SyncCost
+from .cadence import SyncCadence
+from .lease import UserLease
+from .checkpoint import SyncCheckpoint
+from .fanout import SyncFanOut, SyncSubtask
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+import concurrent.futures
+from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 import sys
 import os
@@ -18,7 +34,8 @@ import pymongo
 import pytz
 import kombu
 import json
-import bisect
+import threading
+import time
 
 # Set this up separate from the logger used in this scope, so services logging messages are caught and logged into user's files.
 _global_logger = logging.getLogger("tapiriik")
@@ -35,6 +52,17 @@ if hasattr(sys.stdout, "buffer"):
 
 logger = logging.getLogger("tapiriik.sync.worker")
 
+# Which SynchronizationTask the current thread is working for - so each user's log only gets their own messages, even with several going at once.
+_task_context = threading.local()
+
+class _TaskLogFilter(logging.Filter):
+    def __init__(self, task):
+        super(_TaskLogFilter, self).__init__()
+        self._task = task
+
+    def filter(self, record):
+        return getattr(_task_context, "task", None) is self._task
+
 def _formatExc():
     try:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -83,137 +111,293 @@ def _unpackUserException(raw):
         return None
     return UserException(raw["Type"], extra=raw["Extra"], intervention_required=raw["InterventionRequired"], clear_group=raw["ClearGroup"])
 
+def _packActivityRecord(record):
+    def _activityPrescences(prescences):
+        return dict([(svcId if svcId else "",
+            {
+                "Processed": presc.ProcessedTimestamp,
+                "Synchronized": presc.SynchronizedTimestamp,
+                "Exception": _packUserException(presc.UserException)
+            }) for svcId, presc in prescences.items()])
+
+    return {
+        "StartTime": record.StartTime,
+        "EndTime": record.EndTime,
+        "Type": record.Type,
+        "Name": record.Name,
+        "Notes": record.Notes,
+        "Private": record.Private,
+        "Stationary": record.Stationary,
+        "Distance": record.Distance,
+        "UIDs": sorted(record.UIDs), # So the same set always packs the same way
+        "Prescence": _activityPrescences(record.PresentOnServices),
+        "Abscence": _activityPrescences(record.NotPresentOnServices),
+        "FailureCounts": record.FailureCounts
+    }
+
 class Sync:
 
-    SyncInterval = timedelta(hours=1)
+    SyncInterval = timedelta(seconds=SYNC_INTERVAL_FLOOR) # At the most - see SyncCadence
     SyncIntervalJitter = timedelta(minutes=5)
     MinimumSyncInterval = timedelta(seconds=30)
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=14)  # Based on the general page size of 50 activites, this would be >3/day...
 
     def ScheduleImmediateSync(user, exhaustive=None):
+        nextSync = datetime.utcnow()
+        # Whatever the scheduler was holding them back for gets another look.
         if exhaustive is None:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": nextSync, "NextSyncLane": SyncLane.Interactive}, "$unset": {"SyncHeldUntil": None}})
         else:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": nextSync, "NextSyncIsExhaustive": exhaustive, "NextSyncLane": SyncLane.Interactive}, "$unset": {"SyncHeldUntil": None}})
+        SyncSchedule.Set(user["_id"], nextSync)
 
     def SetNextSyncIsExhaustive(user, exhaustive=False):
         db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": exhaustive}})
 
+    def WillSyncExhaustively(user):
+        # Always to an exhaustive sync if there were errors
+        #   Sometimes services report that uploads failed even when they succeeded.
+        #   If a partial sync was done, we'd be assuming that the accounts were consistent past the first page
+        #       e.g. If an activity failed to upload far in the past, it would never be attempted again.
+        #   So we need to verify the full state of the accounts.
+        # But, we can still do a partial sync if there are *only* blocking errors
+        #   In these cases, the block will protect that service from being improperly manipulated (though tbqh I can't come up with a situation where this would happen, it's more of a performance thing).
+        #   And, when the block is cleared, NextSyncIsExhaustive is set.
+
+        exhaustive = "NextSyncIsExhaustive" in user and user["NextSyncIsExhaustive"] is True
+        if  ("ForcingExhaustiveSyncErrorCount" not in user and "NonblockingSyncErrorCount" in user and user["NonblockingSyncErrorCount"] > 0) or \
+            ("ForcingExhaustiveSyncErrorCount" in user and user["ForcingExhaustiveSyncErrorCount"] > 0):
+            exhaustive = True
+        if user.get("Backfill") and user["Backfill"]["NextSlice"] <= datetime.utcnow():
+            exhaustive = True # See StartBackfill
+        return exhaustive
+
+    def StartBackfill(user):
+        # Rather than one enormous exhaustive sync, the user's history is worked through a slice at a time - see SynchronizationTask._backfillSliceDone
+        # (if there's one already going, it has to start over - the new service hasn't seen any of it)
+        db.users.update({"_id": user["_id"]}, {"$set": {"Backfill": {"Started": datetime.utcnow(), "Cursor": None, "NextSlice": datetime.utcnow(), "Remaining": None, "Total": None}}})
+
     def InitializeWorkerBindings():
         Sync._channel = mq.channel()
         Sync._exchange = kombu.Exchange("tapiriik-users", type="direct")(Sync._channel)
         Sync._exchange.declare()
-        Sync._global_queue = kombu.Queue("tapiriik-users")(Sync._channel)
-        Sync._host_queue = kombu.Queue("tapiriik-users-%s" % socket.gethostname())(Sync._channel)
-        Sync._global_queue.declare()
-        Sync._host_queue.declare()
-        # Bind to worker-specific and general routing keys
-        Sync._global_queue.bind_to(exchange="tapiriik-users", routing_key="")
-        Sync._host_queue.bind_to(exchange="tapiriik-users", routing_key=socket.gethostname())
-
-    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None):
-        def _callback(body, message):
-            Sync._consumeSyncTask(body, message, heartbeat_callback, version)
-
-        Sync._consumer = kombu.Consumer(
-            channel=Sync._channel,
-            queues=[Sync._host_queue, Sync._global_queue],
-            callbacks=[_callback],
-            auto_declare=False
-        )
+        Sync._lane_queues = {}
+        for lane in SyncLane.All:
+            global_queue = kombu.Queue(SyncLane.QueueName(lane))(Sync._channel)
+            host_queue = kombu.Queue(SyncLane.QueueName(lane, socket.gethostname()))(Sync._channel)
+            global_queue.declare()
+            host_queue.declare()
+            # Bind to worker-specific and general routing keys
+            global_queue.bind_to(exchange="tapiriik-users", routing_key=SyncLane.RoutingKey(lane))
+            host_queue.bind_to(exchange="tapiriik-users", routing_key=SyncLane.RoutingKey(lane, socket.gethostname()))
+            Sync._lane_queues[lane] = [host_queue, global_queue]
+        Sync._lane_picker = LanePicker(SYNC_LANE_WEIGHTS)
+        # Pieces of other workers' syncs - see SyncFanOut
+        Sync._subtask_queue = kombu.Queue(SyncSubtask.QueueName)(Sync._channel)
+        Sync._subtask_queue.declare()
+        Sync._subtask_queue.bind_to(exchange="tapiriik-users", routing_key=SyncSubtask.RoutingKey)
+
+    def _nextSyncMessage():
+        # Pulled rather than pushed, so we get to pick which lane it comes from.
+        # Subtasks go first, though - someone's already waiting on them.
+        message = Sync._subtask_queue.get(no_ack=False)
+        if message is not None:
+            return message
+        empty = []
+        for lane in Sync._lane_picker.Order():
+            for queue in Sync._lane_queues[lane]:
+                message = queue.get(no_ack=False)
+                if message is not None:
+                    Sync._lane_picker.Served(lane, empty)
+                    return message
+            empty.append(lane)
+        return None
 
-        Sync._consumer.qos(prefetch_count=1, apply_global=False)
+    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None, concurrency=1):
+        """ Synchronizes users off the queue - one at a time, or up to `concurrency` at once (in which case heartbeat_callback also gets a slot number) """
+        if concurrency > 1:
+            return Sync._performConcurrentGlobalSync(heartbeat_callback, version, max_users, concurrency)
+
+        processed = 0
+        while max_users is None or processed < max_users:
+            message = Sync._nextSyncMessage()
+            if message is None:
+                # Still here, just waiting - otherwise the watchdog takes us for stalled.
+                if heartbeat_callback:
+                    heartbeat_callback("ready", None)
+                time.sleep(SYNC_QUEUE_POLL_INTERVAL)
+                continue
+            Sync._consumeSyncTask(message.payload, message, heartbeat_callback, version)
+            processed += 1
 
-        Sync._consumer.consume()
+    def _performConcurrentGlobalSync(heartbeat_callback, version, max_users, concurrency):
+        # The syncs run on their own threads - but everything to do with the channel stays on this one, since it isn't thread-safe.
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        freeSlots = list(range(concurrency - 1, -1, -1))
+        running = {} # future -> (message, slot)
+        started = 0
+        failure = None
 
-        for _ in kombu.eventloop(mq, limit=max_users):
-            pass
+        try:
+            while True:
+                for future in [x for x in running.keys() if x.done()]:
+                    message, slot = running.pop(future)
+                    freeSlots.append(slot)
+                    if future.exception() is not None:
+                        # Same as when they're run one at a time - if the sync blew up, so do we, and the message goes back in the queue.
+                        # The others get to finish first, though.
+                        if failure is None:
+                            failure = future.exception()
+                        continue
+                    message.ack()
+                # Idle slots have to keep beating too - the watchdog would otherwise take them for stalled, and kill the whole process (every other slot's sync with it).
+                if heartbeat_callback:
+                    for slot in freeSlots:
+                        heartbeat_callback("ready", None, slot=slot)
+                finishing = failure is not None or (max_users is not None and started >= max_users)
+                if finishing and not running:
+                    break
+                message = Sync._nextSyncMessage() if freeSlots and not finishing else None
+                if message is not None:
+                    started += 1
+                    slot = freeSlots.pop()
+                    running[executor.submit(Sync._performSyncTask, message.payload, heartbeat_callback, version, slot)] = (message, slot)
+                    continue
+                # Nothing to do till a sync finishes, or something turns up in the queue.
+                if running:
+                    concurrent.futures.wait(list(running.keys()), timeout=SYNC_QUEUE_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(SYNC_QUEUE_POLL_INTERVAL)
+        finally:
+            executor.shutdown(wait=False)
+        if failure is not None:
+            raise failure
 
     def _consumeSyncTask(body, message, heartbeat_callback_direct, version):
+        Sync._performSyncTask(body, heartbeat_callback_direct, version)
+        message.ack()
+
+    def _performSyncTask(body, heartbeat_callback_direct, version, slot=None):
         from tapiriik.auth import User
 
+        if "fanout_id" in body:
+            return Sync._performSyncSubtask(body, heartbeat_callback_direct, slot)
+
         user_id = body["user_id"]
         user = User.Get(user_id)
         if user is None:
             logger.warning("Could not find user %s - bailing" % user_id)
-            message.ack() # Otherwise the entire thing grinds to a halt
-            return
+            return # The message is still acked - otherwise the entire thing grinds to a halt
         if body["generation"] != user.get("QueuedGeneration", None):
             # QueuedGeneration being different means they've gone through sync_scheduler since this particular message was queued
             # So, discard this and wait for that message to surface
             # Should only happen when I manually requeue people
             logger.warning("Queue generation mismatch for %s - bailing" % user_id)
-            message.ack()
             return
 
         def heartbeat_callback(state):
-            heartbeat_callback_direct(state, user_id)
+            if slot is None:
+                heartbeat_callback_direct(state, user_id)
+            else:
+                heartbeat_callback_direct(state, user_id, slot=slot)
 
         syncStart = datetime.utcnow()
 
-        # Always to an exhaustive sync if there were errors
-        #   Sometimes services report that uploads failed even when they succeeded.
-        #   If a partial sync was done, we'd be assuming that the accounts were consistent past the first page
-        #       e.g. If an activity failed to upload far in the past, it would never be attempted again.
-        #   So we need to verify the full state of the accounts.
-        # But, we can still do a partial sync if there are *only* blocking errors
-        #   In these cases, the block will protect that service from being improperly manipulated (though tbqh I can't come up with a situation where this would happen, it's more of a performance thing).
-        #   And, when the block is cleared, NextSyncIsExhaustive is set.
-
-        exhaustive = "NextSyncIsExhaustive" in user and user["NextSyncIsExhaustive"] is True
-        if  ("ForcingExhaustiveSyncErrorCount" not in user and "NonblockingSyncErrorCount" in user and user["NonblockingSyncErrorCount"] > 0) or \
-            ("ForcingExhaustiveSyncErrorCount" in user and user["ForcingExhaustiveSyncErrorCount"] > 0):
-            exhaustive = True
+        exhaustive = Sync.WillSyncExhaustively(user)
 
         result = None
+        locked_elsewhere = False
         try:
             if not user.get("BlockedOnBadActivitiesAcknowledgement", False):
                 result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback)
+        except SynchronizationLockedException:
+            # Whoever does have them will reschedule them once they're done.
+            # If nobody does (we stalled, and let the lease lapse ourselves), they'd be stuck as queued - so they're due again right away.
+            logger.warning("User %s is being synchronized elsewhere - bailing" % user_id)
+            locked_elsewhere = True
+            if UserLease.RescheduleIfAbandoned(user["_id"], datetime.utcnow()):
+                SyncSchedule.Set(user["_id"], datetime.utcnow())
         finally:
-            nextSync = None
-            if User.HasActivePayment(user):
-                if User.GetConfiguration(user)["suppress_auto_sync"]:
-                    logger.info("Not scheduling auto sync for paid user")
-                else:
-                    nextSync = datetime.utcnow() + Sync.SyncInterval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
-            if result and result.ForceNextSync:
-                logger.info("Forcing next sync at %s" % result.ForceNextSync)
-                nextSync = result.ForceNextSync
-            reschedule_update = {
-                "$set": {
-                    "NextSynchronization": nextSync,
-                    "LastSynchronization": datetime.utcnow(),
-                    "LastSynchronizationVersion": version
-                }, "$unset": {
-                    "QueuedAt": None # Set by sync_scheduler when the record enters the MQ
+            if not locked_elsewhere:
+                nextSync = None
+                if User.HasActivePayment(user):
+                    if User.GetConfiguration(user)["suppress_auto_sync"]:
+                        logger.info("Not scheduling auto sync for paid user")
+                    else:
+                        cadence = result.ActivityCadence if result and result.ActivityCadence else user.get("ActivityCadence")
+                        nextSync = datetime.utcnow() + SyncCadence.Interval(cadence) + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
+                if result and result.ForceNextSync:
+                    logger.info("Forcing next sync at %s" % result.ForceNextSync)
+                    nextSync = result.ForceNextSync
+                backfill = user.get("Backfill")
+                if backfill and len(user.get("ConnectedServices", [])) < 2:
+                    backfill = None # Nothing left to backfill between
+                elif result and result.Backfill:
+                    backfill = None if result.Backfill["Complete"] else dict(user["Backfill"], Cursor=result.Backfill["Cursor"], Remaining=result.Backfill["Remaining"], Total=result.Backfill["Total"], NextSlice=datetime.utcnow() + timedelta(seconds=SYNC_BACKFILL_INTERVAL))
+                elif backfill and backfill["NextSlice"] <= datetime.utcnow():
+                    # This go didn't get anywhere with it (it blew up, they're blocked, etc.) - so the slice waits its turn, rather than being due again right away, forever.
+                    backfill = dict(backfill, NextSlice=datetime.utcnow() + timedelta(seconds=SYNC_BACKFILL_INTERVAL))
+                if backfill:
+                    # The next slice goes ahead whether or not they get auto-syncs - otherwise they'd be clicking "sync now" all day.
+                    nextSync = min(nextSync, backfill["NextSlice"]) if nextSync else backfill["NextSlice"]
+                reschedule_update = {
+                    "$set": {
+                        "NextSynchronization": nextSync,
+                        "LastSynchronization": datetime.utcnow(),
+                        "LastSynchronizationVersion": version
+                    }, "$unset": {
+                        "QueuedAt": None, # Set by sync_scheduler when the record enters the MQ
+                        "NextSyncLane": None,
+                        "ExhaustiveDeferredSince": None # Set by sync_scheduler when it puts off an exhaustive sync
+                    }
                 }
-            }
 
-            if result and result.ForceExhaustive:
-                logger.info("Forcing next sync as exhaustive")
-                reschedule_update["$set"]["NextSyncIsExhaustive"] = True
+                syncTime = (datetime.utcnow() - syncStart).total_seconds()
+                if backfill != user.get("Backfill"):
+                    if backfill:
+                        reschedule_update["$set"]["Backfill"] = backfill
+                    else:
+                        logger.info("Backfill complete" if result and result.Backfill else "Backfill no longer needed")
+                        reschedule_update["$unset"]["Backfill"] = None
+                if result:
+                    reschedule_update["$set"].update(SyncCost.Update(user, syncTime, exhaustive, result.ActivityCount))
+                    if result.ActivityCadence:
+                        reschedule_update["$set"]["ActivityCadence"] = result.ActivityCadence
+
+                if result and result.ForceExhaustive:
+                    logger.info("Forcing next sync as exhaustive")
+                    reschedule_update["$set"]["NextSyncIsExhaustive"] = True
+                else:
+                    reschedule_update["$unset"]["NextSyncIsExhaustive"] = ""
+
+                scheduling_result = db.users.update(
+                    {
+                        "_id": user["_id"]
+                    }, reschedule_update)
+                SyncSchedule.Set(user["_id"], nextSync)
+                reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
+
+                # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
+                user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
+                user_log.write("\n%s\n" % reschedule_confirm_message)
+                user_log.close()
+
+                logger.debug(reschedule_confirm_message)
+                queueWait = (syncStart - user["QueuedAt"]).total_seconds() if user.get("QueuedAt") else None
+                db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime, "Lane": body.get("lane", SyncLane.Scheduled), "QueueWait": queueWait})
+
+    def _performSyncSubtask(body, heartbeat_callback_direct, slot=None):
+        # No rescheduling or anything of the sort - the coordinator takes care of all that once it's merged the results.
+        def heartbeat_callback(state):
+            if slot is None:
+                heartbeat_callback_direct(state, body["user_id"])
             else:
-                reschedule_update["$unset"]["NextSyncIsExhaustive"] = ""
+                heartbeat_callback_direct(state, body["user_id"], slot=slot)
+        logger.info("Performing %s subtask %d of %s for %s" % (body["kind"], body["subtask"], body["fanout_id"], body["user_id"]))
+        SyncFanOut.Perform(SyncSubtask.FromMessage(body), lambda kind, payload, renew: SynchronizationTask.PerformSubtask(kind, payload, renew, heartbeat_callback=heartbeat_callback))
 
-            scheduling_result = db.users.update(
-                {
-                    "_id": user["_id"]
-                }, reschedule_update)
-            reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
-
-            # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
-            user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
-            user_log.write("\n%s\n" % reschedule_confirm_message)
-            user_log.close()
-
-            logger.debug(reschedule_confirm_message)
-            syncTime = (datetime.utcnow() - syncStart).total_seconds()
-            db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
-
-        message.ack()
-
-    def PerformUserSync(user, exhaustive=False, heartbeat_callback=None):
-        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback)
+    def PerformUserSync(user, exhaustive=False, heartbeat_callback=None, deadline=None):
+        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback, deadline=deadline)
 
 
 class SynchronizationTask:
@@ -222,39 +406,111 @@ class SynchronizationTask:
 
     def __init__(self, user):
         self.user = user
+        self._writeBuffer = WriteBuffer()
+        self._lastSyncProgress = None
+        self._lease = None
+        # For checkpoints - see _resumeFromCheckpoint
+        self._listedConnections = []
+        self._listingComplete = False
+        self._listedAt = datetime.utcnow()
+        self._lastCheckpoint = datetime.utcnow()
+        self._deadline = None
+        self._listingDeadline = None
+        # For fanning out - see _fanOutActivity
+        self._fanOut = None
+        self._fanOutPending = []
+        self._fanOutBatches = []
+        self._fanOutStoppedAt = None
 
     def _lockUser(self):
-        db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow()}})
+        lease = UserLease(self.user["_id"])
+        if not lease.Acquire(SyncStep.List):
+            raise SynchronizationLockedException()
+        self._lease = lease
+
+    def _leaseProgress(self, step):
+        # The lease is kept alive so long as we're getting somewhere - and if someone's taken it in the meantime, we stop right here.
+        if self._lease and not self._lease.Progress(step):
+            raise SynchronizationLockedException()
 
     def _unlockUser(self):
-        unlock_result = db.users.update(
-            {
-                "_id": self.user["_id"]
-            }, {
-                "$unset": {
-                    "SynchronizationWorker": None
-                }
-            })
+        unlock_update = {
+            "$unset": {
+                "SynchronizationWorker": None
+            }
+        }
+        if self._lastSyncProgress:
+            # Where it ended up, since most of the progress updates never made it this far.
+            unlock_update["$set"] = {"SynchronizationStep": self._lastSyncProgress[0], "SynchronizationProgress": self._lastSyncProgress[1]}
+        if self._lease:
+            unlock_result = self._lease.Release(unlock_update)
+        else:
+            unlock_result = db.users.update(
+                {
+                    "_id": self.user["_id"]
+                }, unlock_update)
+        SyncProgress.Clear(self.user["_id"])
         logger.debug("User unlock returned %s" % unlock_result)
 
     def _loadServiceData(self):
         self._connectedServiceIds = [x["ID"] for x in self.user["ConnectedServices"]]
         self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": self._connectedServiceIds}})]
+        for conn in self._serviceConnections:
+            SynchronizedActivities.MigrateLegacy(conn)
+        # Checked against every activity - so make those lookups cheap. This is never written back as-is.
+        synchronizedActivities = SynchronizedActivities.Load([x._id for x in self._serviceConnections])
+        for conn in self._serviceConnections:
+            conn.SynchronizedActivities = synchronizedActivities[conn._id]
+
+    def _markActivitySynchronized(self, conn, activity):
+        # Keep our copy in line with what we're writing.
+        if not isinstance(getattr(conn, "SynchronizedActivities", None), set):
+            conn.SynchronizedActivities = set(getattr(conn, "SynchronizedActivities", []))
+        conn.SynchronizedActivities |= activity.UIDs
+        SynchronizedActivities.Queue(self._writeBuffer, [(conn._id, uid) for uid in activity.UIDs])
 
     def _updateSyncProgress(self, step, progress):
-        db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
+        self._leaseProgress(step)
+        # Only a change of step goes to the database right away - everything in between is in Redis.
+        SyncProgress.Set(self.user["_id"], step, progress, persist=not self._lastSyncProgress or self._lastSyncProgress[0] != step)
+        self._lastSyncProgress = (step, progress)
 
     def _initializeUserLogging(self):
         self._logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", maxBytes=0, backupCount=5, encoding="utf-8")
         self._logging_file_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
+        self._logging_file_handler.addFilter(_TaskLogFilter(self))
         self._logging_file_handler.doRollover()
+        _task_context.task = self
         _global_logger.addHandler(self._logging_file_handler)
 
     def _closeUserLogging(self):
         _global_logger.removeHandler(self._logging_file_handler)
+        _task_context.task = None
         self._logging_file_handler.flush()
         self._logging_file_handler.close()
 
+    def _inTaskContext(self, fn, deadline=None):
+        # For anything run on the pools, so what it logs still ends up in this user's log.
+        # Same goes for the deadline (unless it gets one of its own).
+        def run(*args, **kwargs):
+            _task_context.task = self
+            set_request_deadline(deadline if deadline else self._deadline)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _task_context.task = None
+                set_request_deadline(None)
+        return run
+
+    def _deadlineNear(self):
+        return self._deadline is not None and datetime.utcnow() >= self._deadline - timedelta(seconds=SYNC_DEADLINE_RESERVE)
+
+    def _deadlinePassed(self):
+        return self._deadline is not None and datetime.utcnow() >= self._deadline
+
+    def _listingDeadlinePassed(self):
+        return self._listingDeadline is not None and datetime.utcnow() >= self._listingDeadline
+
     def _loadExtendedAuthData(self):
         self._extendedAuthDetails = list(cachedb.extendedAuthDetails.find({"ID": {"$in": self._connectedServiceIds}}))
 
@@ -315,78 +571,120 @@ class SynchronizationTask:
         db.users.update({"_id": self.user["_id"]}, {"$set": {"NonblockingSyncErrorCount": nonblockingSyncErrorsCount, "BlockingSyncErrorCount": blockingSyncErrorsCount, "ForcingExhaustiveSyncErrorCount": forcingExhaustiveSyncErrorsCount, "SyncExclusionCount": syncExclusionCount}})
 
     def _writeBackActivityRecords(self):
-        def _activityPrescences(prescences):
-            return dict([(svcId if svcId else "",
-                {
-                    "Processed": presc.ProcessedTimestamp,
-                    "Synchronized": presc.SynchronizedTimestamp,
-                    "Exception": _packUserException(presc.UserException)
-                }) for svcId, presc in prescences.items()])
+        # One document per record - and only the ones that changed.
+        if self._upgradeActivityRecords:
+            # Anything already in the new layout is left over from an upgrade that didn't finish - everything gets written out again below.
+            self._writeBuffer.Queue(db.activity_records, pymongo.DeleteMany({"UserID": self.user["_id"], "Activities": {"$exists": False}}))
 
-        self._activityRecords.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
-        composed_records = [
-            {
-                "StartTime": x.StartTime,
-                "EndTime": x.EndTime,
-                "Type": x.Type,
-                "Name": x.Name,
-                "Notes": x.Notes,
-                "Private": x.Private,
-                "Stationary": x.Stationary,
-                "Distance": x.Distance,
-                "UIDs": list(x.UIDs),
-                "Prescence": _activityPrescences(x.PresentOnServices),
-                "Abscence": _activityPrescences(x.NotPresentOnServices),
-                "FailureCounts": x.FailureCounts
-            }
-            for x in self._activityRecords
-        ]
+        retainedRecordIds = set()
+        for record in self._activityRecords:
+            packed_record = _packActivityRecord(record)
+            if hasattr(record, "_id"):
+                retainedRecordIds.add(record._id)
+                if packed_record == record.PersistedState and not self._upgradeActivityRecords:
+                    continue
+            else:
+                record._id = ObjectId()
+            packed_record["UserID"] = self.user["_id"]
+            self._writeBuffer.Queue(db.activity_records, pymongo.ReplaceOne({"_id": record._id}, packed_record, upsert=True))
+            record.PersistedState = packed_record
 
-        db.activity_records.update(
-            {"UserID": self.user["_id"]},
-            {
-                "$set": {
-                    "UserID": self.user["_id"],
-                    "Activities": composed_records
-                }
-            },
-            upsert=True
-        )
+        droppedRecordIds = [x for x in self._persistedActivityRecordIds if x not in retainedRecordIds]
+        if droppedRecordIds:
+            self._writeBuffer.Queue(db.activity_records, pymongo.DeleteMany({"_id": {"$in": droppedRecordIds}}))
+
+        if self._upgradeActivityRecords:
+            self._writeBuffer.Queue(db.activity_records, pymongo.DeleteMany({"UserID": self.user["_id"], "Activities": {"$exists": True}}))
+        self._writeBuffer.Flush()
 
     def _initializeActivityRecords(self):
-        raw_records = db.activity_records.find_one({"UserID": self.user["_id"]})
         self._activityRecords = []
-        if not raw_records:
-            return
-        else:
-            raw_records = raw_records["Activities"]
-            for raw_record in raw_records:
-                if "UIDs" not in raw_record:
-                    continue # From the few days where this was rolled out without this key...
-                rec = ActivityRecord(raw_record)
-                rec.UIDs = set(rec.UIDs)
-                # Did I mention I should really start using an ORM-type deal any day now?
-                for svc, absent in rec.Abscence.items():
-                    rec.NotPresentOnServices[svc] = ActivityServicePrescence(absent["Processed"], absent["Synchronized"], _unpackUserException(absent["Exception"]))
-                for svc, present in rec.Prescence.items():
-                    rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
-                del rec.Prescence
-                del rec.Abscence
-                rec.Touched = False
-                self._activityRecords.append(rec)
+        self._indexActivityRecords()
+        self._upgradeActivityRecords = False
+        self._persistedActivityRecordIds = []
+        for raw_record in ActivityRecord.LoadRaw(self.user["_id"]):
+            if "_id" not in raw_record:
+                # Still in the single-document layout - these all get written out as their own documents at the end.
+                self._upgradeActivityRecords = True
+            if "UIDs" not in raw_record:
+                continue # From the few days where this was rolled out without this key...
+            rec = ActivityRecord(raw_record)
+            rec.UIDs = set(rec.UIDs)
+            # Did I mention I should really start using an ORM-type deal any day now?
+            for svc, absent in rec.Abscence.items():
+                rec.NotPresentOnServices[svc] = ActivityServicePrescence(absent["Processed"], absent["Synchronized"], _unpackUserException(absent["Exception"]))
+            for svc, present in rec.Prescence.items():
+                rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
+            del rec.Prescence
+            del rec.Abscence
+            rec.Touched = False
+            if hasattr(rec, "_id"):
+                rec.PersistedState = copy.deepcopy(_packActivityRecord(rec)) # Or it'd share FailureCounts with the record
+                self._persistedActivityRecordIds.append(rec._id)
+            self._activityRecords.append(rec)
+            self._indexActivityRecord(rec)
+
+    def _indexActivityRecords(self):
+        # UID -> the first record (in self._activityRecords order) containing it, so lookups find the same record a scan of the list would.
+        self._activityRecordsByUID = {}
+        self._activityRecordsHoldingUID = {} # UID -> every record containing it, for when the first one lets go of it
+        self._activityRecordUIDs = {} # What each record was last indexed under
+        self._activityRecordOrder = {}
+        self._touchedActivityRecords = []
+        for record in self._activityRecords:
+            self._indexActivityRecord(record)
+            if getattr(record, "Touched", False):
+                self._touchedActivityRecords.append(record)
+
+    def _indexActivityRecord(self, record):
+        # Must be called again when the record's UIDs change.
+        if id(record) not in self._activityRecordOrder:
+            self._activityRecordOrder[id(record)] = len(self._activityRecordOrder)
+        recordOrder = self._activityRecordOrder[id(record)]
+        uids = set(record.UIDs) # A copy - the record's set is often shared with (and grown by) the activity
+        # Whatever UIDs it's since lost shouldn't lead back to it any more.
+        for uid in self._activityRecordUIDs.get(id(record), set()) - uids:
+            holders = self._activityRecordsHoldingUID[uid]
+            del holders[id(record)]
+            if self._activityRecordsByUID.get(uid) is record:
+                if holders:
+                    self._activityRecordsByUID[uid] = min(holders.values(), key=lambda x: self._activityRecordOrder[id(x)])
+                else:
+                    del self._activityRecordsByUID[uid]
+        self._activityRecordUIDs[id(record)] = uids
+        for uid in uids:
+            self._activityRecordsHoldingUID.setdefault(uid, {})[id(record)] = record
+            indexedRecord = self._activityRecordsByUID.get(uid)
+            if indexedRecord is None or self._activityRecordOrder[id(indexedRecord)] > recordOrder:
+                self._activityRecordsByUID[uid] = record
+
+    def _touchActivityRecord(self, record):
+        if not record.Touched:
+            record.Touched = True
+            self._touchedActivityRecords.append(record)
+
+    def _findActivityRecord(self, activity):
+        candidates = [self._activityRecordsByUID[uid] for uid in activity.UIDs if uid in self._activityRecordsByUID]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda x: self._activityRecordOrder[id(x)])
 
     def _findOrCreateActivityRecord(self, activity):
-        for record in self._activityRecords:
-            if record.UIDs & activity.UIDs:
-                record.Touched = True
-                return record
+        record = self._findActivityRecord(activity)
+        if record:
+            self._touchActivityRecord(record)
+            return record
         record = ActivityRecord.FromActivity(activity)
-        record.Touched = True
+        record.Touched = False
+        self._touchActivityRecord(record)
         self._activityRecords.append(record)
+        self._indexActivityRecord(record)
         return record
 
     def _dropUntouchedActivityRecords(self):
-        self._activityRecords[:] = [x for x in self._activityRecords if x.Touched]
+        # We already know which records were touched, no need to go through the rest.
+        self._activityRecords[:] = sorted(self._touchedActivityRecords, key=lambda x: self._activityRecordOrder[id(x)])
+        self._indexActivityRecords()
 
     def _persistServiceTrigger(self, serviceRecord):
         self._persistTriggerServices[serviceRecord._id] = True
@@ -412,7 +710,7 @@ class SynchronizationTask:
             if conn._id in activity.ServiceDataCollection:
                 # The activity record is updated earlier for these, blegh.
                 continue
-            elif hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            elif hasattr(conn, "SynchronizedActivities") and not activity.UIDs.isdisjoint(conn.SynchronizedActivities):
                 continue
             elif activity.Type not in conn.Service.SupportedActivities:
                 logger.debug("\t...%s doesn't support type %s" % (conn.Service.ID, activity.Type))
@@ -441,11 +739,9 @@ class SynchronizationTask:
             return a
 
     def _accumulateActivities(self, conn, svcActivities, no_add=False):
-        # Yep, abs() works on timedeltas
-        activityStartLeeway = timedelta(minutes=3)
-        activityStartTZOffsetLeeway = timedelta(minutes=1)
-        timezoneErrorPeriod = timedelta(hours=38)
         from tapiriik.services.interchange import ActivityType
+        if not isinstance(self._activities, ActivityIndex):
+            self._activities = ActivityIndex(self._activities)
         for act in svcActivities:
             act.UIDs = set([act.UID])
             if not hasattr(act, "ServiceDataCollection"):
@@ -458,54 +754,21 @@ class SynchronizationTask:
             if act.TZ and not hasattr(act.TZ, "localize"):
                 raise ValueError("Got activity with TZ type " + str(type(act.TZ)) + " instead of a pytz timezone")
             # Used to ensureTZ() right here - doubt it's needed any more?
-            # Binsearch to find which activities actually need individual attention.
+            # The index finds the activities that are reasonably close together to be considered duplicate:
+            #  - those with the same UID
+            #  - those within a few minutes of each other (as actual instants if both are TZ-aware, otherwise as if they were in the same TZ)
+            #  - sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
+            #    So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
+            #    (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
+            #    There's a very low chance that two activities in this period would intersect and be merged together.
+            #    But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
+            #  - similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
             # Otherwise it's O(mn^2).
-            # self._activities is sorted most recent first
-            relevantActivitiesStart = bisect.bisect_left(self._activities, act.StartTime + timezoneErrorPeriod)
-            relevantActivitiesEnd = bisect.bisect_right(self._activities, act.StartTime - timezoneErrorPeriod, lo=relevantActivitiesStart)
             extantActIter = (
-                              x for x in (self._activities[idx] for idx in range(relevantActivitiesStart, relevantActivitiesEnd)) if
-                              (
-                                  # Identical
-                                  x.UID == act.UID
-                                  or
-                                  # Check to see if the self._activities are reasonably close together to be considered duplicate
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime-x.StartTime) < activityStartLeeway
-                                  )
-                                  or
-                                  # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < activityStartLeeway
-                                  )
-                                  or
-                                  # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
-                                  # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
-                                  #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
-                                  # There's a very low chance that two activities in this period would intersect and be merged together.
-                                  # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < activityStartTZOffsetLeeway
-                                   )
-                                  or
-                                  # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (activityStartTZOffsetLeeway / 2) and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (activityStartTZOffsetLeeway / 2)
-                                   )
-                               )
-                                and
+                              x for x in self._activities.FindDuplicates(act) if
                                 # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
                                 (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type]))
-                              )
+                            )
 
             try:
                 existingActivity = next(extantActIter)
@@ -514,12 +777,17 @@ class SynchronizationTask:
 
             if existingActivity:
                 # we don't merge the exclude values here, since at this stage the services have the option of just not returning those activities
+                # (DefineTZ changes the StartTime and UID too, so the index needs to know what they were before)
+                existingStartTime = existingActivity.StartTime
+                existingUID = existingActivity.UID
                 if act.TZ is not None and existingActivity.TZ is None:
                     existingActivity.TZ = act.TZ
                     existingActivity.DefineTZ()
                 existingActivity.FallbackTZ = existingActivity.FallbackTZ if existingActivity.FallbackTZ else act.FallbackTZ
                 # tortuous merging logic is tortuous
                 existingActivity.StartTime = self._coalesceDatetime(existingActivity.StartTime, act.StartTime)
+                if existingActivity.StartTime is not existingStartTime or existingActivity.UID != existingUID:
+                    self._activities.Update(existingActivity)
                 existingActivity.EndTime = self._coalesceDatetime(existingActivity.EndTime, act.EndTime, knownTz=existingActivity.StartTime.tzinfo)
                 existingActivity.Name = existingActivity.Name if existingActivity.Name else act.Name
                 existingActivity.Notes = existingActivity.Notes if existingActivity.Notes else act.Notes
@@ -551,7 +819,7 @@ class SynchronizationTask:
                 act.UIDs = existingActivity.UIDs  # stop the circular inclusion, not that it matters
                 continue
             if not no_add:
-                bisect.insort_left(self._activities, act)
+                self._activities.Add(act)
 
     def _determineEligibleRecipientServices(self, activity, recipientServices):
         from tapiriik.auth import User
@@ -633,7 +901,7 @@ class SynchronizationTask:
                 # The connection never gets saved in full again, so we can sub these in here at no risk.
                 conn.ExtendedAuthorization = extAuthDetails[0]
 
-    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+    def _shouldDownloadActivityList(self, conn, exhaustive):
         svc = conn.Service
         # Bail out as appropriate for the entire account (_syncErrors contains only blocking errors at this point)
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
@@ -643,32 +911,59 @@ class SynchronizationTask:
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service]:
             logger.info("Service %s is blocked:" % conn.Service.ID)
             self._excludeService(conn, _unpackUserException([x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service][0]))
-            return
+            return False
 
         if svc.ID in DISABLED_SERVICES or svc.ID in WITHDRAWN_SERVICES:
             logger.info("Service %s is widthdrawn" % conn.Service.ID)
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return False
+
+        unavailable_until = ServiceHealth.UnavailableUntil(svc.ID)
+        if unavailable_until:
+            # No sense listing only to hit the same wall as everyone else - we'll catch up with it next time.
+            logger.info("Service %s is unavailable until %s" % (conn.Service.ID, unavailable_until))
+            self._excludeService(conn, UserException(UserExceptionType.RateLimited))
+            return False
 
         if exhaustive and not svc.SupportsExhaustiveListing and not self._activities:
             # If we get to this point, we must already have activity listings from another service.
             logger.info("Account does not contain any services supporting exhaustive activity listing")
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return False
 
         if svc.RequiresExtendedAuthorizationDetails:
             if not conn.ExtendedAuthorization:
                 logger.info("No extended auth details for " + svc.ID)
                 self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
+                return False
+
+        return True
+
+    def _activityListBound(self, exhaustive):
+        # Services that can't list exhaustively are given the earliest activity we already know about instead.
+        if not exhaustive or not self._activities:
+            return exhaustive
+        return min((x.StartTime.replace(tzinfo=None) for x in self._activities))
+
+    def _downloadActivityList(self, conn, exhaustive, no_add=False, listing=None):
+        # listing is a callable returning the result of DownloadActivityList (or raising its exception)
+        # When it's provided, the eligibility checks are assumed to have been done already.
+        svc = conn.Service
+        outOfTime = self._listingDeadlinePassed
+        if listing is None:
+            if not self._shouldDownloadActivityList(conn, exhaustive):
                 return
+            listing_bound = self._activityListBound(exhaustive)
+            listing = lambda: svc.DownloadActivityList(conn, listing_bound)
+            outOfTime = self._deadlinePassed # Since it's listed right here, under the sync's own deadline
 
         try:
             logger.info("\tRetrieving list from " + svc.ID)
-            if not exhaustive or not self._activities:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive)
-            else:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, min((x.StartTime.replace(tzinfo=None) for x in self._activities)))
+            svcActivities, svcExclusions = listing()
         except (ServiceException, ServiceWarning) as e:
+            if outOfTime():
+                # Our fault rather than the service's - not worth an error, just another go.
+                raise SynchronizationOutOfTimeException()
             # Special-case rate limiting errors thrown during listing
             # Otherwise, things will melt down when the limit is reached
             # (lots of users will hit this error, then be marked for full synchronization later)
@@ -684,14 +979,148 @@ class SynchronizationTask:
             self._syncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
             self._excludeService(conn, e.UserException)
             if not _isWarning(e):
+                if ServiceHealth.IsServiceFailure(e):
+                    ServiceHealth.RecordOutcome(svc.ID, False)
                 return
         except Exception as e:
+            if outOfTime():
+                raise SynchronizationOutOfTimeException()
             self._syncErrors[conn._id].append(_packException(SyncStep.List))
             self._excludeService(conn, UserException(UserExceptionType.ListingError))
+            ServiceHealth.RecordOutcome(svc.ID, False)
             return
+        ServiceHealth.RecordOutcome(svc.ID, True)
         self._accumulateExclusions(conn, svcExclusions)
         self._accumulateActivities(conn, svcActivities, no_add=no_add)
 
+    def _downloadActivityLists(self, conns, exhaustive, heartbeat_callback=None):
+        # The listings themselves are retrieved concurrently, but everything they touch on this object is handled here, in the original order
+        # That way, deduplication, exclusions and errors come out exactly as if they had been listed one after another.
+        listable_conns = []
+        for conn in conns:
+            # If we're not going to be doing anything anyways, stop now
+            if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                raise SynchronizationCompleteException()
+            if conn._id in self._listedConnections:
+                continue # Already in the checkpoint we resumed from
+            if self._shouldDownloadActivityList(conn, exhaustive):
+                listable_conns.append(conn)
+
+        if not listable_conns:
+            return
+
+        listing_bound = self._activityListBound(exhaustive)
+        executor = None
+        if self._fanOut:
+            listings = [(conn, self._remoteListing(conn, listing_bound)) for conn in listable_conns]
+        else:
+            executor = ThreadPoolExecutor(max_workers=max(1, min(len(listable_conns), SYNC_LISTING_CONCURRENCY)))
+            listings = [(conn, executor.submit(self._inTaskContext(conn.Service.DownloadActivityList, deadline=self._listingDeadline), conn, listing_bound).result) for conn in listable_conns]
+        try:
+            for idx, (conn, listing) in enumerate(listings):
+                if idx > 0 and len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                    raise SynchronizationCompleteException()
+                if heartbeat_callback:
+                    heartbeat_callback(SyncStep.List)
+
+                self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                self._downloadActivityList(conn, exhaustive, listing=listing)
+                self._listedConnections.append(conn._id)
+                self._checkpointListing(exhaustive)
+        finally:
+            # Don't hang around for listings we no longer care about
+            if executor:
+                executor.shutdown(wait=False)
+
+    def _remoteListing(self, conn, listing_bound):
+        # Hands the listing out, returning something to stand in for the future's result.
+        subtask = self._fanOut.Dispatch(SyncSubtask.List, {"UserID": self.user["_id"], "Deadline": self._listingDeadline, "Connections": [conn._id], "Bound": listing_bound})
+        def listing():
+            activities, exclusions, connections = self._fanOut.Result(subtask)
+            conn.__dict__.update(connections[conn._id]) # Whatever the service changed along the way, e.g. refreshed tokens
+            return activities, exclusions
+        return listing
+
+    def _checkpointListing(self, exhaustive):
+        SyncCheckpoint.SaveListing(self.user["_id"], [x._id for x in self._serviceConnections], exhaustive, self._listedAt, {
+            "Listed": self._listedConnections,
+            "Complete": self._listingComplete,
+            "Activities": self._activities,
+            "SyncErrors": self._syncErrors,
+            "SyncExclusions": self._syncExclusions,
+            "ExcludedServices": self._excludedServices
+        })
+
+    def _checkpointProgress(self, position, force=False):
+        # position being how many activities are completely done with
+        if not force and datetime.utcnow() - self._lastCheckpoint < timedelta(seconds=SYNC_CHECKPOINT_INTERVAL):
+            return
+        self._lastCheckpoint = datetime.utcnow()
+        self._writeBuffer.Flush() # Otherwise we might count something as done that never made it to the database
+        SyncCheckpoint.SaveProgress(self.user["_id"], self._listedAt, {
+            "Position": position,
+            "SyncErrors": self._syncErrors,
+            "SyncExclusions": self._syncExclusions,
+            "ExcludedServices": self._excludedServices,
+            "ActivityRecords": self._touchedActivityRecords,
+            "ForceNextSync": self._sync_result.ForceNextSync,
+            "ForceExhaustive": self._sync_result.ForceExhaustive
+        })
+
+    def _resumeFromCheckpoint(self, exhaustive):
+        """ Picks up where the last sync left off, if it died part-way through - returns how many activities it got through """
+        checkpoint = SyncCheckpoint.Load(self.user["_id"], [x._id for x in self._serviceConnections], exhaustive)
+        if not checkpoint:
+            return 0
+        listing, progress = checkpoint
+        if progress and self._upgradeActivityRecords:
+            # The activity records can't be matched up reliably till they've got their own IDs, so just the listing, thanks.
+            progress = None
+        logger.info("Resuming from checkpoint listed at %s (%d connections listed, %s activities in)" % (listing["ListedAt"], len(listing["Listed"]), progress["Position"] if progress else 0))
+        state = progress if progress else listing
+        self._listedAt = listing["ListedAt"]
+        self._listedConnections = listing["Listed"]
+        self._listingComplete = listing["Complete"]
+        self._activities = listing["Activities"]
+        self._syncErrors = state["SyncErrors"]
+        self._syncExclusions = state["SyncExclusions"]
+        self._excludedServices = state["ExcludedServices"]
+        # Anything that's turned up since that listing won't be in it - so the triggers need to stick around for next time.
+        for conn in self._serviceConnections:
+            self._persistServiceTrigger(conn)
+        if not progress:
+            return 0
+
+        persistedRecords = dict((record._id, idx) for idx, record in enumerate(self._activityRecords) if hasattr(record, "_id"))
+        for record in progress["ActivityRecords"]:
+            if hasattr(record, "_id") and record._id in persistedRecords:
+                self._activityRecords[persistedRecords[record._id]] = record
+            else:
+                self._activityRecords.append(record)
+        self._indexActivityRecords()
+        if progress["ForceNextSync"]:
+            self._sync_result.ForceScheduleNextSyncOnOrBefore(progress["ForceNextSync"])
+        self._sync_result.ForceExhaustive = self._sync_result.ForceExhaustive or progress["ForceExhaustive"]
+        return progress["Position"]
+
+    def _backfillStoppedAt(self, activity, activityIndex):
+        # Everything before this activity is done - but if we stopped short of the old cursor, that's still as far as we've got.
+        cursor = activity.StartTime.replace(tzinfo=None)
+        if self._backfill["Cursor"] is not None and self._backfill["Cursor"] < cursor:
+            cursor = self._backfill["Cursor"]
+        return {"Complete": False, "Cursor": cursor, "Remaining": len(self._activities) - activityIndex, "Total": len(self._activities)}
+
+    def _backfillSliceDone(self, activity, processedActivities):
+        """ Whether this slice of the backfill has gone far enough - if so, the cursor ends up at this activity """
+        startTime = activity.StartTime.replace(tzinfo=None)
+        if self._backfill["Cursor"] is not None and startTime >= self._backfill["Cursor"]:
+            return False # Been through here already, so there's little (if anything) to do
+        if self._backfillSliceStart is None:
+            # First one past the cursor.
+            self._backfillSliceStart = (datetime.utcnow(), processedActivities)
+        startedAt, startedProcessed = self._backfillSliceStart
+        return processedActivities - startedProcessed >= SYNC_BACKFILL_SLICE_ACTIVITIES or datetime.utcnow() - startedAt >= timedelta(seconds=SYNC_BACKFILL_SLICE_DURATION)
+
     def _estimateFallbackTZ(self, activities):
         from collections import Counter
         # With the hope that the majority of the activity records returned will have TZs, and the user's current TZ will constitute the majority.
@@ -718,31 +1147,23 @@ class SynchronizationTask:
         updateServicesWithExistingActivity = False
         for serviceWithExistingActivityId in activity.ServiceDataCollection.keys():
             serviceWithExistingActivity = [x for x in self._serviceConnections if x._id == serviceWithExistingActivityId][0]
-            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not (activity.UIDs <= set(serviceWithExistingActivity.SynchronizedActivities)):
+            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not activity.UIDs.issubset(serviceWithExistingActivity.SynchronizedActivities):
                 updateServicesWithExistingActivity = True
                 break
 
         if updateServicesWithExistingActivity:
             logger.debug("\t\tUpdating SynchronizedActivities")
-            try:
-                db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}},
-                                      {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}},
-                                      multi=True)
-            except pymongo.errors.WriteError as e:
-                if e.code == 17419: # Update makes document too large.
-                    # Throw them all out - exhaustive sync will recover.
-                    # I should probably check that this is actually due to transient issues - otherwise it'll keep happening.
-                    db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}}, {"$unset": {"SynchronizedActivities": ""}})
-                    self._sync_result.ForceExhaustive = True
-                else:
-                    raise
+            # These are buffered - if we lose them, the next listing will find them again.
+            for conn in self._serviceConnections:
+                if conn._id in activity.ServiceDataCollection:
+                    self._markActivitySynchronized(conn, activity)
 
     def _updateActivityRecordInitialPrescence(self, activity):
         for connWithExistingActivityId in activity.ServiceDataCollection.keys():
             connWithExistingActivity = [x for x in self._serviceConnections if x._id == connWithExistingActivityId][0]
             activity.Record.MarkAsPresentOn(connWithExistingActivity)
         for conn in self._serviceConnections:
-            if hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            if hasattr(conn, "SynchronizedActivities") and not activity.UIDs.isdisjoint(conn.SynchronizedActivities):
                 activity.Record.MarkAsPresentOn(conn)
 
     def _syncActivityRedisKey(user):
@@ -756,13 +1177,69 @@ class SynchronizationTask:
     def RecentSyncActivity(user):
         return [json.loads(x.decode("UTF-8")) for x in redis.lrange(SynchronizationTask._syncActivityRedisKey(user), 0, 4)]
 
-    def _downloadActivity(self, activity):
-        act = None
+    def _downloadSources(self, activity):
         actAvailableFromSvcIds = activity.ServiceDataCollection.keys()
         actAvailableFromSvcs = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromSvcIds]
 
         servicePriorityList = Service.PreferredDownloadPriorityList()
-        actAvailableFromSvcs.sort(key=lambda x: servicePriorityList.index(x.Service))
+        actAvailableFromSvcs.sort(key=lambda x: servicePriorityList.index(x.Service.ID))
+        return actAvailableFromSvcs
+
+    def _predictDownloadSource(self, activity):
+        # A side-effect-free guess at where _downloadActivity will get this activity from, if it gets that far.
+        # It's allowed to be wrong - a bad guess just costs a wasted download.
+        if self._deferredServices:
+            return None # Deferred listings can still merge into activities we'd be prefetching.
+        if activity.Private:
+            return None
+        if self._user_config["sync_skip_before"] and activity.StartTime.replace(tzinfo=None) < self._user_config["sync_skip_before"]:
+            return None
+        if self._user_config["sync_upload_delay"] and activity.EndTime and activity.EndTime.replace(tzinfo=None) > datetime.utcnow() - timedelta(seconds=self._user_config["sync_upload_delay"], hours=14):
+            return None # Give or take a time zone.
+
+        hasRecipients = False
+        for conn in self._serviceConnections:
+            if not conn.Service.ReceivesActivities or conn._id in activity.ServiceDataCollection or self._isServiceExcluded(conn):
+                continue
+            if hasattr(conn, "SynchronizedActivities") and not activity.UIDs.isdisjoint(conn.SynchronizedActivities):
+                continue
+            if activity.Type in conn.Service.SupportedActivities:
+                hasRecipients = True
+                break
+        if not hasRecipients:
+            return None
+
+        record = self._findActivityRecord(activity)
+        for dlSvcRecord in self._downloadSources(activity):
+            if not dlSvcRecord.Service.SuppliesActivities or activity.UID in self._syncExclusions[dlSvcRecord._id] or self._isServiceExcluded(dlSvcRecord):
+                continue
+            if record and record.GetFailureCount(dlSvcRecord) >= dlSvcRecord.Service.DownloadRetryCount:
+                continue
+            return dlSvcRecord
+        return None
+
+    def _downloadWorkingCopy(self, activity, dlSvcRecord):
+        workingCopy = copy.copy(activity)  # we can hope
+        # Load in the service data in the same place they left it.
+        workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+        return workingCopy
+
+    def _prefetchActivityDownloads(self, activities, nextActivityIndex):
+        # Start downloading the next few activities (in the order the sync's going through them) while the current one is being processed.
+        # Only the DownloadActivity call happens ahead of time - _downloadActivity picks up the result (or exception) as if it had made the call itself.
+        for activity in activities[nextActivityIndex:nextActivityIndex + SYNC_DOWNLOAD_LOOKAHEAD]:
+            if activity.UID in self._prefetchedDownloads:
+                continue
+            dlSvcRecord = self._predictDownloadSource(activity)
+            if not dlSvcRecord:
+                continue
+            workingCopy = self._downloadWorkingCopy(activity, dlSvcRecord)
+            self._prefetchedDownloads[activity.UID] = (dlSvcRecord._id, workingCopy, self._downloadExecutor.submit(self._inTaskContext(dlSvcRecord.Service.DownloadActivity), dlSvcRecord, workingCopy))
+
+    def _downloadActivity(self, activity):
+        act = None
+        actAvailableFromSvcs = self._downloadSources(activity)
+        prefetched = self._prefetchedDownloads.pop(activity.UID, None)
 
         # TODO: redo this, it was completely broken:
         # Prefer retrieving the activity from its original source.
@@ -789,12 +1266,18 @@ class SynchronizationTask:
                 logger.info("\t\t...download retry count exceeded")
                 continue
 
-            workingCopy = copy.copy(activity)  # we can hope
-            # Load in the service data in the same place they left it.
-            workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+            if prefetched and prefetched[0] == dlSvcRecord._id:
+                workingCopy, download = prefetched[1], prefetched[2].result
+            else:
+                workingCopy = self._downloadWorkingCopy(activity, dlSvcRecord)
+                download = lambda: dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+            prefetched = None
             try:
-                workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+                workingCopy = download()
             except (ServiceException, ServiceWarning) as e:
+                if self._deadlinePassed():
+                    # Cut off by the deadline rather than anything wrong with the activity - it's left for next time.
+                    raise SynchronizationOutOfTimeException()
                 if not _isWarning(e):
                     # Persist the exception if we just exceeded the failure count
                     # (but not if a more useful blocking exception was provided)
@@ -817,6 +1300,8 @@ class SynchronizationTask:
                 activity.Record.MarkAsNotPresentOtherwise(e.UserException)
                 continue
             except Exception as e:
+                if self._deadlinePassed():
+                    raise SynchronizationOutOfTimeException()
                 packed_exc = _packException(SyncStep.Download)
 
                 activity.Record.IncrementFailureCount(dlSvcRecord)
@@ -849,12 +1334,18 @@ class SynchronizationTask:
         # If nothing was downloaded at this point, the activity record will show the most recent error - which is fine enough, since only one service is needed to get the activity.
         return act, dlSvc
 
-    def _uploadActivity(self, activity, destinationServiceRec):
+    def _uploadActivity(self, activity, destinationServiceRec, upload=None):
+        # upload is a callable returning the result of UploadActivity (or raising its exception), if it's already under way elsewhere
         destSvc = destinationServiceRec.Service
 
         try:
+            if upload is not None:
+                return upload()
             return destSvc.UploadActivity(destinationServiceRec, activity)
         except (ServiceException, ServiceWarning) as e:
+            if self._deadlinePassed():
+                # Same as for downloads - not the activity's fault.
+                raise SynchronizationOutOfTimeException()
             if not _isWarning(e):
                 activity.Record.IncrementFailureCount(destinationServiceRec)
                 # The rate-limiting special case here is so that users don't get stranded due to rate limiting issues outside of their control
@@ -870,6 +1361,8 @@ class SynchronizationTask:
                 activity.Record.MarkAsNotPresentOn(destinationServiceRec, e.UserException if e.UserException else UserException(UserExceptionType.UploadError))
                 raise UploadException()
         except Exception as e:
+            if self._deadlinePassed():
+                raise SynchronizationOutOfTimeException()
             packed_exc = _packException(SyncStep.Upload)
 
             activity.Record.IncrementFailureCount(destinationServiceRec)
@@ -883,16 +1376,282 @@ class SynchronizationTask:
 
         activity.Record.ResetFailureCount(destinationServiceRec)
 
-    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
+    def _leaveForNextTime(self, exhaustive):
+        # Out of time - whatever's left gets picked up again shortly.
+        self._sync_result.ForceScheduleNextSyncOnOrBefore(datetime.utcnow() + timedelta(seconds=SYNC_DEADLINE_RESCHEDULE))
+        if exhaustive and not self._backfill:
+            self._sync_result.ForceExhaustive = True
+        # Whatever triggered this sync hasn't been dealt with yet.
+        for conn in self._serviceConnections:
+            self._persistServiceTrigger(conn)
+
+    def _fanOutWaiting(self, heartbeat_callback):
+        # We're not stalled, just waiting on others - and they've got claims of their own that lapse if *they* stall.
+        step = self._lastSyncProgress[0] if self._lastSyncProgress else SyncStep.List
+        if heartbeat_callback:
+            heartbeat_callback(step)
+        self._leaseProgress(step)
+
+    def _fanOutPosition(self, activityIndex):
+        # Anything handed out but not merged back in yet isn't done with, as far as checkpoints go.
+        return min([batch["Activities"][0][0] for batch in self._fanOutBatches] + [x[0] for x in self._fanOutPending[:1]] + [activityIndex])
+
+    def _awaitFanOutRecord(self, record):
+        """ Waits for anything handed out with this activity record to come back - returns how many activities were processed in what came back """
+        # Otherwise we'd be working from (and later overwriting) a stale copy of it.
+        for idx in range(len(self._fanOutBatches) - 1, -1, -1):
+            if id(record) in self._fanOutBatches[idx]["Records"]:
+                return self._mergeFanOut(inFlight=len(self._fanOutBatches) - idx - 1)
+        return 0
+
+    def _fanOutActivity(self, activityIndex, activity, eligibleServices):
+        """ Queues the activity up to be downloaded and uploaded elsewhere - returns how many activities were processed in whatever came back in the meantime """
+        self._fanOutPending.append((activityIndex, activity, [x._id for x in eligibleServices]))
+        if len(self._fanOutPending) >= SYNC_FANOUT_BATCH_SIZE:
+            return self._dispatchFanOutBatch()
+        return self._mergeFanOut()
+
+    def _dispatchFanOutBatch(self):
+        processed = self._mergeFanOut(inFlight=SYNC_FANOUT_CONCURRENCY - 1)
+        pending = self._fanOutPending
+        self._fanOutPending = []
+        activities = [x[1] for x in pending]
+        # They only need to know about the exclusions they'd be checking.
+        exclusions = dict((connId, dict((act.UID, connExclusions[act.UID]) for act in activities if act.UID in connExclusions)) for connId, connExclusions in self._syncExclusions.items())
+        subtask = self._fanOut.Dispatch(SyncSubtask.Batch, {
+            "UserID": self.user["_id"],
+            "Deadline": self._deadline,
+            "Connections": [x._id for x in self._serviceConnections],
+            "Activities": activities,
+            "Destinations": [x[2] for x in pending],
+            "SyncExclusions": exclusions,
+            "ExcludedServices": self._excludedServices
+        })
+        self._fanOutBatches.append({"Subtask": subtask, "Activities": [(x[0], x[1]) for x in pending], "Records": set(id(x.Record) for x in activities)})
+        return processed
+
+    def _mergeFanOut(self, inFlight=None):
+        """ Merges whatever's come back, in the order it went out (waiting till no more than inFlight batches are still out, if given) - returns how many activities were processed """
+        processed = 0
+        while self._fanOutBatches:
+            if (inFlight is None or len(self._fanOutBatches) <= inFlight) and not self._fanOutBatches[0]["Subtask"].IsDone():
+                break
+            processed += self._mergeFanOutBatch(self._fanOutBatches.pop(0))
+        return processed
+
+    def _mergeFanOutBatch(self, batch):
+        # Everything here would have happened in this order had we done it ourselves - errors and all.
+        result = self._fanOut.Result(batch["Subtask"])
+        for (activityIndex, activity), record in zip(batch["Activities"], result["Records"]):
+            activity.Record.__dict__.update(record.__dict__) # Other activities may well have hold of it too
+            self._indexActivityRecord(activity.Record)
+        for connId, errors in result["SyncErrors"].items():
+            self._syncErrors[connId] += errors
+        for connId, exclusions in result["SyncExclusions"].items():
+            self._syncExclusions[connId].update(exclusions)
+        self._excludedServices.update(result["ExcludedServices"])
+        for conn in self._serviceConnections:
+            conn.__dict__.update(result["Connections"][conn._id])
+            if result["Synchronized"][conn._id]:
+                # Already written back by whoever uploaded them.
+                if not isinstance(getattr(conn, "SynchronizedActivities", None), set):
+                    conn.SynchronizedActivities = set(getattr(conn, "SynchronizedActivities", []))
+                conn.SynchronizedActivities |= result["Synchronized"][conn._id]
+        if result["Done"] < len(batch["Activities"]):
+            stoppedAt = batch["Activities"][result["Done"]][0]
+            self._fanOutStoppedAt = stoppedAt if self._fanOutStoppedAt is None else min(self._fanOutStoppedAt, stoppedAt)
+        return result["Processed"]
+
+    def _finishFanOut(self):
+        if self._fanOutPending:
+            self._dispatchFanOutBatch()
+        self._mergeFanOut(inFlight=0)
+
+    def PerformSubtask(kind, payload, renew, heartbeat_callback=None):
+        """ Does one piece of a fanned-out sync, on behalf of whoever's coordinating it - see SyncFanOut """
         from tapiriik.auth import User
+        task = SynchronizationTask(User.Get(payload["UserID"]))
+        task._deadline = payload["Deadline"]
+        previousDeadline = get_request_deadline() # If it's the coordinator doing this, it's still got its own sync to get back to
+        set_request_deadline(task._deadline)
+        try:
+            task._loadSubtaskServiceData(payload["Connections"])
+            if kind == SyncSubtask.List:
+                return task._performListingSubtask(payload, heartbeat_callback)
+            return task._performBatchSubtask(payload, renew, heartbeat_callback)
+        finally:
+            set_request_deadline(previousDeadline)
+
+    def _loadSubtaskServiceData(self, connectionIds):
+        self._connectedServiceIds = connectionIds
+        self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": connectionIds}})]
+        self._loadExtendedAuthData()
+        for conn in self._serviceConnections:
+            # Same as the coordinator's copies - see _initializePersistedSyncErrorsAndExclusions
+            conn.__dict__.pop("SyncErrors", None)
+            conn.__dict__.pop("ExcludedActivities", None)
+            # Just what we add - the coordinator's already done all the checking against these.
+            conn.SynchronizedActivities = set()
+            self._primeExtendedAuthDetails(conn)
+
+    def _subtaskConnectionState(self):
+        return dict((conn._id, dict((k, v) for k, v in conn.__dict__.items() if k != "SynchronizedActivities")) for conn in self._serviceConnections)
+
+    def _performListingSubtask(self, payload, heartbeat_callback):
+        conn = self._serviceConnections[0]
+        if heartbeat_callback:
+            heartbeat_callback(SyncStep.List)
+        logger.info("\tRetrieving list from " + conn.Service.ID)
+        activities, exclusions = conn.Service.DownloadActivityList(conn, payload["Bound"])
+        return activities, exclusions, self._subtaskConnectionState()
+
+    def _performBatchSubtask(self, payload, renew, heartbeat_callback):
+        conns = dict((conn._id, conn) for conn in self._serviceConnections)
+        self._syncErrors = dict((connId, []) for connId in conns.keys())
+        self._syncExclusions = dict((connId, payload["SyncExclusions"].get(connId, {})) for connId in conns.keys())
+        self._excludedServices = dict(payload["ExcludedServices"])
+        self._activityRecords = []
+        self._indexActivityRecords()
+        self._prefetchedDownloads = {}
+        self._uploadExecutor = ThreadPoolExecutor(max_workers=SYNC_UPLOAD_CONCURRENCY)
+        done = processed = 0
+        try:
+            for activity, destinations in zip(payload["Activities"], payload["Destinations"]):
+                if not renew() or self._deadlineNear():
+                    break # The coordinator sorts out the rest
+                if heartbeat_callback:
+                    heartbeat_callback(SyncStep.Download)
+                logger.info(str(activity) + " " + str(activity.UID[:3]) + " to " + str([conns[x].Service.ID for x in destinations]))
+                try:
+                    if self._transferActivity(activity, [conns[x] for x in destinations], heartbeat_callback):
+                        processed += 1
+                except SynchronizationOutOfTimeException:
+                    break # Not done with, so the coordinator leaves it for next time too
+                done += 1
+        finally:
+            self._uploadExecutor.shutdown()
+            self._writeBuffer.Flush()
+        return {
+            "Done": done,
+            "Processed": processed,
+            "Records": [x.Record for x in payload["Activities"]],
+            "SyncErrors": self._syncErrors,
+            "SyncExclusions": self._syncExclusions,
+            "ExcludedServices": dict((k, v) for k, v in self._excludedServices.items() if k not in payload["ExcludedServices"]),
+            "Synchronized": dict((conn._id, conn.SynchronizedActivities) for conn in self._serviceConnections),
+            "Connections": self._subtaskConnectionState()
+        }
+
+    def _transferActivity(self, activity, eligibleServices, heartbeat_callback=None):
+        """ Downloads the activity and uploads it to wherever it's going - returns whether it counts towards the progress """
         from tapiriik.services.interchange import ActivityStatisticUnit
 
+        # Download the full activity record
+        full_activity, activitySource = self._downloadActivity(activity)
+
+        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
+            # The activity record gets updated in _downloadActivity
+            return True  # we tried
+
+        full_activity.CleanStats()
+        full_activity.CleanWaypoints()
+
+        try:
+            full_activity.EnsureTZ()
+        except Exception as e:
+            logger.error("\tCould not determine TZ %s" % e)
+            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
+            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+            return False
+        else:
+            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
+
+        try:
+            full_activity.CheckTimestampSanity()
+        except ValueError as e:
+            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
+            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
+            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
+            # raise ActivityShouldNotSynchronizeException()
+
+        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+        self._indexActivityRecord(activity.Record)
+
+        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
+
+        successful_destination_service_ids = []
+
+        uploadDestinations = []
+        for destinationSvcRecord in eligibleServices:
+            destSvc = destinationSvcRecord.Service
+            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
+                logger.info("\t\t...marked as stationary during download")
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
+                continue
+            if not full_activity.Stationary:
+                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
+                    logger.info("\t\t...marked as non-GPS during download")
+                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
+                    continue
+            uploadDestinations.append(destinationSvcRecord)
+
+        # The uploads themselves happen concurrently, but their results are handled here, in order - same as if they'd happened one by one.
+        # If the deadline cuts one off, the rest still get recorded - otherwise the ones that made it would be uploaded all over again next time.
+        outOfTime = False
+        uploadFutures = [(destinationSvcRecord, self._uploadExecutor.submit(self._inTaskContext(destinationSvcRecord.Service.UploadActivity), destinationSvcRecord, full_activity)) for destinationSvcRecord in uploadDestinations]
+
+        for destinationSvcRecord, uploadFuture in uploadFutures:
+            if heartbeat_callback:
+                heartbeat_callback(SyncStep.Upload)
+            self._leaseProgress(SyncStep.Upload)
+            destSvc = destinationSvcRecord.Service
+
+            uploaded_external_id = None
+            logger.info("\t  Uploading to " + destSvc.ID)
+            try:
+                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord, upload=uploadFuture.result)
+            except UploadException:
+                continue # At this point it's already been added to the error collection, so we can just bail.
+            except SynchronizationOutOfTimeException:
+                outOfTime = True
+                continue
+            logger.info("\t  Uploaded")
+
+            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
+            successful_destination_service_ids.append(destSvc.ID)
+
+            if uploaded_external_id:
+                # record external ID, for posterity (and later debugging)
+                self._writeBuffer.Queue(db.uploaded_activities, pymongo.InsertOne({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()}))
+            # flag as successful
+            self._markActivitySynchronized(destinationSvcRecord, activity)
+
+            self._writeBuffer.Queue(db.sync_stats, pymongo.UpdateOne({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True))
+
+        # Whatever we've recorded about uploads can't wait - if we lost it, we'd end up uploading the activity again.
+        if successful_destination_service_ids:
+            self._writeBuffer.Flush()
+
+        if len(successful_destination_service_ids):
+            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
+        del full_activity
+        if outOfTime:
+            raise SynchronizationOutOfTimeException()
+        return True
+
+    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None, deadline=None):
+        from tapiriik.auth import User
+
         if len(self.user["ConnectedServices"]) <= 1:
             return # Done and done!
 
         sync_result = SynchronizationTaskResult()
         self._sync_result = sync_result
 
+        # Everything (service calls included) has to fit in before this - see _deadlineNear.
+        self._deadline = deadline if deadline else datetime.utcnow() + timedelta(seconds=SYNC_DEADLINE)
+        self._listingDeadline = max(self._deadline, datetime.utcnow() + timedelta(seconds=SYNC_DEADLINE_LISTING))
+
         self._user_config = User.GetConfiguration(self.user)
 
         # Mark this user as in-progress.
@@ -919,11 +1678,29 @@ class SynchronizationTask:
 
         self._initializeActivityRecords()
 
+        resumePosition = self._resumeFromCheckpoint(exhaustive)
+
+        # Exhaustive syncs only go so far at once while a backfill is under way.
+        self._backfill = self.user.get("Backfill") if exhaustive else None
+        self._backfillSliceStart = None
+        # ...and any sync only goes as far as its deadline allows.
+        activitiesComplete = True
+
+        self._uploadExecutor = ThreadPoolExecutor(max_workers=SYNC_UPLOAD_CONCURRENCY)
+        self._downloadExecutor = ThreadPoolExecutor(max_workers=1)
+        self._prefetchedDownloads = {}
+
+        if SyncFanOut.ShouldFanOut(self.user):
+            logger.info("Fanning out")
+            self._fanOut = SyncFanOut(self.user["_id"], lambda kind, payload, renew: SynchronizationTask.PerformSubtask(kind, payload, renew, heartbeat_callback=heartbeat_callback), lambda: self._fanOutWaiting(heartbeat_callback))
+
+        set_request_deadline(self._deadline)
         try:
             try:
-                # Sort services that don't support exhaustive listing last.
+                # Services that don't support exhaustive listing are listed in a second wave.
                 # That way, we can provide them with the proper bounds for listing based
                 # on activities from other services.
+                listing_waves = ([], [])
                 for conn in sorted(self._serviceConnections,
                                    key=lambda x: x.Service.SupportsExhaustiveListing,
                                    reverse=True):
@@ -946,25 +1723,44 @@ class SynchronizationTask:
                         self._deferredServices.append(conn._id)
                         continue
 
-                    if heartbeat_callback:
-                        heartbeat_callback(SyncStep.List)
-
-                    self._updateSyncProgress(SyncStep.List, conn.Service.ID)
-                    self._downloadActivityList(conn, exhaustive)
-
-                self._applyFallbackTZ()
-
-                # Makes reading the logs much easier.
-                self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=True)
-
-                totalActivities = len(self._activities)
-                processedActivities = 0
-
-                for activity in self._activities:
+                    listing_waves[0 if conn.Service.SupportsExhaustiveListing else 1].append(conn)
+
+                if not self._listingComplete:
+                    for listing_wave in listing_waves:
+                        self._downloadActivityLists(listing_wave, exhaustive, heartbeat_callback=heartbeat_callback)
+
+                    self._applyFallbackTZ()
+                    self._listingComplete = True
+                    self._checkpointListing(exhaustive)
+
+                # The index is already ordered most recent first - makes reading the logs much easier.
+                # It's snapshotted here since a deferred listing can still move things around in it (filling in a TZ, say) - positions have to stay put for the checkpoints, prefetching and backfill cursor.
+                activities = list(self._activities)
+
+                totalActivities = len(activities)
+                processedActivities = resumePosition
+                stoppedAt = None # The first activity we didn't get to, if we stopped short
+                outOfTime = False
+
+                for activityIndex, activity in enumerate(activities):
+                    if activityIndex < resumePosition:
+                        continue # Done last time
+                    if self._deadlineNear():
+                        logger.info("Out of time at %s (%d of %d activities to go) - leaving the rest for next time" % (activity.StartTime, len(activities) - activityIndex, len(activities)))
+                        stoppedAt = activityIndex
+                        outOfTime = True
+                        break
+                    if self._backfill and self._backfillSliceDone(activity, processedActivities):
+                        logger.info("Backfill slice done at %s (%d of %d activities to go)" % (activity.StartTime, len(activities) - activityIndex, len(activities)))
+                        stoppedAt = activityIndex
+                        break
+                    self._checkpointProgress(self._fanOutPosition(activityIndex))
                     logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([[y.Service.ID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]))
                     logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
                     try:
                         activity.Record = self._findOrCreateActivityRecord(activity) # Make it a member of the activity, to avoid passing it around as a seperate parameter everywhere.
+                        if self._fanOut:
+                            processedActivities += self._awaitFanOutRecord(activity.Record)
 
                         self._updateSynchronizedActivities(activity)
                         self._updateActivityRecordInitialPrescence(activity)
@@ -1078,98 +1874,69 @@ class SynchronizationTask:
                         # The second most important line of logging in the application...
                         logger.info("\t\t...to " + str([x.Service.ID for x in recipientServices]))
 
-                        # Download the full activity record
-                        full_activity, activitySource = self._downloadActivity(activity)
+                        if self._fanOut:
+                            # The downloading and uploading happens elsewhere - it's all merged back in by _mergeFanOutBatch.
+                            processedActivities += self._fanOutActivity(activityIndex, activity, eligibleServices)
+                            continue
 
-                        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
-                            # The activity record gets updated in _downloadActivity
-                            processedActivities += 1  # we tried
-                            raise ActivityShouldNotSynchronizeException()
-
-                        full_activity.CleanStats()
-                        full_activity.CleanWaypoints()
+                        if SYNC_DOWNLOAD_LOOKAHEAD:
+                            self._prefetchActivityDownloads(activities, activityIndex + 1)
 
-                        try:
-                            full_activity.EnsureTZ()
-                        except Exception as e:
-                            logger.error("\tCould not determine TZ %s" % e)
-                            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
-                            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+                        if not self._transferActivity(activity, eligibleServices, heartbeat_callback):
                             raise ActivityShouldNotSynchronizeException()
-                        else:
-                            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
-
-                        try:
-                            full_activity.CheckTimestampSanity()
-                        except ValueError as e:
-                            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
-                            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
-                            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
-                            # raise ActivityShouldNotSynchronizeException()
-
-                        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
-
-                        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
-
-                        successful_destination_service_ids = []
-
-                        for destinationSvcRecord in eligibleServices:
-                            if heartbeat_callback:
-                                heartbeat_callback(SyncStep.Upload)
-                            destSvc = destinationSvcRecord.Service
-                            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
-                                logger.info("\t\t...marked as stationary during download")
-                                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
-                                continue
-                            if not full_activity.Stationary:
-                                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
-                                    logger.info("\t\t...marked as non-GPS during download")
-                                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
-                                    continue
-
-                            uploaded_external_id = None
-                            logger.info("\t  Uploading to " + destSvc.ID)
-                            try:
-                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord)
-                            except UploadException:
-                                continue # At this point it's already been added to the error collection, so we can just bail.
-                            logger.info("\t  Uploaded")
-
-                            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
-                            successful_destination_service_ids.append(destSvc.ID)
-
-                            if uploaded_external_id:
-                                # record external ID, for posterity (and later debugging)
-                                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
-                            # flag as successful
-                            db.connections.update({"_id": destinationSvcRecord._id},
-                                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
-
-                            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
-
-                        if len(successful_destination_service_ids):
-                            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
-                        del full_activity
                         processedActivities += 1
                     except ActivityShouldNotSynchronizeException:
                         continue
+                    except SynchronizationOutOfTimeException:
+                        # Same as running out above, just noticed later - this activity's left for next time along with the rest.
+                        logger.info("Ran out of time at %s (%d of %d activities to go) - leaving the rest for next time" % (activity.StartTime, len(activities) - activityIndex, len(activities)))
+                        stoppedAt = activityIndex
+                        outOfTime = True
+                        break
                     finally:
+                        self._prefetchedDownloads.pop(activity.UID, None) # In case it never got as far as _downloadActivity
                         del activity
 
+                if self._fanOut:
+                    self._finishFanOut()
+                    if self._fanOutStoppedAt is not None:
+                        # Somebody ran out of time part-way through a batch.
+                        stoppedAt = self._fanOutStoppedAt if stoppedAt is None else min(stoppedAt, self._fanOutStoppedAt)
+                        outOfTime = True
+
+                if outOfTime:
+                    self._leaveForNextTime(exhaustive)
+                    self._checkpointProgress(stoppedAt, force=True) # So the next go starts right here
+                activitiesComplete = stoppedAt is None
+                if self._backfill:
+                    sync_result.Backfill = {"Complete": True} if activitiesComplete else self._backfillStoppedAt(activities[stoppedAt], stoppedAt)
+
             except SynchronizationCompleteException:
                 # This gets thrown when there is obviously nothing left to do - but we still need to clean things up.
                 logger.info("SynchronizationCompleteException thrown")
+                if self._fanOut:
+                    self._finishFanOut() # Whatever's already been handed out is as good as done
+            except SynchronizationOutOfTimeException:
+                # Whatever was listed in time is in the checkpoint - the rest, and everything after, is for next time.
+                logger.info("Out of time listing (%d of %d connections listed) - leaving the rest for next time" % (len(self._listedConnections), len(self._serviceConnections)))
+                self._leaveForNextTime(exhaustive)
+                activitiesComplete = False
 
             logger.info("Writing back service data")
+            self._writeBuffer.Flush()
             self._writeBackSyncErrorsAndExclusions()
 
-            if exhaustive:
+            if exhaustive and activitiesComplete:
                 # Clean up potentially orphaned records, since we know everything is here.
                 logger.info("Clearing old activity records")
                 self._dropUntouchedActivityRecords()
 
             logger.info("Writing back activity records")
             self._writeBackActivityRecords()
+            if activitiesComplete:
+                SyncCheckpoint.Clear(self.user["_id"])
+            sync_result.ActivityCount = len(self._activityRecords)
+            sync_result.ActivityCadence = SyncCadence.FromActivityRecords(self._activityRecords)
 
             logger.info("Finalizing")
             # Clear non-persisted extended auth details.
@@ -1186,7 +1953,15 @@ class SynchronizationTask:
         else:
             logger.info("Finished sync for %s (worker %d)" % (self.user["_id"], os.getpid()))
         finally:
+            if self._lease:
+                self._lease.Release() # If we didn't make it as far as unlocking - otherwise, this does nothing
+            self._uploadExecutor.shutdown()
+            # Any remaining prefetches are only for activities we've since decided against - no need to wait on them.
+            self._downloadExecutor.shutdown(wait=False)
+            if self._fanOut:
+                self._fanOut.Close()
             self._closeUserLogging()
+            set_request_deadline(None)
 
         return sync_result
 
@@ -1195,6 +1970,9 @@ class SynchronizationTaskResult:
     def __init__(self, force_next_sync=None, force_exhaustive=False):
         self.ForceNextSync = force_next_sync
         self.ForceExhaustive = force_exhaustive
+        self.ActivityCount = None # How many we know of, all told - for SyncCost
+        self.ActivityCadence = None
+        self.Backfill = None # Where this slice of the backfill got to, if it was one
 
     def ForceScheduleNextSyncOnOrBefore(self, next_sync):
         self.ForceNextSync = self.ForceNextSync if self.ForceNextSync and self.ForceNextSync < next_sync else next_sync
@@ -1209,6 +1987,12 @@ class ActivityShouldNotSynchronizeException(Exception):
 class SynchronizationCompleteException(Exception):
     pass
 
+class SynchronizationOutOfTimeException(Exception):
+    pass
+
+class SynchronizationLockedException(Exception):
+    pass
+
 class SyncStep:
     List = "list"
     Download = "download"
@@ -0,0 +1,59 @@
+from tapiriik.database import db
+from pymongo.errors import BulkWriteError
+import pymongo
+
+class SynchronizedActivities:
+    """
+    Which activities (by UID) are known to be present on which connections.
+
+    These used to be an array on the connection document itself - which grew without bound, until it hit the document size limit.
+    """
+    _indexEnsured = False
+
+    def _collection():
+        if not SynchronizedActivities._indexEnsured:
+            db.synchronized_activities.ensure_index([("ConnectionID", pymongo.ASCENDING), ("UID", pymongo.ASCENDING)], unique=True)
+            SynchronizedActivities._indexEnsured = True
+        return db.synchronized_activities
+
+    def Load(connectionIds):
+        """ Returns {connection ID: set of UIDs} for every connection given """
+        synchronized = dict((connId, set()) for connId in connectionIds)
+        for rec in SynchronizedActivities._collection().find({"ConnectionID": {"$in": list(connectionIds)}}, {"ConnectionID": 1, "UID": 1, "_id": 0}):
+            synchronized[rec["ConnectionID"]].add(rec["UID"])
+        return synchronized
+
+    def Count(connectionId):
+        return SynchronizedActivities._collection().find({"ConnectionID": connectionId}).count()
+
+    def _operations(pairs):
+        return [pymongo.UpdateOne({"ConnectionID": connId, "UID": uid}, {"$setOnInsert": {"ConnectionID": connId, "UID": uid}}, upsert=True) for connId, uid in pairs]
+
+    def Queue(writeBuffer, pairs):
+        """ Records each (connection ID, UID) pair when the WriteBuffer is next flushed """
+        collection = SynchronizedActivities._collection()
+        for op in SynchronizedActivities._operations(pairs):
+            writeBuffer.Queue(collection, op, tolerate_duplicate=True)
+
+    def Add(pairs):
+        """ Records each (connection ID, UID) pair in one round-trip """
+        ops = SynchronizedActivities._operations(pairs)
+        if not ops:
+            return
+        try:
+            SynchronizedActivities._collection().bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Two upserts racing for the same pair - either way, it's there now.
+            if [x for x in e.details["writeErrors"] if x["code"] != 11000]:
+                raise
+
+    def Clear(connectionIds):
+        SynchronizedActivities._collection().remove({"ConnectionID": {"$in": list(connectionIds)}})
+
+    def MigrateLegacy(serviceRecord):
+        # Move the array off the connection document, if it's still there.
+        legacy = serviceRecord.__dict__.pop("SynchronizedActivities", None)
+        if legacy is None:
+            return
+        SynchronizedActivities.Add([(serviceRecord._id, uid) for uid in legacy])
+        db.connections.update({"_id": serviceRecord._id}, {"$unset": {"SynchronizedActivities": ""}})
@@ -0,0 +1,63 @@
+from tapiriik.settings import SYNC_WRITE_BUFFER_SIZE, SYNC_WRITE_BUFFER_INTERVAL, SYNC_WRITE_CONCERNS
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+from datetime import datetime, timedelta
+
+class WriteBuffer:
+    """
+    Collects writes made during a sync, and sends them along as ordered bulk writes.
+
+    They're flushed once enough are queued, once the oldest has waited long enough (checked as more are queued - there's no timer), and whenever Flush() is called.
+    """
+    def __init__(self, max_size=SYNC_WRITE_BUFFER_SIZE, max_age=SYNC_WRITE_BUFFER_INTERVAL, write_concerns=SYNC_WRITE_CONCERNS):
+        self._maxSize = max_size
+        self._maxAge = timedelta(seconds=max_age)
+        self._writeConcerns = write_concerns
+        self._pending = []  # (collection, operation, coalesce key, tolerate duplicate)
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def Queue(self, collection, operation, coalesce=None, tolerate_duplicate=False):
+        # Anything queued with the same coalesce key replaces what's already pending - e.g. progress updates, where only the latest matters.
+        # tolerate_duplicate is for upserts that can race someone else's - where the document is there either way, so a duplicate key error isn't one.
+        if coalesce is not None:
+            self._pending = [x for x in self._pending if x[0].full_name != collection.full_name or x[2] != coalesce]
+        self._pending.append((collection, operation, coalesce, tolerate_duplicate))
+        if self._oldest is None:
+            self._oldest = datetime.utcnow()
+        if len(self._pending) >= self._maxSize or datetime.utcnow() - self._oldest >= self._maxAge:
+            self.Flush()
+
+    def _collection(self, collection):
+        if collection.name in self._writeConcerns:
+            return collection.with_options(write_concern=WriteConcern(w=self._writeConcerns[collection.name]))
+        return collection
+
+    def _write(self, collection, operations):
+        # operations being (operation, tolerate duplicate)
+        collection = self._collection(collection)
+        while operations:
+            try:
+                collection.bulk_write([x[0] for x in operations], ordered=True)
+                return
+            except BulkWriteError as e:
+                # Ordered, so it stopped at the first error - carry on after it, if it's a duplicate we were told to expect.
+                error = e.details["writeErrors"][0]
+                if error["code"] != 11000 or not operations[error["index"]][1]:
+                    raise
+                operations = operations[error["index"] + 1:]
+
+    def Flush(self):
+        pending = self._pending
+        self._pending = []
+        self._oldest = None
+        # Consecutive writes to the same collection go together, so the overall order is preserved.
+        while pending:
+            collection = pending[0][0]
+            batchLength = 1
+            while batchLength < len(pending) and pending[batchLength][0].full_name == collection.full_name:
+                batchLength += 1
+            self._write(collection, [(x[1], x[3]) for x in pending[:batchLength]])
+            pending = pending[batchLength:]
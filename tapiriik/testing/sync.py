@@ -1,15 +1,41 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
-from tapiriik.sync import SynchronizationTask
+from tapiriik.sync import Sync, SynchronizationTask, SyncStep, UploadException, SynchronizationLockedException, SynchronizationTaskResult, SynchronizationOutOfTimeException
 from tapiriik.sync.activity_record import ActivityRecord
-from tapiriik.services import UserException, UserExceptionType
+from tapiriik.sync.activity_index import ActivityIndex
+from tapiriik.sync.synchronized_activities import SynchronizedActivities
+from tapiriik.sync.write_buffer import WriteBuffer
+from tapiriik.sync.heartbeat import WorkerHeartbeat, SyncProgress
+from tapiriik.sync.schedule import SyncSchedule
+from tapiriik.sync.lanes import SyncLane, LanePicker
+from tapiriik.sync.cost import SyncCost
+from tapiriik.sync.cadence import SyncCadence
+from tapiriik.sync.backpressure import SyncBackpressure
+from tapiriik.sync.affinity import HostRing, SyncAffinity
+from tapiriik.sync.lease import UserLease
+from tapiriik.sync.checkpoint import SyncCheckpoint
+from tapiriik.sync.fanout import SyncFanOut, SyncSubtask
+from tapiriik.services.health import ServiceHealth
+from tapiriik.settings import SYNC_COST_PER_ACTIVITY, SYNC_INTERVAL_CEILING, SYNC_BACKPRESSURE_QUEUE_LENGTH, SYNC_BACKPRESSURE_RECHECK_INTERVAL, SYNC_OFF_PEAK_HOURS, SYNC_EXHAUSTIVE_MAX_DEFERRAL, SYNC_SERVICE_HEALTH_MIN_SAMPLES, SYNC_CHECKPOINT_INTERVAL, SYNC_BACKFILL_SLICE_ACTIVITIES, SYNC_DEADLINE_RESERVE, SYNC_LEASE_STALL_TIMEOUT
+from tapiriik.services import Service, UserException, UserExceptionType, ServiceException, APIException
 from tapiriik.services.api import APIExcludeActivity
 from tapiriik.services.interchange import Activity, ActivityType
 from tapiriik.auth import User
+from tapiriik.requests_lib import set_request_deadline, request_timeout
+from tapiriik.database import db, redis
+from bson.objectid import ObjectId
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, tzinfo
 import pytz
 import copy
+import time
+import threading
+import pymongo
+import kombu
+from pymongo.errors import BulkWriteError
+import logging
+import importlib
 
 
 class UTC(tzinfo):
@@ -159,6 +185,796 @@ class SyncTests(TapiriikTestCase):
         self.assertEqual(len(recipientServicesB), 0)
         self.assertEqual(len(s._activities), 1)
 
+    def test_service_manifest(self):
+        # The manifest stands in for the services until they're loaded, so it had better match them.
+        for entry in Service.Manifest():
+            svcClass = getattr(importlib.import_module(entry["Module"]), entry["Class"])
+            self.assertEqual(svcClass.ID, entry["ID"])
+            self.assertEqual(svcClass.DisplayName, entry["DisplayName"])
+            self.assertEqual(bool(entry.get("PollsPartialSyncTrigger")), svcClass.PartialSyncTriggerPollInterval is not None)
+        self.assertEqual(set(Service.PreferredDownloadPriorityList()), set(x["ID"] for x in Service.Manifest()))
+        self.assertRaises(ValueError, Service.FromID, "notaservice")
+
+    def test_synchronized_activities_membership(self):
+        ''' check that successful uploads show up in a connection's SynchronizedActivities during the same sync '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        actA = TestTools.create_blank_activity(svcA, actType=ActivityType.Rowing, record=recA)
+        actA.UIDs = set([actA.UID])
+        actA.Record = ActivityRecord.FromActivity(actA)
+
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA, recB]
+        self.assertEqual(s._determineRecipientServices(actA), [recB])
+
+        s._markActivitySynchronized(recB, actA)
+        self.assertEqual(recB.SynchronizedActivities, actA.UIDs)
+        self.assertEqual(s._determineRecipientServices(actA), [])
+
+    def test_synchronized_activities_store(self):
+        ''' check that SynchronizedActivities are stored per connection, and picked up from the old connection array '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        SynchronizedActivities.Clear([recA._id, recB._id])
+
+        writeBuffer = WriteBuffer()
+        SynchronizedActivities.Queue(writeBuffer, [(recA._id, "uid1"), (recB._id, "uid1")])
+        SynchronizedActivities.Queue(writeBuffer, [(recA._id, "uid1"), (recA._id, "uid2")])
+        self.assertEqual(len(writeBuffer), 4)
+        self.assertEqual(SynchronizedActivities.Load([recA._id]), {recA._id: set()})
+        writeBuffer.Flush()
+        self.assertEqual(len(writeBuffer), 0)
+
+        recB.SynchronizedActivities = ["uid3"]
+        SynchronizedActivities.MigrateLegacy(recB)
+        self.assertFalse(hasattr(recB, "SynchronizedActivities"))
+
+        self.assertEqual(SynchronizedActivities.Load([recA._id, recB._id]), {recA._id: set(["uid1", "uid2"]), recB._id: set(["uid1", "uid3"])})
+        self.assertEqual(SynchronizedActivities.Count(recA._id), 2)
+
+    def test_write_buffer(self):
+        ''' check that buffered writes are flushed in order, by size, and coalesced '''
+        collection = db.write_buffer_test
+        collection.remove({})
+        writeBuffer = WriteBuffer(max_size=4, max_age=60)
+        writeBuffer.Queue(collection, pymongo.InsertOne({"_id": 1, "Value": 1}))
+        writeBuffer.Queue(collection, pymongo.UpdateOne({"_id": 1}, {"$set": {"Value": 2}}), coalesce="value")
+        writeBuffer.Queue(collection, pymongo.UpdateOne({"_id": 1}, {"$set": {"Value": 3}}), coalesce="value")
+        self.assertEqual(len(writeBuffer), 2)
+        self.assertEqual(collection.find().count(), 0)
+        writeBuffer.Queue(collection, pymongo.InsertOne({"_id": 2}))
+        writeBuffer.Queue(collection, pymongo.InsertOne({"_id": 1}), tolerate_duplicate=True) # Skipped, since it was expected
+        self.assertEqual(len(writeBuffer), 0)
+        self.assertEqual(collection.find_one({"_id": 1})["Value"], 3)
+        self.assertEqual(collection.find().count(), 2)
+        # Any other duplicate is still an error
+        writeBuffer.Queue(collection, pymongo.InsertOne({"_id": 2}))
+        writeBuffer.Queue(collection, pymongo.InsertOne({"_id": 3}))
+        self.assertRaises(BulkWriteError, writeBuffer.Flush)
+        self.assertEqual(collection.find().count(), 2)
+
+    def test_heartbeat(self):
+        ''' check that heartbeats and progress only reach Mongo at phase boundaries, but can always be read back '''
+        workerId = db.sync_workers.insert({"Heartbeat": datetime.utcnow(), "State": "startup"})
+        heartbeat = WorkerHeartbeat(workerId)
+        heartbeat.Beat("ready")
+        heartbeat.Beat(SyncStep.List, "user")
+        persisted = db.sync_workers.find_one({"_id": workerId})
+        heartbeat.Beat(SyncStep.Download, "user")
+        self.assertEqual(WorkerHeartbeat.Read(db.sync_workers.find({"_id": workerId}))[0]["User"], "user")
+        if redis is not None:
+            self.assertEqual(db.sync_workers.find_one({"_id": workerId}), persisted)
+        # User IDs come back out the same type they went in
+        userId = ObjectId()
+        heartbeat.Beat(SyncStep.List, userId)
+        heartbeat.Beat(SyncStep.Download, userId)
+        self.assertEqual(WorkerHeartbeat.Read(db.sync_workers.find({"_id": workerId}))[0]["User"], userId)
+        heartbeat.Clear()
+
+        user = TestTools.create_mock_user()
+        db.users.update({"_id": user["_id"]}, user, upsert=True)
+        s = SynchronizationTask(user)
+        s._updateSyncProgress(SyncStep.List, 0)
+        s._updateSyncProgress(SyncStep.Download, 0.1)
+        s._updateSyncProgress(SyncStep.Download, 0.5)
+        self.assertEqual(SyncProgress.Read(db.users.find({"_id": user["_id"]}))[0]["SynchronizationProgress"], 0.5)
+        if redis is not None:
+            self.assertEqual(db.users.find_one({"_id": user["_id"]})["SynchronizationProgress"], 0.1)
+        s._unlockUser()
+        self.assertEqual(db.users.find_one({"_id": user["_id"]})["SynchronizationProgress"], 0.5)
+
+    def test_sync_schedule(self):
+        ''' check that due users come out of the schedule earliest-first, and only once '''
+        now = datetime.utcnow().replace(microsecond=0) # (Mongo only keeps milliseconds)
+        times = {}
+        for offset in (-10, -20, 60):
+            user = TestTools.create_mock_user()
+            user["_id"] = ObjectId()
+            user["NextSynchronization"] = now + timedelta(seconds=offset)
+            db.users.update({"_id": user["_id"]}, user, upsert=True)
+            times[user["_id"]] = user["NextSynchronization"]
+        SyncSchedule.Add(times)
+        due = sorted([x for x in times if times[x] <= now], key=lambda x: times[x])
+        popped = SyncSchedule.PopDue(now, 100)
+        if redis is None:
+            self.assertEqual(set(due), set(due).intersection(popped))
+            return
+        self.assertEqual(popped, due)
+        self.assertEqual(SyncSchedule.PopDue(now, 100), [])
+        self.assertEqual(SyncSchedule.NextDue(), max(times.values()))
+
+        SyncSchedule.ScheduleMatching({"_id": {"$in": due}}, now)
+        self.assertEqual(set(SyncSchedule.PopDue(now, 100)), set(due))
+        self.assertEqual(db.users.find_one({"_id": due[0]})["NextSynchronization"], now)
+        SyncSchedule.Remove(list(times.keys()))
+        self.assertEqual(SyncSchedule.NextDue(), None)
+
+        # Holds outlast the schedule being rebuilt from the user records - till they ask to sync, anyway
+        SyncSchedule.Hold({due[0]: now + timedelta(hours=1)})
+        self.assertEqual(SyncSchedule.DueAt(db.users.find_one({"_id": due[0]})), now + timedelta(hours=1))
+        SyncSchedule.Rebuild()
+        popped = SyncSchedule.PopDue(now, 1000)
+        self.assertNotIn(due[0], popped)
+        self.assertIn(due[1], popped)
+        Sync.ScheduleImmediateSync({"_id": due[0]})
+        self.assertNotIn("SyncHeldUntil", db.users.find_one({"_id": due[0]}))
+        self.assertIn(due[0], SyncSchedule.PopDue(datetime.utcnow(), 1000))
+        redis.delete(SyncSchedule._redisKey)
+
+    def test_sync_lanes(self):
+        ''' check that users are routed to the right lane, and that each lane gets its share of the workers '''
+        self.assertEqual(SyncLane.ForUser({"NextSyncLane": SyncLane.Interactive}, True), SyncLane.Interactive)
+        self.assertEqual(SyncLane.ForUser({"NextSyncLane": SyncLane.Triggered}, True), SyncLane.Exhaustive)
+        self.assertEqual(SyncLane.ForUser({"NextSyncLane": SyncLane.Triggered}, False), SyncLane.Triggered)
+        self.assertEqual(SyncLane.ForUser({}, False), SyncLane.Scheduled)
+        self.assertTrue(Sync.WillSyncExhaustively({"NonblockingSyncErrorCount": 1}))
+        self.assertEqual(SyncLane.RoutingKey(SyncLane.Scheduled), "") # Same as before there were lanes
+
+        class FakeQueue:
+            def __init__(self, messages):
+                self.messages = messages
+            def get(self, no_ack):
+                return self.messages.pop(0) if self.messages else None
+
+        originalQueues, originalPicker, originalSubtasks = getattr(Sync, "_lane_queues", None), getattr(Sync, "_lane_picker", None), getattr(Sync, "_subtask_queue", None)
+        Sync._subtask_queue = FakeQueue([])
+        Sync._lane_queues = {
+            SyncLane.Interactive: [FakeQueue([]), FakeQueue(["interactive"] * 10)],
+            SyncLane.Scheduled: [FakeQueue(["host-scheduled"]), FakeQueue(["scheduled"] * 10)],
+            SyncLane.Exhaustive: [FakeQueue([]), FakeQueue([])]
+        }
+        Sync._lane_picker = LanePicker({SyncLane.Interactive: 3, SyncLane.Scheduled: 1, SyncLane.Exhaustive: 1})
+        try:
+            taken = [Sync._nextSyncMessage() for x in range(12)]
+            self.assertEqual(taken.count("interactive"), 9)
+            self.assertEqual(taken[:2], ["interactive", "host-scheduled"]) # The exhaustive lane's empty, so it doesn't get a turn
+            taken = [Sync._nextSyncMessage() for x in range(10)]
+            self.assertEqual(sorted(taken[:9]), ["interactive"] + ["scheduled"] * 8) # Whatever's left, once the other lane runs dry
+            self.assertEqual(taken[9], None)
+            Sync._subtask_queue.messages = ["subtask"]
+            Sync._lane_queues[SyncLane.Interactive][1].messages = ["interactive"]
+            self.assertEqual([Sync._nextSyncMessage() for x in range(2)], ["subtask", "interactive"])
+        finally:
+            Sync._lane_queues, Sync._lane_picker, Sync._subtask_queue = originalQueues, originalPicker, originalSubtasks
+
+    def test_concurrent_worker_idle_heartbeat(self):
+        ''' check that idle slots keep beating while the others are busy, so the watchdog doesn't take the process for stalled '''
+        class FakeMessage:
+            acked = False
+            payload = {}
+            def ack(self):
+                self.acked = True
+
+        busy = threading.Event()
+        beats = []
+        def heartbeat(state, user, slot=0):
+            beats.append((state, slot, busy.is_set()))
+        def perform(body, heartbeat_callback, version, slot=None):
+            busy.set()
+            time.sleep(0.2)
+            busy.clear()
+
+        message = FakeMessage()
+        messages = [message]
+        originalNext, originalPerform = Sync._nextSyncMessage, Sync._performSyncTask
+        Sync._nextSyncMessage = lambda: messages.pop(0) if messages else None
+        Sync._performSyncTask = perform
+        try:
+            Sync.PerformGlobalSync(heartbeat_callback=heartbeat, max_users=1, concurrency=2)
+        finally:
+            Sync._nextSyncMessage, Sync._performSyncTask = originalNext, originalPerform
+        self.assertTrue(message.acked)
+        self.assertIn(("ready", 1, True), beats)
+
+    def test_sync_cost(self):
+        ''' check that sync cost estimates follow how long syncs actually take '''
+        user = TestTools.create_mock_user()
+        self.assertTrue(SyncCost.Estimate(user, exhaustive=True) > SyncCost.Estimate(user))
+        for duration in [100, 100, 400]:
+            user.setdefault("SyncCost", {})
+            for key, value in SyncCost.Update(user, duration, False, 1000).items():
+                user["SyncCost"][key.split(".")[1]] = value
+        self.assertTrue(100 < SyncCost.Estimate(user) < 400)
+        self.assertFalse(SyncCost.IsExpensive(user))
+        # Never timed an exhaustive sync, but we know there's a lot to go through.
+        self.assertTrue(SyncCost.Estimate(user, exhaustive=True) > 1000 * SYNC_COST_PER_ACTIVITY)
+
+    def test_sync_cadence(self):
+        ''' check that the sync interval stretches out for users who haven't been active in a while '''
+        now = datetime(2015, 6, 1, 12)
+        self.assertEqual(SyncCadence.Interval(None, now), Sync.SyncInterval)
+        records = []
+        for days in [1, 2, 3, 5]:
+            rec = ActivityRecord()
+            rec.StartTime = pytz.utc.localize(now - timedelta(days=days))
+            records.append(rec)
+        cadence = SyncCadence.FromActivityRecords(records, now)
+        self.assertEqual(cadence["LastActivity"], now - timedelta(days=1))
+        self.assertEqual(cadence["TypicalGap"], timedelta(days=1).total_seconds())
+        rec = ActivityRecord()
+        rec.StartTime = pytz.utc.localize(now - timedelta(days=9))
+        self.assertEqual(SyncCadence.FromActivityRecords(records + [rec], now)["TypicalGap"], timedelta(days=1.5).total_seconds())
+        activeInterval = SyncCadence.Interval(cadence, now)
+        self.assertTrue(Sync.SyncInterval <= activeInterval)
+        dormantInterval = SyncCadence.Interval(cadence, now + timedelta(days=60))
+        self.assertTrue(activeInterval < dormantInterval <= timedelta(seconds=SYNC_INTERVAL_CEILING))
+        self.assertEqual(SyncCadence.Interval(cadence, now + timedelta(days=3650)), timedelta(seconds=SYNC_INTERVAL_CEILING))
+
+    def test_sync_backpressure(self):
+        ''' check that exhaustive syncs are put off till off-peak when the queue's backed up - but not forever '''
+        class FakeQueue:
+            def __init__(self, length):
+                self.length = length
+            def queue_declare(self, passive):
+                return type("DeclareOk", (), {"message_count": self.length})
+
+        self.assertFalse(SyncBackpressure([FakeQueue(1), FakeQueue(1)]).Saturated())
+        self.assertTrue(SyncBackpressure([FakeQueue(SYNC_BACKPRESSURE_QUEUE_LENGTH), FakeQueue(1)]).Saturated())
+
+        start, end = SYNC_OFF_PEAK_HOURS
+        peak = datetime(2015, 6, 1, end, 30)
+        offPeak = SyncBackpressure.NextOffPeak(peak)
+        self.assertTrue(offPeak > peak and start <= offPeak.hour < end)
+        self.assertEqual(SyncBackpressure.NextOffPeak(offPeak), offPeak + timedelta(seconds=SYNC_BACKPRESSURE_RECHECK_INTERVAL))
+
+        user = {"NextSynchronization": peak}
+        self.assertTrue(peak < SyncBackpressure.DeferUntil(user, peak) <= peak + timedelta(seconds=SYNC_EXHAUSTIVE_MAX_DEFERRAL))
+        user["ExhaustiveDeferredSince"] = peak - timedelta(seconds=SYNC_EXHAUSTIVE_MAX_DEFERRAL)
+        self.assertEqual(SyncBackpressure.DeferUntil(user, peak), None)
+
+    def test_service_health(self):
+        ''' check that services are reported unavailable while rate limited or failing everywhere, and not for one user's problems '''
+        # Other tests' syncs report on the mock services, so these start from scratch.
+        svcA, svcB = [type("MockService", (), {"ID": "health-%s" % ObjectId()}) for x in range(2)]
+        self.assertEqual(ServiceHealth.Unavailable([svcA.ID, svcB.ID]), {})
+
+        until = (datetime.utcnow() + timedelta(minutes=15)).replace(microsecond=0)
+        ServiceHealth.RecordRateLimit(svcA.ID, until)
+        self.assertEqual(ServiceHealth.UnavailableUntil(svcA.ID), until)
+
+        self.assertFalse(ServiceHealth.IsServiceFailure(APIException("auth", user_exception=UserException(UserExceptionType.Authorization))))
+        self.assertTrue(ServiceHealth.IsServiceFailure(APIException("limit", user_exception=UserException(UserExceptionType.RateLimited))))
+        self.assertTrue(ServiceHealth.IsServiceFailure(ValueError()))
+
+        for x in range(SYNC_SERVICE_HEALTH_MIN_SAMPLES - 1):
+            ServiceHealth.RecordOutcome(svcB.ID, False)
+        self.assertIsNone(ServiceHealth.UnavailableUntil(svcB.ID)) # Not enough to go on yet
+        ServiceHealth.RecordOutcome(svcB.ID, False)
+        self.assertIsNotNone(ServiceHealth.UnavailableUntil(svcB.ID))
+        for x in range(SYNC_SERVICE_HEALTH_MIN_SAMPLES):
+            ServiceHealth.RecordOutcome(svcB.ID, True)
+        self.assertIsNone(ServiceHealth.UnavailableUntil(svcB.ID))
+
+    def test_host_ring(self):
+        ''' check that users stick to their host, and only the departed host's users move when one leaves '''
+        users = [ObjectId() for x in range(500)]
+        ring = HostRing(["a", "b", "c", "d"])
+        before = dict((x, ring.Host(x)) for x in users)
+        self.assertEqual(before, dict((x, HostRing(["d", "c", "b", "a"]).Host(x)) for x in users))
+        self.assertEqual(set(before.values()), set(["a", "b", "c", "d"]))
+
+        after = dict((x, HostRing(["a", "b", "d"]).Host(x)) for x in users)
+        self.assertEqual([x for x in users if before[x] != after[x]], [x for x in users if before[x] == "c"])
+        self.assertIsNone(HostRing([]).Host(users[0]))
+
+    def test_host_evacuation(self):
+        ''' check that only users routed to a host by affinity are moved off it when it goes away '''
+        queues = dict((lane, []) for lane in SyncLane.All)
+        queues[SyncLane.Scheduled] = [{"user_id": "a", "affinity": True}, {"user_id": "b"}, {"user_id": "c", "affinity": True}]
+
+        class FakeMessage:
+            def __init__(self, messages, payload):
+                self.messages, self.payload = messages, payload
+            def ack(self):
+                pass
+            def requeue(self):
+                self.messages.append(self.payload)
+
+        class FakeQueue:
+            def __init__(self, name):
+                self.messages = queues[[lane for lane in SyncLane.All if SyncLane.QueueName(lane, "gone") == name][0]]
+            def __call__(self, channel):
+                return self
+            def get(self, no_ack):
+                return FakeMessage(self.messages, self.messages.pop(0)) if self.messages else None
+
+        class FakeProducer:
+            published = []
+            def publish(self, payload, routing_key):
+                self.published.append((payload["user_id"], routing_key))
+
+        producer = FakeProducer()
+        originalQueue = kombu.Queue
+        kombu.Queue = FakeQueue
+        try:
+            SyncAffinity(None, producer)._evacuate("gone")
+        finally:
+            kombu.Queue = originalQueue
+        self.assertEqual(producer.published, [("a", SyncLane.RoutingKey(SyncLane.Scheduled)), ("c", SyncLane.RoutingKey(SyncLane.Scheduled))])
+        self.assertEqual(queues[SyncLane.Scheduled], [{"user_id": "b"}]) # Restricted to that host, so it stays put
+
+    def test_user_lease(self):
+        ''' check that only one worker can hold a user at a time, and that a lapsed lease can be taken over '''
+        user = TestTools.create_mock_user()
+        user["_id"] = ObjectId()
+        db.users.insert(user)
+
+        first = UserLease(user["_id"])
+        self.assertTrue(first.Acquire(SyncStep.List))
+        self.assertTrue(UserLease.IsHeld(db.users.find_one({"_id": user["_id"]})))
+        self.assertFalse(UserLease(user["_id"]).Acquire(SyncStep.List))
+        self.assertRaises(SynchronizationLockedException, SynchronizationTask(user)._lockUser)
+
+        # The first worker's gone quiet...
+        db.users.update({"_id": user["_id"]}, {"$set": {"SynchronizationLeaseExpiry": datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertFalse(UserLease.IsHeld(db.users.find_one({"_id": user["_id"]})))
+        second = UserLease(user["_id"])
+        self.assertTrue(second.Acquire(SyncStep.List))
+
+        # ...and when it comes back, it can't release (or renew) what's no longer its lease.
+        first.Release()
+        self.assertTrue(UserLease.IsHeld(db.users.find_one({"_id": user["_id"]})))
+        self.assertFalse(first._renew())
+        self.assertFalse(first.Progress(SyncStep.Download))
+
+        second.Release()
+        self.assertNotIn("SynchronizationWorker", db.users.find_one({"_id": user["_id"]}))
+
+        # A stalled sync lets its lease lapse - and once someone else has it, doesn't carry on when it wakes up
+        stalled = UserLease(user["_id"])
+        self.assertTrue(stalled.Acquire(SyncStep.Download))
+        stalled._lastProgress = datetime.utcnow() - timedelta(seconds=SYNC_LEASE_STALL_TIMEOUT + 1)
+        self.assertFalse(stalled._renew())
+        db.users.update({"_id": user["_id"]}, {"$set": {"SynchronizationLeaseExpiry": datetime.utcnow() - timedelta(seconds=1)}})
+        third = UserLease(user["_id"])
+        self.assertTrue(third.Acquire(SyncStep.List))
+        self.assertFalse(stalled.Progress(SyncStep.Download))
+        db.users.update({"_id": user["_id"]}, {"$set": {"QueuedAt": datetime.utcnow()}})
+        self.assertFalse(UserLease.RescheduleIfAbandoned(user["_id"], datetime.utcnow())) # The new holder will see to it
+
+        # Same goes if the renewals stop without anyone noticing - it's over once the last one runs out
+        third._stop.set()
+        self.assertTrue(third.Progress(SyncStep.Download))
+        third._expiry = datetime.utcnow() - timedelta(seconds=1)
+        self.assertFalse(third.Progress(SyncStep.Download))
+        third.Release()
+        self.assertTrue(UserLease.RescheduleIfAbandoned(user["_id"], datetime.utcnow()))
+        self.assertNotIn("QueuedAt", db.users.find_one({"_id": user["_id"]}))
+
+    def test_task_log_isolation(self):
+        ''' check that a user's log only picks up messages from their own sync, including from its pools '''
+        from tapiriik.sync.sync import _TaskLogFilter, _task_context
+        sA = SynchronizationTask(TestTools.create_mock_user())
+        sB = SynchronizationTask(TestTools.create_mock_user())
+        filterA = _TaskLogFilter(sA)
+        record = logging.LogRecord("tapiriik", logging.INFO, __file__, 0, "message", None, None)
+
+        self.assertFalse(filterA.filter(record))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertTrue(executor.submit(sA._inTaskContext(filterA.filter), record).result())
+            self.assertFalse(executor.submit(sB._inTaskContext(filterA.filter), record).result())
+            self.assertFalse(executor.submit(filterA.filter, record).result())
+        self.assertIsNone(getattr(_task_context, "task", None))
+
+    def test_concurrent_listing_merge_order(self):
+        ''' check that concurrently-retrieved listings are merged in connection order '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+
+        actA = TestTools.create_blank_activity(svcA, record=recA)
+        actB = TestTools.create_blank_activity(svcB, record=recB)
+        actB.StartTime = actA.StartTime
+        actB.CalculateUID()
+
+        def slow_list(svcRec, exhaustive):
+            time.sleep(0.2)  # Make sure B finishes first
+            return [actA], []
+        svcA.DownloadActivityList = slow_list
+        svcB.DownloadActivityList = lambda svcRec, exhaustive: ([actB], [])
+
+        s = SynchronizationTask(TestTools.create_mock_user())
+        s._serviceConnections = [recA, recB]
+        s._activities = []
+        s._excludedServices = {}
+        s._syncErrors = {recA._id: [], recB._id: []}
+        s._syncExclusions = {recA._id: {}, recB._id: {}}
+
+        s._downloadActivityLists([recA, recB], False)
+
+        self.assertEqual(len(s._activities), 1)
+        self.assertIs(s._activities[0], actA)
+        self.assertEqual(s._activities[0].UIDs, set([actA.UID, actB.UID]))
+
+    def test_sync_checkpoint_resume(self):
+        ''' check that a sync picks up the listing and progress checkpointed by the one before it '''
+        if redis is None:
+            return
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        actA = TestTools.create_blank_activity(svcA, record=recA)
+        actB = TestTools.create_blank_activity(svcB, record=recB)
+        svcA.DownloadActivityList = lambda svcRec, exhaustive: ([actA], [])
+        svcB.DownloadActivityList = lambda svcRec, exhaustive: ([actB], [])
+        user = TestTools.create_mock_user()
+        user["_id"] = ObjectId()
+
+        def task():
+            s = SynchronizationTask(user)
+            s._serviceConnections = [recA, recB]
+            s._activities = []
+            s._excludedServices = {}
+            s._persistTriggerServices = {}
+            s._syncErrors = {recA._id: [], recB._id: []}
+            s._syncExclusions = {recA._id: {}, recB._id: {}}
+            s._activityRecords = []
+            s._indexActivityRecords()
+            s._upgradeActivityRecords = False
+            s._sync_result = SynchronizationTaskResult()
+            return s
+
+        first = task()
+        first._downloadActivityLists([recA, recB], False)
+
+        def never_list(svcRec, exhaustive):
+            raise Exception("Should have come from the checkpoint")
+        svcA.DownloadActivityList = svcB.DownloadActivityList = never_list
+
+        second = task()
+        self.assertEqual(second._resumeFromCheckpoint(False), 0)
+        self.assertEqual(second._listedConnections, [recA._id, recB._id])
+        self.assertEqual([x.UIDs for x in second._activities], [x.UIDs for x in first._activities])
+        self.assertTrue(second._shouldPersistServiceTrigger(recA))
+        second._downloadActivityLists([recA, recB], False)
+        self.assertEqual(second._syncErrors, {recA._id: [], recB._id: []})
+
+        second._lastCheckpoint = datetime.utcnow() - timedelta(seconds=SYNC_CHECKPOINT_INTERVAL)
+        second._sync_result.ForceExhaustive = True
+        second._checkpointProgress(1)
+        third = task()
+        self.assertEqual(third._resumeFromCheckpoint(False), 1)
+        self.assertTrue(third._sync_result.ForceExhaustive)
+
+        # It's no good to a different sort of sync.
+        self.assertIsNone(SyncCheckpoint.Load(user["_id"], [recA._id, recB._id], True))
+        self.assertEqual(task()._resumeFromCheckpoint(False), 0)
+
+    def test_backfill_slices(self):
+        ''' check that a backfill slice runs through everything newer than the cursor, then stops once it's gone far enough past it '''
+        now = datetime.utcnow()
+        self.assertTrue(Sync.WillSyncExhaustively({"Backfill": {"NextSlice": now - timedelta(seconds=1)}}))
+        self.assertFalse(Sync.WillSyncExhaustively({"Backfill": {"NextSlice": now + timedelta(minutes=5)}}))
+
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        cursor = datetime(2014, 6, 1)
+        newer = TestTools.create_blank_activity(svcA, record=recA)
+        newer.StartTime = pytz.utc.localize(cursor + timedelta(days=1))
+        older = TestTools.create_blank_activity(svcA, record=recA)
+        older.StartTime = cursor - timedelta(days=1)
+
+        s = SynchronizationTask(None)
+        s._backfill = {"Cursor": cursor}
+        s._backfillSliceStart = None
+        self.assertFalse(s._backfillSliceDone(newer, 500))
+        self.assertFalse(s._backfillSliceDone(older, 10)) # The slice starts here
+        self.assertFalse(s._backfillSliceDone(older, 10 + SYNC_BACKFILL_SLICE_ACTIVITIES - 1))
+        self.assertTrue(s._backfillSliceDone(older, 10 + SYNC_BACKFILL_SLICE_ACTIVITIES))
+
+        # With no cursor, the whole history is fair game.
+        s._backfill = {"Cursor": None}
+        s._backfillSliceStart = None
+        self.assertFalse(s._backfillSliceDone(newer, 0))
+        self.assertTrue(s._backfillSliceDone(older, SYNC_BACKFILL_SLICE_ACTIVITIES))
+
+    def test_backfill_reschedule(self):
+        ''' check that a sync that doesn't get anywhere with a backfill doesn't leave its slice due again right away '''
+        now = datetime.utcnow()
+        user = {"_id": ObjectId(), "ConnectedServices": [{"Service": "mockA", "ID": ObjectId()}, {"Service": "mockB", "ID": ObjectId()}], "QueuedGeneration": "backfill", "QueuedAt": now}
+        user["Backfill"] = {"Started": now, "Cursor": None, "NextSlice": now - timedelta(minutes=1), "Remaining": None, "Total": None}
+        db.users.insert(dict(user))
+        body = {"user_id": str(user["_id"]), "generation": "backfill"}
+        heartbeat = lambda state, user_id: None
+
+        def fail(user, exhaustive=False, heartbeat_callback=None, deadline=None):
+            raise ValueError("Sync failed")
+        originalPerform = Sync.PerformUserSync
+        try:
+            Sync.PerformUserSync = fail
+            self.assertRaises(ValueError, Sync._performSyncTask, body, heartbeat, "test")
+            rescheduled = db.users.find_one({"_id": user["_id"]})
+            self.assertTrue(rescheduled["Backfill"]["NextSlice"] > now)
+            self.assertTrue(rescheduled["NextSynchronization"] > now)
+
+            # Same goes if there's no result at all
+            db.users.update({"_id": user["_id"]}, {"$set": {"Backfill.NextSlice": now - timedelta(minutes=1), "QueuedGeneration": "backfill"}})
+            Sync.PerformUserSync = lambda user, exhaustive=False, heartbeat_callback=None, deadline=None: None
+            Sync._performSyncTask(body, heartbeat, "test")
+            rescheduled = db.users.find_one({"_id": user["_id"]})
+            self.assertTrue(rescheduled["Backfill"]["NextSlice"] > now)
+            self.assertTrue(rescheduled["NextSynchronization"] > now)
+
+            # ...and with only one connection left, there's nothing to backfill
+            db.users.update({"_id": user["_id"]}, {"$set": {"ConnectedServices": user["ConnectedServices"][:1]}})
+            Sync._performSyncTask(body, heartbeat, "test")
+            self.assertNotIn("Backfill", db.users.find_one({"_id": user["_id"]}))
+        finally:
+            Sync.PerformUserSync = originalPerform
+
+    def test_sync_deadline(self):
+        ''' check that service calls are held to the sync's deadline, and that a backfill cut short doesn't lose its place '''
+        import requests
+        now = datetime.utcnow()
+        self.assertEqual(request_timeout(60, now=now), 60)
+        set_request_deadline(now + timedelta(seconds=10))
+        try:
+            self.assertEqual(request_timeout(60, now=now), 10)
+            self.assertEqual(request_timeout(5, now=now), 5)
+            self.assertEqual(request_timeout(None, now=now), 10)
+            self.assertEqual(request_timeout((3, 60), now=now), (3, 10))
+            with self.assertRaises(requests.exceptions.Timeout):
+                request_timeout(60, now=now + timedelta(seconds=10))
+        finally:
+            set_request_deadline(None)
+
+        s = SynchronizationTask(None)
+        self.assertFalse(s._deadlineNear()) # No deadline, no hurry
+        s._deadline = datetime.utcnow() + timedelta(seconds=SYNC_DEADLINE_RESERVE * 2)
+        self.assertFalse(s._deadlineNear())
+        s._deadline = datetime.utcnow() + timedelta(seconds=SYNC_DEADLINE_RESERVE / 2)
+        self.assertTrue(s._deadlineNear())
+        self.assertFalse(s._deadlinePassed())
+
+        # Stopping short of the cursor mustn't move it forward past what the earlier slices got through.
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        cursor = datetime(2014, 6, 1)
+        newer = TestTools.create_blank_activity(svcA, record=recA)
+        newer.StartTime = pytz.utc.localize(cursor + timedelta(days=1))
+        older = TestTools.create_blank_activity(svcA, record=recA)
+        older.StartTime = cursor - timedelta(days=1)
+        s._activities = [newer, older]
+        s._backfill = {"Cursor": cursor}
+        self.assertEqual(s._backfillStoppedAt(newer, 0), {"Complete": False, "Cursor": cursor, "Remaining": 2, "Total": 2})
+        self.assertEqual(s._backfillStoppedAt(older, 1)["Cursor"], older.StartTime)
+        s._backfill = {"Cursor": None}
+        self.assertEqual(s._backfillStoppedAt(newer, 0)["Cursor"], newer.StartTime.replace(tzinfo=None))
+
+        # Running out of time listing isn't the service's fault - no error, and the connection's left to be listed next time.
+        s._serviceConnections = [recA]
+        s._excludedServices = {}
+        s._syncErrors = {recA._id: []}
+        s._listedConnections = []
+        def listing():
+            raise ServiceException("Timed out")
+        s._listingDeadline = datetime.utcnow() - timedelta(seconds=1)
+        with self.assertRaises(SynchronizationOutOfTimeException):
+            s._downloadActivityList(recA, False, listing=listing)
+        self.assertEqual(s._syncErrors[recA._id], [])
+        self.assertEqual(s._excludedServices, {})
+        s._listingDeadline = datetime.utcnow() + timedelta(seconds=60)
+        s._downloadActivityList(recA, False, listing=listing)
+        self.assertEqual(len(s._syncErrors[recA._id]), 1)
+
+    def test_sync_fanout(self):
+        ''' check that listings and batches done elsewhere are merged back in as if they'd been done by the sync itself '''
+        if redis is None:
+            return
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        db.connections.insert(dict(recA.__dict__))
+        db.connections.insert(dict(recB.__dict__))
+        user = {"_id": ObjectId(), "ConnectedServices": [{"Service": "mockA", "ID": recA._id}, {"Service": "mockB", "ID": recB._id}]}
+        db.users.insert(dict(user))
+
+        acts = [TestTools.create_random_activity(svcA, tz=True, record=recA) for x in range(3)]
+        for idx, act in enumerate(acts):
+            act.UID = "fanout-%d" % idx # They all start at the same time
+            act.UIDs = set([act.UID])
+            act.ServiceDataCollection = {recA._id: {"ActivityID": act.UID}} # Service records don't pickle
+            act.Stationary = False
+            act.GPS = True
+        svcA.DownloadActivityList = lambda svcRec, exhaustive: (acts[:1], [])
+        svcA.DownloadActivity = lambda svcRec, act: act
+        def upload(svcRec, act):
+            if acts[1].UID in act.Record.UIDs:
+                raise ServiceException("Upload failed")
+            return "uploaded-" + act.UID
+        svcB.UploadActivity = upload
+
+        s = SynchronizationTask(user)
+        s._serviceConnections = [recA, recB]
+        s._connectedServiceIds = [recA._id, recB._id]
+        s._excludedServices = {}
+        s._syncErrors = {recA._id: [], recB._id: []}
+        s._syncExclusions = {recA._id: {}, recB._id: {}}
+        s._activityRecords = []
+        s._indexActivityRecords()
+        s._deadline = datetime.utcnow() + timedelta(hours=1)
+        s._fanOut = SyncFanOut(user["_id"], SynchronizationTask.PerformSubtask, lambda: None)
+        originalPriorityList = Service.PreferredDownloadPriorityList
+        Service.PreferredDownloadPriorityList = lambda: [svcA.ID, svcB.ID]
+
+        # Nothing's there to hand them out to here, so the sync ends up doing it all itself - but by way of Redis, all the same.
+        listed, exclusions = s._remoteListing(recA, False)()
+        self.assertEqual([x.UID for x in listed], [acts[0].UID])
+
+        try:
+            for idx, act in enumerate(acts):
+                act.Record = s._findOrCreateActivityRecord(act)
+                s._fanOutActivity(idx, act, [recB])
+                if idx == 0:
+                    s._dispatchFanOutBatch()
+                    # ...as if another worker had picked it up.
+                    self.assertTrue(SyncFanOut.Perform(s._fanOutBatches[0]["Subtask"], SynchronizationTask.PerformSubtask))
+                    self.assertFalse(SyncFanOut.Perform(s._fanOutBatches[0]["Subtask"], SynchronizationTask.PerformSubtask))
+            self.assertEqual(s._fanOutPosition(3), 1)
+            s._finishFanOut()
+            s._fanOut.Close()
+        finally:
+            Service.PreferredDownloadPriorityList = originalPriorityList
+
+        self.assertEqual(s._fanOutBatches, [])
+        self.assertEqual(s._fanOutStoppedAt, None)
+        self.assertTrue(svcB.ID in acts[0].Record.PresentOnServices)
+        self.assertTrue(svcB.ID in acts[2].Record.PresentOnServices)
+        self.assertTrue(svcB.ID in acts[1].Record.NotPresentOnServices)
+        self.assertEqual(acts[1].Record.GetFailureCount(recB), 1)
+        self.assertEqual(s._findActivityRecord(acts[2]), acts[2].Record)
+        self.assertEqual(len(s._syncErrors[recB._id]), 1)
+        self.assertEqual(s._syncErrors[recB._id][0]["Step"], SyncStep.Upload)
+        self.assertEqual(recB.SynchronizedActivities, set([acts[0].UID, acts[2].UID]))
+
+    def test_concurrent_upload_failure(self):
+        ''' check that failures from uploads run on the pool are recorded as if they happened inline '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+
+        act = TestTools.create_blank_activity(svcA, record=recA)
+        act.UIDs = set([act.UID])
+        act.Record = ActivityRecord.FromActivity(act)
+
+        def failing_upload(svcRec, activity):
+            raise ServiceException("Upload failed")
+        svcB.UploadActivity = failing_upload
+
+        s = SynchronizationTask(None)
+        s._excludedServices = {}
+        s._syncErrors = {recA._id: [], recB._id: []}
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        upload_future = executor.submit(svcB.UploadActivity, recB, act)
+        with self.assertRaises(UploadException):
+            s._uploadActivity(act, recB, upload=upload_future.result)
+        executor.shutdown()
+
+        self.assertEqual(act.Record.GetFailureCount(recB), 1)
+        self.assertEqual(len(s._syncErrors[recB._id]), 1)
+        self.assertEqual(s._syncErrors[recB._id][0]["Step"], SyncStep.Upload)
+        self.assertTrue("Upload failed" in s._syncErrors[recB._id][0]["Message"])
+        self.assertTrue(svcB.ID in act.Record.NotPresentOnServices)
+
+    def test_transfer_out_of_time(self):
+        ''' check that downloads, uploads and deferred listings cut off by the deadline are left for next time rather than counted as failures '''
+        import requests
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+
+        act = TestTools.create_blank_activity(svcA, record=recA)
+        act.UIDs = set([act.UID])
+        act.Record = ActivityRecord.FromActivity(act)
+
+        def timed_out(*args):
+            raise requests.exceptions.Timeout("Out of time")
+        svcA.DownloadActivity = timed_out
+        svcB.UploadActivity = timed_out
+        svcB.DownloadActivityList = timed_out
+
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA, recB]
+        s._excludedServices = {}
+        s._syncExclusions = {recA._id: {}, recB._id: {}}
+        s._syncErrors = {recA._id: [], recB._id: []}
+        s._prefetchedDownloads = {}
+        s._listedConnections = []
+        s._deadline = datetime.utcnow() - timedelta(seconds=1)
+        s._listingDeadline = datetime.utcnow() + timedelta(seconds=60) # Deferred listings don't get this long
+
+        originalPriorityList = Service.PreferredDownloadPriorityList
+        Service.PreferredDownloadPriorityList = lambda: [svcA.ID, svcB.ID]
+        try:
+            with self.assertRaises(SynchronizationOutOfTimeException):
+                s._downloadActivity(act)
+        finally:
+            Service.PreferredDownloadPriorityList = originalPriorityList
+        with self.assertRaises(SynchronizationOutOfTimeException):
+            s._uploadActivity(act, recB)
+        with self.assertRaises(SynchronizationOutOfTimeException):
+            s._downloadActivityList(recB, False, no_add=True)
+        self.assertEqual(act.Record.GetFailureCount(recA), 0)
+        self.assertEqual(act.Record.GetFailureCount(recB), 0)
+        self.assertEqual(s._syncErrors, {recA._id: [], recB._id: []})
+        self.assertEqual(s._excludedServices, {})
+        self.assertEqual(s._listedConnections, [])
+
+        # With time to spare, it's the service's fault after all.
+        s._deadline = datetime.utcnow() + timedelta(seconds=60)
+        with self.assertRaises(UploadException):
+            s._uploadActivity(act, recB)
+        self.assertEqual(act.Record.GetFailureCount(recB), 1)
+        self.assertEqual(len(s._syncErrors[recB._id]), 1)
+
+    def test_download_prefetch(self):
+        ''' check that prefetched downloads are picked up instead of downloading again '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+
+        actA = TestTools.create_random_activity(svcA, actType=ActivityType.Rowing, tz=True, record=recA)
+        actA.Stationary = False
+        actA.GPS = True
+        actA.UIDs = set([actA.UID])
+
+        downloads = []
+        def download(svcRec, activity):
+            downloads.append(activity)
+            return activity
+        svcA.DownloadActivity = download
+
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA, recB]
+        s._activities = [actA]
+        s._activityRecords = []
+        s._indexActivityRecords()
+        s._excludedServices = {}
+        s._deferredServices = []
+        s._syncExclusions = {recA._id: {}, recB._id: {}}
+        s._user_config = {"sync_skip_before": None, "sync_upload_delay": 0}
+        s._prefetchedDownloads = {}
+        s._downloadExecutor = ThreadPoolExecutor(max_workers=1)
+
+        originalPriorityList = Service.PreferredDownloadPriorityList
+        Service.PreferredDownloadPriorityList = lambda: [svcA.ID, svcB.ID]
+        try:
+            s._prefetchActivityDownloads(s._activities, 0)
+            self.assertTrue(actA.UID in s._prefetchedDownloads)
+            actA.Record = ActivityRecord.FromActivity(actA)
+            full_activity, source = s._downloadActivity(actA)
+        finally:
+            Service.PreferredDownloadPriorityList = originalPriorityList
+            s._downloadExecutor.shutdown()
+
+        self.assertEqual(len(downloads), 1)
+        self.assertIs(full_activity, downloads[0])
+        self.assertEqual(source, svcA)
+        self.assertEqual(len(s._prefetchedDownloads), 0)
+
     def test_svc_supported_activity_types(self):
         ''' check that only activities are only sent to services which support them '''
         svcA, svcB = TestTools.create_mock_services()
@@ -324,6 +1140,146 @@ class SyncTests(TapiriikTestCase):
 
         self.assertEqual(len(s._activities), 2)
 
+    def test_activity_deduplicate_late_tz(self):
+        ''' check that an activity whose TZ only turns up from the second service is still matched by its actual start afterwards '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        denver = pytz.timezone("America/Denver")
+        actB = TestTools.create_blank_activity(svcB, record=recB)
+        actB.StartTime = datetime(2015, 1, 10, 10, 0, 0)
+        actB.EndTime = actB.StartTime + timedelta(hours=1)
+        actB.CalculateUID()
+        actA = TestTools.create_blank_activity(svcA, record=recA)
+        actA.TZ = denver
+        actA.StartTime = denver.localize(actB.StartTime)
+        actA.EndTime = actA.StartTime + timedelta(hours=1)
+        actA.CalculateUID()
+        # The same instant give or take 90 seconds, but in UTC - only a match if the merged activity's been reindexed as TZ-aware
+        actC = TestTools.create_blank_activity(svcA, record=recA)
+        actC.TZ = pytz.utc
+        actC.StartTime = actA.StartTime.astimezone(pytz.utc) + timedelta(seconds=90)
+        actC.EndTime = actC.StartTime + timedelta(hours=1)
+        actC.CalculateUID()
+
+        s = SynchronizationTask(None)
+        s._activities = []
+        s._accumulateActivities(recB, [copy.deepcopy(actB)])
+        s._accumulateActivities(recA, [copy.deepcopy(actA)])
+        self.assertEqual(len(s._activities), 1)
+        merged = s._activities[0]
+        self.assertEqual(merged.StartTime.tzinfo.zone, "America/Denver")
+        self.assertEqual([id(x) for x in s._activities.FindDuplicates(merged)], [id(merged)])
+
+        s._accumulateActivities(recA, [copy.deepcopy(actC)])
+        self.assertEqual(len(s._activities), 1)
+
+    def test_activity_index(self):
+        ''' check that the activity index is ordered and matched like the sorted list it replaced '''
+        svcA, svcB = TestTools.create_mock_services()
+        actA = TestTools.create_blank_activity(svcA)
+        actA.StartTime = datetime(2015, 3, 4, 5, 6, 7)
+        actA.CalculateUID()
+        actB = TestTools.create_blank_activity(svcB)
+        actB.StartTime = actA.StartTime
+        actB.CalculateUID()
+        actC = TestTools.create_blank_activity(svcB)
+        actC.StartTime = actA.StartTime + timedelta(days=1)
+        actC.CalculateUID()
+
+        index = ActivityIndex()
+        for act in (actA, actB, actC):
+            index.Add(act)
+
+        # Most recent first, and most recently added first among equals
+        self.assertEqual([id(x) for x in index], [id(actC), id(actB), id(actA)])
+        self.assertEqual([id(x) for x in ActivityIndex(list(index))], [id(actC), id(actB), id(actA)])
+
+        # Half-hour TZ offsets, but not anywhere else on the clock
+        actD = TestTools.create_blank_activity(svcA)
+        actD.StartTime = actA.StartTime + timedelta(hours=5, minutes=30, seconds=10)
+        actD.CalculateUID()
+        self.assertEqual([id(x) for x in index.FindDuplicates(actD)], [id(actB), id(actA)])
+        actD.StartTime = actA.StartTime + timedelta(hours=5, minutes=31)
+        self.assertEqual(index.FindDuplicates(actD), [])
+
+    def test_activity_record_index(self):
+        ''' check that activity records are found by UID like the list scan did, and that untouched ones are dropped '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        actA = TestTools.create_random_activity(svcA, tz=True, record=recA)
+        actB = TestTools.create_random_activity(svcB, tz=True, record=recB)
+        actC = TestTools.create_random_activity(svcB, tz=True, record=recB)
+        for offset, act in enumerate((actA, actB, actC)):
+            act.StartTime += timedelta(days=offset)
+            act.CalculateUID()
+            act.UIDs = set([act.UID])
+
+        s = SynchronizationTask(None)
+        s._activityRecords = []
+        s._indexActivityRecords()
+
+        recordA = s._findOrCreateActivityRecord(actA)
+        recordB = s._findOrCreateActivityRecord(actB)
+        self.assertIs(s._findOrCreateActivityRecord(actA), recordA)
+        self.assertIsNone(s._findActivityRecord(actC))
+
+        # The activity picked up a UID belonging to a later record - the earlier one still wins
+        actA.UIDs = actA.UIDs | actB.UIDs
+        recordA.SetActivity(actA)
+        s._indexActivityRecord(recordA)
+        self.assertIs(s._findActivityRecord(actB), recordA)
+
+        # ...and once it's let go of it again, that UID leads back to the later record
+        actA.UIDs = set([actA.UID])
+        recordA.SetActivity(actA)
+        s._indexActivityRecord(recordA)
+        self.assertIs(s._findActivityRecord(actB), recordB)
+        self.assertIs(s._findActivityRecord(actA), recordA)
+
+        for record in s._activityRecords:
+            record.Touched = False
+        s._indexActivityRecords()
+        s._findOrCreateActivityRecord(actC)
+        s._findOrCreateActivityRecord(actA)
+        s._dropUntouchedActivityRecords()
+        self.assertEqual([set(x.UIDs) for x in s._activityRecords], [actA.UIDs, actC.UIDs])
+        actD = TestTools.create_random_activity(svcA, tz=True, record=recA)
+        actD.StartTime += timedelta(days=3)
+        actD.CalculateUID()
+        actD.UIDs = set([actD.UID])
+        self.assertIsNone(s._findActivityRecord(actD))
+
+    def test_activity_record_storage(self):
+        ''' check that activity records are moved out of the single-document layout, and that only changed ones are written back '''
+        user = TestTools.create_mock_user()
+        db.activity_records.remove({"UserID": user["_id"]})
+        legacyRecords = []
+        for idx in range(3):
+            legacyRecords.append({"StartTime": datetime(2015, 3, 4 - idx), "EndTime": datetime(2015, 3, 4 - idx, 1), "Type": ActivityType.Running, "Name": None, "Notes": None, "Private": False, "Stationary": False, "Distance": 1000, "UIDs": ["uid%d" % idx], "Prescence": {}, "Abscence": {}, "FailureCounts": {}})
+        db.activity_records.insert({"UserID": user["_id"], "Activities": legacyRecords})
+
+        s = SynchronizationTask(user)
+        s._initializeActivityRecords()
+        self.assertEqual(len(s._activityRecords), 3)
+        s._writeBackActivityRecords()
+        self.assertEqual(db.activity_records.find({"UserID": user["_id"], "Activities": {"$exists": True}}).count(), 0)
+        self.assertEqual(db.activity_records.find({"UserID": user["_id"]}).count(), 3)
+
+        s = SynchronizationTask(user)
+        s._initializeActivityRecords()
+        self.assertEqual([x.UIDs for x in s._activityRecords], [set(["uid0"]), set(["uid1"]), set(["uid2"])])
+        s._activityRecords[1].FailureCounts["mockA"] = 1
+        s._activityRecords.pop(2)
+        queued = []
+        queue = s._writeBuffer.Queue
+        s._writeBuffer.Queue = lambda collection, op, **kwargs: (queued.append(op), queue(collection, op, **kwargs))
+        s._writeBackActivityRecords()
+        self.assertEqual(len(queued), 2) # The changed one, and the dropped one
+        self.assertEqual([x["UIDs"] for x in ActivityRecord.LoadRaw(user["_id"])], [["uid0"], ["uid1"]])
+        self.assertEqual(ActivityRecord.LoadRaw(user["_id"])[1]["FailureCounts"], {"mockA": 1})
+
     def test_activity_coalesce(self):
         ''' ensure that activity data is getting coalesced by _accumulateActivities '''
         svcA, svcB = TestTools.create_mock_services()
@@ -3,6 +3,9 @@ from django.http import HttpResponse
 from tapiriik.settings import DIAG_AUTH_TOTP_SECRET, DIAG_AUTH_PASSWORD, SITE_VER
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.heartbeat import WorkerHeartbeat, SyncProgress
+from tapiriik.sync.schedule import SyncSchedule
+from tapiriik.sync.lease import UserLease
 from tapiriik.auth import TOTP, DiagnosticsUser, User
 from bson.objectid import ObjectId
 import hashlib
@@ -32,18 +35,21 @@ def diag_queue_dashboard(req):
     # We fetch this twice so the (orphaned) indicators are correct even if there were writes during all these other queries
     context["allWorkerPIDsPre"] = [x["Process"] for x in db.sync_workers.find()]
 
-    context["lockedSyncUsers"] = list(db.users.find({"SynchronizationWorker": {"$ne": None}}))
+    context["lockedSyncUsers"] = SyncProgress.Read(db.users.find({"SynchronizationWorker": {"$ne": None}}))
     context["lockedSyncRecords"] = len(context["lockedSyncUsers"])
+    # These are free to go again - it's just that nobody's picked them up yet.
+    context["lapsedLeaseUserIds"] = [x["_id"] for x in context["lockedSyncUsers"] if not UserLease.IsHeld(x)]
     context["queuedUnlockedUsers"] = list(db.users.find({"SynchronizationWorker": {"$exists": False}, "QueuedAt": {"$ne": None}}))
 
     context["userCt"] = db.users.count()
     context["scheduledCt"] = db.users.find({"$or":[{"NextSynchronization": {"$ne": None, "$exists": True}}, {"QueuedAt": {"$ne": None, "$exists": True}}]}).count()
     context["autosyncCt"] = db.users.find(User.PaidUserMongoQuery()).count()
+    context["schedulerPass"] = SyncSchedule.LastPass()
 
     context["errorUsersCt"] = db.users.find({"NonblockingSyncErrorCount": {"$gt": 0}}).count()
     context["exclusionUsers"] = db.users.find({"SyncExclusionCount": {"$gt": 0}}).count()
 
-    context["allWorkers"] = list(db.sync_workers.find())
+    context["allWorkers"] = WorkerHeartbeat.Read(db.sync_workers.find())
 
     synchronizingUserIds = [x["User"] if "User" in x else None for x in context["allWorkers"]]
     context["duplicatedUserSynchronizations"] = set([x for x in synchronizingUserIds if synchronizingUserIds.count(x) > 1])
@@ -74,10 +80,13 @@ def diag_queue_dashboard(req):
         delta = True
     if "unlockOrphaned" in req.POST:
         orphanedUserIDs = [x["_id"] for x in context["lockedSyncUsers"] if x["SynchronizationWorker"] not in context["allWorkerPIDs"]]
-        db.users.update({"_id":{"$in":orphanedUserIDs}}, {"$unset": {"SynchronizationWorker": None}}, multi=True)
+        db.users.update({"_id":{"$in":orphanedUserIDs}}, {"$unset": {"SynchronizationWorker": None, "SynchronizationLease": None, "SynchronizationLeaseExpiry": None}}, multi=True)
         delta = True
     if "requeueQueued" in req.POST:
-        db.users.update({"QueuedAt": {"$lt": datetime.utcnow()}, "$or": [{"SynchronizationWorker": {"$exists": False}}, {"SynchronizationWorker": None}]}, {"$set": {"NextSynchronization": datetime.utcnow(), "QueuedGeneration": "manual"}, "$unset": {"QueuedAt": True}}, multi=True)
+        requeueAt = datetime.utcnow()
+        requeueUserIds = [x["_id"] for x in db.users.find({"QueuedAt": {"$lt": requeueAt}, "$or": [{"SynchronizationWorker": {"$exists": False}}, {"SynchronizationWorker": None}]}, {"_id": True})]
+        db.users.update({"_id": {"$in": requeueUserIds}}, {"$set": {"NextSynchronization": requeueAt, "QueuedGeneration": "manual"}, "$unset": {"QueuedAt": True}}, multi=True)
+        SyncSchedule.Add(dict((x, requeueAt) for x in requeueUserIds))
 
     if delta:
         return redirect("diagnostics_queue_dashboard")
@@ -148,9 +157,10 @@ def diag_user(req, user):
     if "sync" in req.POST:
         Sync.ScheduleImmediateSync(userRec, req.POST["sync"] == "Full")
     elif "unlock" in req.POST:
-        db.users.update({"_id": ObjectId(user)}, {"$unset": {"SynchronizationWorker": None}})
+        db.users.update({"_id": ObjectId(user)}, {"$unset": {"SynchronizationWorker": None, "SynchronizationLease": None, "SynchronizationLeaseExpiry": None}})
     elif "lock" in req.POST:
-        db.users.update({"_id": ObjectId(user)}, {"$set": {"SynchronizationWorker": 1}})
+        # A lease that never lapses.
+        db.users.update({"_id": ObjectId(user)}, {"$set": {"SynchronizationWorker": 1, "SynchronizationLeaseExpiry": datetime.max}})
     elif "requeue" in req.POST:
         db.users.update({"_id": ObjectId(user)}, {"$unset": {"QueuedAt": None}})
     elif "hostrestrict" in req.POST:
@@ -179,13 +189,14 @@ def diag_user(req, user):
         except:
             pass
     elif "svc_marksync" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])},
-                              {"$addToSet": {"SynchronizedActivities": req.POST["uid"]}},
-                              multi=False)
+        from tapiriik.sync.synchronized_activities import SynchronizedActivities
+        SynchronizedActivities.Add([(ObjectId(req.POST["id"]), req.POST["uid"])])
     elif "svc_clearexc" in req.POST:
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"ExcludedActivities": 1}})
     elif "svc_clearacts" in req.POST:
+        from tapiriik.sync.synchronized_activities import SynchronizedActivities
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1}})
+        SynchronizedActivities.Clear([ObjectId(req.POST["id"])])
         Sync.SetNextSyncIsExhaustive(userRec, True)
     elif "svc_toggle_poll_sub" in req.POST:
         from tapiriik.services import Service
@@ -199,11 +210,13 @@ def diag_user(req, user):
         from tapiriik.services import Service
         svcRec = Service.GetServiceRecordByID(req.POST["id"])
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$pull": {"SyncErrors": {"Scope": "activity"}}})
-        act_recs = db.activity_records.find_one({"UserID": ObjectId(user)})
-        for act in act_recs["Activities"]:
-            if "FailureCounts" in act and svcRec.Service.ID in act["FailureCounts"]:
-                del act["FailureCounts"][svcRec.Service.ID]
-        db.activity_records.save(act_recs)
+        db.activity_records.update({"UserID": ObjectId(user), "FailureCounts." + svcRec.Service.ID: {"$exists": True}}, {"$unset": {"FailureCounts." + svcRec.Service.ID: ""}}, multi=True)
+        act_recs = db.activity_records.find_one({"UserID": ObjectId(user), "Activities": {"$exists": True}}) # Not yet in the one-document-per-activity layout
+        if act_recs:
+            for act in act_recs["Activities"]:
+                if "FailureCounts" in act and svcRec.Service.ID in act["FailureCounts"]:
+                    del act["FailureCounts"][svcRec.Service.ID]
+            db.activity_records.save(act_recs)
     else:
         delta = False
 
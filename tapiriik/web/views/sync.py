@@ -5,6 +5,8 @@ from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import redirect
 from tapiriik.auth import User
 from tapiriik.sync import Sync, SynchronizationTask
+from tapiriik.sync.heartbeat import SyncProgress
+from tapiriik.sync.lease import UserLease
 from tapiriik.database import db
 from tapiriik.services import Service
 from tapiriik.settings import MONGO_FULL_WRITE_CONCERN
@@ -33,6 +35,9 @@ def sync_status(req):
         for err in sorted(conn.SyncErrors, key=err_msg):
             syncHash = zlib.adler32(bytes(err_msg(err), "UTF-8"), syncHash)
 
+    if "SynchronizationWorker" in req.user:
+        SyncProgress.Read([req.user]) # The user record only gets the occasional update while the sync is running
+
     # Flatten NextSynchronization with QueuedAt
     pendingSyncTime = req.user["NextSynchronization"] if "NextSynchronization" in req.user else None
     if "QueuedAt" in req.user and req.user["QueuedAt"]:
@@ -40,12 +45,17 @@ def sync_status(req):
 
     sync_status_dict = {"NextSync": (pendingSyncTime.ctime() + " UTC") if pendingSyncTime else None,
                         "LastSync": (req.user["LastSynchronization"].ctime() + " UTC") if "LastSynchronization" in req.user and req.user["LastSynchronization"] is not None else None,
-                        "Synchronizing": "SynchronizationWorker" in req.user,
+                        "Synchronizing": UserLease.IsHeld(req.user),
                         "SynchronizationProgress": req.user["SynchronizationProgress"] if "SynchronizationProgress" in req.user else None,
                         "SynchronizationStep": req.user["SynchronizationStep"] if "SynchronizationStep" in req.user else None,
                         "SynchronizationWaitTime": None, # I wish.
+                        "Backfill": None,
                         "Hash": syncHash}
 
+    if req.user.get("Backfill"):
+        backfill = req.user["Backfill"]
+        sync_status_dict["Backfill"] = {"Started": backfill["Started"].ctime() + " UTC", "Progress": (1 - backfill["Remaining"] / backfill["Total"]) if backfill["Total"] else None}
+
     if stats and "QueueHeadTime" in stats:
         sync_status_dict["SynchronizationWaitTime"] = (stats["QueueHeadTime"] - (datetime.utcnow() - req.user["NextSynchronization"]).total_seconds()) if "NextSynchronization" in req.user and req.user["NextSynchronization"] is not None else None
 